@@ -0,0 +1,8 @@
+"""
+Package: benchmarks
+Performance benchmarks for the inventory service
+
+Every benchmark runs against the database named by DATABASE_URI, e.g.
+
+  DATABASE_URI=sqlite:////tmp/bench.db python -m benchmarks.finders
+"""
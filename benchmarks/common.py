@@ -0,0 +1,66 @@
+"""
+Helpers shared by the benchmark scripts
+"""
+import json
+import math
+import os
+import platform
+import time
+from datetime import datetime, timezone
+
+# where the scripts write their results unless told otherwise, ignored by git
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+
+def timed(func, repeat):
+    """Calls func repeat times and returns the latency of every call in milliseconds"""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def percentile(samples, pct):
+    """Returns the pct percentile (nearest rank) of a list of samples"""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def summarize(samples):
+    """Summarizes latency samples in milliseconds"""
+    count = len(samples)
+    return {
+        "count": count,
+        "mean_ms": round(sum(samples) / count, 4) if count else 0.0,
+        "min_ms": round(min(samples), 4) if count else 0.0,
+        "p50_ms": round(percentile(samples, 50), 4),
+        "p95_ms": round(percentile(samples, 95), 4),
+        "p99_ms": round(percentile(samples, 99), 4),
+        "max_ms": round(max(samples), 4) if count else 0.0,
+    }
+
+
+def results_path(name):
+    """Returns the default --output path of a benchmark"""
+    return os.path.join(RESULTS_DIR, name)
+
+
+def write_results(path, name, results):
+    """Writes benchmark results with the environment they were measured in"""
+    document = {
+        "benchmark": name,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": results,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as output:
+        json.dump(document, output, indent=2, sort_keys=True)
+        output.write("\n")
+    return document
@@ -0,0 +1,180 @@
+"""
+Micro-benchmarks of the per-request hot paths
+
+Times Product.serialize and Product.deserialize, the request validators
+of the routes, check_content_type and the Product finders, each called
+--number times per sample, and reports the microseconds per call of the
+fastest sample, the least disturbed by the rest of the machine. The
+samples of the cases are taken in turns.
+
+Every run also times a fixed pure Python workload, the calibration case,
+and records the cost of every case relative to it, so the results of a
+slower or faster machine stay comparable. The relative costs are compared
+with --baseline, a file committed with the repository, and the script
+exits with status 1 when a case got slower by more than --tolerance
+percent. --update-baseline rewrites the baseline with this run instead,
+after an intended change.
+
+  DATABASE_URI=sqlite:////tmp/bench.db python -m benchmarks.micro
+  DATABASE_URI=sqlite:////tmp/bench.db python -m benchmarks.micro --update-baseline
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+
+from werkzeug.test import EnvironBuilder
+
+from service.models import db, Product, Condition
+from service.migrations import upgrade
+from service.routes import app, product_args, get_args, retrieve_args, check_content_type, validate_product
+from benchmarks.common import timed, summarize, write_results, results_path
+
+BASELINE = os.path.join(os.path.dirname(__file__), "baselines", "micro.json")
+
+CALIBRATION = "calibration"
+
+SAMPLE = {
+    "product_id": 1, "product_name": "product-1", "quantity": 10, "condition": "USED",
+    "restock_level": 5, "reorder_amount": 20,
+}
+
+
+def seed(rows):
+    """Makes sure Products 1 to rows exist, in every condition"""
+    conditions = list(Condition)
+    if Product.query.count() >= rows:
+        return
+    Product.query.delete()
+    db.session.commit()
+    Product.bulk_create([
+        Product(product_id=number // len(conditions) + 1, product_name="product-{}".format(number % 100),
+                quantity=number % 50, condition=conditions[number % len(conditions)],
+                restock_level=10, reorder_amount=20)
+        for number in range(rows)
+    ])
+
+
+def in_request(func, path, **kwargs):
+    """Returns func called inside a request context, as the routes call it
+
+    The WSGI environ is built once, so the case times the request context
+    and func rather than the test client.
+    """
+    environ = EnvironBuilder(path, **kwargs).get_environ()
+
+    def call():
+        with app.request_context(dict(environ)):
+            return func()
+    return call
+
+
+def calibrate():
+    """The fixed workload the cost of every case is measured against"""
+    values = {}
+    for number in range(100):
+        values["key-{}".format(number)] = number * number
+    return sorted(values.items(), key=lambda item: -item[1])
+
+
+def cases():
+    """Returns {name: function} of every hot path"""
+    product = Product().deserialize(SAMPLE)
+    return {
+        CALIBRATION: calibrate,
+        "serialize": product.serialize,
+        "deserialize": lambda: Product().deserialize(SAMPLE),
+        "validate_product": lambda: Product(**validate_product(SAMPLE)),
+        "request_context": in_request(lambda: None, "/inventory/1"),
+        "product_args": in_request(product_args.parse_args, "/inventory/1/inc?condition=USED&value=5"),
+        "get_args": in_request(get_args.parse_args, "/inventory?product_name=product-1&condition=USED&limit=50"),
+        "retrieve_args": in_request(retrieve_args.parse_args, "/inventory/1?condition=USED"),
+        "check_content_type": in_request(lambda: check_content_type("application/json"), "/inventory",
+                                         method="POST", content_type="application/json"),
+        "find": lambda: Product.find(1),
+        "find_by_id": lambda: Product.find_by_id(1).all(),
+        "find_by_id_and_condition": lambda: Product.find_by_id_and_condition(1, Condition.USED),
+        "find_by_name": lambda: Product.find_by_name("product-1").limit(50).all(),
+        "find_by_condition": lambda: Product.find_by_condition(Condition.USED).limit(50).all(),
+        "page": lambda: Product.page(Product.query, 50),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Returns {case: change in percent} and the cases whose relative cost regressed beyond tolerance"""
+    changes, regressed = {}, []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if name == CALIBRATION or not before or not before.get("relative"):
+            continue
+        change = (result["relative"] - before["relative"]) / before["relative"] * 100
+        changes[name] = round(change, 1)
+        if change > tolerance:
+            regressed.append(name)
+    return changes, regressed
+
+
+def main(argv=None):
+    """Runs every case, prints the cost per call and checks it against the baseline"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=5000, help="Products in the table the finders query")
+    parser.add_argument("--number", type=int, default=200, help="calls per sample")
+    parser.add_argument("--repeat", type=int, default=15, help="samples per case")
+    parser.add_argument("--cases", help="comma-separated cases to run, all by default")
+    parser.add_argument("--baseline", default=BASELINE, help="results to compare with")
+    parser.add_argument("--tolerance", type=float, default=50, help="allowed slowdown in percent")
+    parser.add_argument("--update-baseline", action="store_true", help="write this run to --baseline")
+    parser.add_argument("--output", default=results_path("micro.json"), help="where to write the JSON results")
+    args = parser.parse_args(argv)
+
+    app.logger.setLevel(logging.CRITICAL)
+    upgrade(db.engine)
+    seed(args.rows)
+    selected = cases()
+    if args.cases:
+        selected = {name: selected[name] for name in [CALIBRATION] + args.cases.split(",")}
+
+    # every round times each case once, so a slower phase of the machine hits all of them
+    samples = {name: [] for name in selected}
+    with app.app_context():
+        for _ in range(args.repeat):
+            for name, func in selected.items():
+                def batch(func=func):
+                    for _ in range(args.number):
+                        func()
+                samples[name].extend(timed(batch, 1))
+                db.session.remove()
+    results = {}
+    for name, latencies in samples.items():
+        latency = summarize(latencies)
+        results[name] = {"per_call_us": round(latency["min_ms"] * 1000 / args.number, 3),
+                         "p50_per_call_us": round(latency["p50_ms"] * 1000 / args.number, 3)}
+    for result in results.values():
+        result["relative"] = round(result["per_call_us"] / results[CALIBRATION]["per_call_us"], 4)
+
+    changes, regressed = {}, []
+    if not args.update_baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as baseline:
+            changes, regressed = compare(results, json.load(baseline)["results"]["cases"], args.tolerance)
+    write_results(args.output, "micro", {
+        "rows": args.rows, "number": args.number, "cases": results, "change_percent": changes,
+    })
+    if args.update_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        shutil.copyfile(args.output, args.baseline)
+
+    print("{:<26} {:>12} {:>12} {:>10} {:>10}".format("case", "us per call", "median us", "relative", "change"))
+    for name, result in results.items():
+        change = "{:+.1f}%".format(changes[name]) if name in changes else ""
+        print("{:<26} {:>12.3f} {:>12.3f} {:>10.3f} {:>10}".format(
+            name, result["per_call_us"], result["p50_per_call_us"], result["relative"], change))
+    if regressed:
+        print("Slower than the baseline by more than {:.0f}%: {}".format(args.tolerance, ", ".join(regressed)))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
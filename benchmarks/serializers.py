@@ -0,0 +1,72 @@
+"""
+Per-row cost of serializing Products
+
+Compares the former read path, Product.serialize() followed by flask-restx
+marshalling and JSON encoding, with the precompiled serializers that the
+routes now use.
+
+  DATABASE_URI=sqlite:////tmp/bench.db python -m benchmarks.serializers --rows 10000
+"""
+import argparse
+import json
+import logging
+import sys
+
+from flask_restx import marshal
+
+from service.models import Product, Condition
+from service.routes import app, product_model
+from service.serializers import product_dict, dumps
+from benchmarks.common import timed, summarize, write_results, results_path
+
+
+def make_products(rows):
+    """Returns rows unsaved Products"""
+    conditions = list(Condition)
+    return [
+        Product(id=number, product_id=10000 + number, product_name="product-{}".format(number),
+                quantity=number % 100, condition=conditions[number % len(conditions)],
+                restock_level=10, reorder_amount=20)
+        for number in range(rows)
+    ]
+
+
+def cases(products):
+    """Returns the serialization paths to compare, each serializing every product once"""
+    return {
+        "serialize+marshal": lambda: [marshal(product.serialize(), product_model) for product in products],
+        "serialize+marshal+json": lambda: json.dumps(
+            [marshal(product.serialize(), product_model) for product in products]),
+        "product_dict": lambda: [product_dict(product) for product in products],
+        "product_dict+dumps": lambda: dumps([product_dict(product) for product in products]),
+    }
+
+
+def main(argv=None):
+    """Runs every case and prints the cost per row"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=10000, help="Products serialized per run")
+    parser.add_argument("--repeat", type=int, default=20, help="runs per case")
+    parser.add_argument("--output", default=results_path("serializers.json"), help="where to write the JSON results")
+    args = parser.parse_args(argv)
+
+    app.logger.setLevel(logging.CRITICAL)
+    products = make_products(args.rows)
+    results = {}
+    with app.test_request_context():
+        for name, func in cases(products).items():
+            latency = summarize(timed(func, args.repeat))
+            latency["per_row_us"] = round(latency["p50_ms"] * 1000 / args.rows, 3)
+            results[name] = latency
+    write_results(args.output, "serializers", {"rows": args.rows, "cases": results})
+
+    baseline = results["serialize+marshal+json"]["per_row_us"]
+    print("{:<24} {:>12} {:>9}".format("case", "us per row", "speedup"))
+    for name, latency in results.items():
+        print("{:<24} {:>12.3f} {:>8.1f}x".format(
+            name, latency["per_row_us"], baseline / latency["per_row_us"]))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
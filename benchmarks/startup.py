@@ -0,0 +1,83 @@
+"""
+Startup budget of the service
+
+Imports service:app in --runs fresh interpreters with python -X importtime,
+records the cumulative import time of the service package, the peak RSS of
+the process once the app is loaded and the slowest imported modules, and
+exits with status 1 when the median import time or RSS exceeds its budget.
+
+  DATABASE_URI=sqlite:////tmp/bench.db python -m benchmarks.startup --max-import-ms 1000 --max-rss-mb 80
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+
+from benchmarks.common import write_results, results_path
+
+PROBE = "import resource, service; service.app; print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)"
+
+
+def parse_importtime(stderr):
+    """Returns {module: (self_us, cumulative_us)} from the output of -X importtime"""
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        modules[name.strip()] = (int(self_us), int(cumulative_us))
+    return modules
+
+
+def measure():
+    """Imports the app in a new interpreter and returns (import ms, RSS MB, modules)"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", PROBE], capture_output=True, text=True, check=True
+    )
+    modules = parse_importtime(result.stderr)
+    rss_kb = int(result.stdout.strip().splitlines()[-1])  # ru_maxrss is in KB on Linux
+    return modules["service"][1] / 1000, rss_kb / 1024, modules
+
+
+def main(argv=None):
+    """Measures the startup of the app and checks it against the budgets"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="fresh interpreters to measure")
+    parser.add_argument("--max-import-ms", type=float, default=1000, help="budget of the median import time")
+    parser.add_argument("--max-rss-mb", type=float, default=80, help="budget of the median RSS after import")
+    parser.add_argument("--top", type=int, default=15, help="slowest modules to list")
+    parser.add_argument("--output", default=results_path("startup.json"), help="where to write the JSON results")
+    args = parser.parse_args(argv)
+
+    runs = [measure() for _ in range(args.runs)]
+    import_ms = statistics.median(run[0] for run in runs)
+    rss_mb = statistics.median(run[1] for run in runs)
+    # top-level packages only, so one heavy dependency is not listed with all its submodules
+    packages = {}
+    for name, (_, cumulative_us) in runs[-1][2].items():
+        top = name.split(".")[0]
+        if name == top or top == "service":
+            packages[name] = max(packages.get(name, 0), cumulative_us)
+    slowest = sorted(packages.items(), key=lambda item: item[1], reverse=True)[:args.top]
+
+    results = {
+        "import_ms": round(import_ms, 1),
+        "rss_mb": round(rss_mb, 1),
+        "budget": {"import_ms": args.max_import_ms, "rss_mb": args.max_rss_mb},
+        "slowest_modules_ms": {name: round(cumulative_us / 1000, 1) for name, cumulative_us in slowest},
+    }
+    write_results(args.output, "startup", results)
+
+    print("{:<32} {:>10}".format("module", "cumul ms"))
+    for name, cumulative_us in slowest:
+        print("{:<32} {:>10.1f}".format(name, cumulative_us / 1000))
+    print("import service: {:.1f} ms (budget {:.0f}), RSS {:.1f} MB (budget {:.0f})".format(
+        import_ms, args.max_import_ms, rss_mb, args.max_rss_mb))
+    if import_ms > args.max_import_ms or rss_mb > args.max_rss_mb:
+        print("Startup budget exceeded")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
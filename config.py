@@ -18,5 +18,52 @@ if 'VCAP_SERVICES' in os.environ:
 SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+# Apply missing schema migrations at boot instead of with flask db-upgrade
+DB_AUTO_MIGRATE = os.getenv("DB_AUTO_MIGRATE", "False").lower() == "true"
+
+# Connection pool, see service/pool.py (SQLite only uses DB_POOL_PRE_PING)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "True").lower() == "true"
+# PostgreSQL statement_timeout in milliseconds, 0 disables it
+DB_STATEMENT_TIMEOUT = int(os.getenv("DB_STATEMENT_TIMEOUT", "0"))
+
+# Bulk create: rows per INSERT statement and the most Products accepted per request
+BULK_BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", "1000"))
+BULK_MAX_ITEMS = int(os.getenv("BULK_MAX_ITEMS", "10000"))
+
+# Times PUT /inventory/<product_id> rereads and reapplies an update that lost a race
+UPDATE_RETRIES = int(os.getenv("UPDATE_RETRIES", "3"))
+
+# Keyset pagination of GET /inventory
+PAGE_SIZE_DEFAULT = int(os.getenv("PAGE_SIZE_DEFAULT", "100"))
+PAGE_SIZE_MAX = int(os.getenv("PAGE_SIZE_MAX", "1000"))
+
+# Rows fetched per round trip when streaming Products
+STREAM_BATCH_SIZE = int(os.getenv("STREAM_BATCH_SIZE", "1000"))
+
+# Restock sweep: the id range each UPDATE (and transaction) covers
+RESTOCK_BATCH_SIZE = int(os.getenv("RESTOCK_BATCH_SIZE", "10000"))
+
+# Ledger mode: /inc, /dec, /update and adjustments append stock movements instead of
+# rewriting products.quantity, and flask compact-ledger folds them in, see service/ledger.py
+INVENTORY_LEDGER = os.getenv("INVENTORY_LEDGER", "False").lower() == "true"
+LEDGER_COMPACT_BATCH_SIZE = int(os.getenv("LEDGER_COMPACT_BATCH_SIZE", "10000"))
+
+# The most shards PUT /inventory/<product_id>/shards splits the stock of a Product across
+SHARDS_MAX = int(os.getenv("SHARDS_MAX", "64"))
+
+# Read cache of GET /inventory/<product_id>: lru, null or "package.module:Class"
+CACHE_TYPE = os.getenv("CACHE_TYPE", "lru")
+CACHE_MAX_SIZE = int(os.getenv("CACHE_MAX_SIZE", "10000"))
+CACHE_TTL = float(os.getenv("CACHE_TTL", "5"))
+
+# Prometheus metrics: with METRICS_DIR every worker writes its metrics there
+# within METRICS_FLUSH_INTERVAL seconds of a request and /metrics adds them up
+METRICS_DIR = os.getenv("METRICS_DIR")
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "1"))
+
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "s3cr3t-key-shhhh")
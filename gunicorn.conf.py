@@ -0,0 +1,122 @@
+"""
+Gunicorn configuration
+
+Sizes the server from the CPU count of the node, unless the GUNICORN_*
+environment variables say otherwise:
+
+  GUNICORN_WORKER_CLASS  sync (default), gthread or gevent
+  GUNICORN_WORKERS       sync: 2 * CPUs + 1, gthread and gevent: CPUs
+  GUNICORN_THREADS       threads per gthread worker (default 4)
+  GUNICORN_WORKER_CONNECTIONS  concurrent requests per gevent worker (default 1000)
+  GUNICORN_PRELOAD       import the app once in the master (default true, false for gevent)
+  GUNICORN_TIMEOUT       seconds before a silent worker is restarted (default 30)
+  DB_MAX_CONNECTIONS     database connections all workers may hold together
+                         (default 100, the max_connections of PostgreSQL)
+
+Unless DB_POOL_SIZE and DB_MAX_OVERFLOW are set, the pool of every worker
+is sized from its share of DB_MAX_CONNECTIONS; when_ready warns when the
+pools of all workers can open more connections than that.
+
+With more than one worker and no METRICS_DIR the workers write their metrics
+to a temporary directory, so /metrics reports the totals of the server.
+
+The app is imported, and the database initialized, before the workers fork
+when it is preloaded, so the master closes its connections in when_ready,
+and every worker opens its own in post_worker_init. Otherwise every worker
+opens them when it imports the app. /health/ready answers 503 until they are
+open. gevent workers patch psycopg2 in post_fork, before they connect.
+"""
+import glob
+import multiprocessing
+import os
+import tempfile
+
+cpus = multiprocessing.cpu_count()
+
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "sync")
+if worker_class not in ("sync", "gthread", "gevent"):
+    raise ValueError("GUNICORN_WORKER_CLASS must be sync, gthread or gevent, not " + worker_class)
+
+bind = "0.0.0.0:" + os.getenv("PORT", "8080")
+workers = int(os.getenv("GUNICORN_WORKERS", 2 * cpus + 1 if worker_class == "sync" else cpus))
+threads = int(os.getenv("GUNICORN_THREADS", "4")) if worker_class == "gthread" else 1
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "1000"))
+preload_app = os.getenv("GUNICORN_PRELOAD", str(worker_class != "gevent")).lower() == "true"
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "30"))
+keepalive = 5
+accesslog = "-"
+errorlog = "-"
+
+# every thread of a worker can hold one connection without waiting for the pool,
+# as long as the pools of all workers stay within DB_MAX_CONNECTIONS
+max_connections = int(os.getenv("DB_MAX_CONNECTIONS", "100"))
+connections_per_worker = max(1, max_connections // workers)
+os.environ.setdefault("DB_POOL_SIZE", str(min(max(threads, 5), connections_per_worker)))
+os.environ.setdefault("DB_MAX_OVERFLOW", str(min(10, connections_per_worker - int(os.environ["DB_POOL_SIZE"]))))
+
+# set before a preloaded app reads its configuration
+if workers > 1 and not os.getenv("METRICS_DIR"):
+    os.environ["METRICS_DIR"] = tempfile.mkdtemp(prefix="inventory-metrics-")
+
+
+def on_starting(server):
+    """Removes the metrics files of the workers of a previous run"""
+    metrics_dir = os.getenv("METRICS_DIR")
+    if metrics_dir:
+        os.makedirs(metrics_dir, exist_ok=True)
+        for path in glob.glob(os.path.join(metrics_dir, "metrics-*.json*")):
+            os.remove(path)
+        server.log.info("Cleared metrics directory %s", metrics_dir)
+
+
+def when_ready(server):
+    """Checks the connection budget and closes the connections a preloaded app opened in the master"""
+    pool_size, max_overflow = int(os.environ["DB_POOL_SIZE"]), max(0, int(os.environ["DB_MAX_OVERFLOW"]))
+    total = server.cfg.workers * (pool_size + max_overflow)
+    if total > max_connections and not os.getenv("DATABASE_URI", "").startswith("sqlite"):
+        server.log.warning(
+            "%d workers with DB_POOL_SIZE=%d and DB_MAX_OVERFLOW=%d can open %d database connections, "
+            "more than DB_MAX_CONNECTIONS=%d", server.cfg.workers, pool_size, max_overflow, total, max_connections)
+    if pool_size < threads:
+        server.log.warning("DB_POOL_SIZE=%d is below the %d threads of a worker", pool_size, threads)
+    if not server.cfg.preload_app:
+        return
+    from service import app  # pylint: disable=import-outside-toplevel
+    from service.models import db  # pylint: disable=import-outside-toplevel
+    with app.app_context():
+        db.engine.dispose()
+
+
+def post_fork(server, worker):
+    """Makes psycopg2 cooperative in gevent workers and drops the connections a preloaded app opened"""
+    if worker_class == "gevent":
+        try:  # psycopg2 waits on the database cooperatively only on connections opened after the patch
+            from psycogreen.gevent import patch_psycopg  # pylint: disable=import-outside-toplevel
+            patch_psycopg()
+        except ImportError:
+            worker.log.warning("psycogreen is not installed, database calls will block the gevent worker")
+    if not server.cfg.preload_app:
+        return
+    from service import app  # pylint: disable=import-outside-toplevel
+    from service.models import db  # pylint: disable=import-outside-toplevel
+    with app.app_context():
+        # close=False leaves the master's sockets alone, they are shared after fork
+        db.engine.dispose(close=False)
+
+
+def worker_exit(server, worker):  # pylint: disable=unused-argument
+    """Writes the metrics the worker observed since its last flush"""
+    from service.routes import request_metrics  # pylint: disable=import-outside-toplevel
+    request_metrics.flush(force=True)
+
+
+def post_worker_init(worker):
+    """Opens the connections of a worker forked from a preloaded app before it accepts requests"""
+    if not worker.cfg.preload_app:
+        return  # the worker opened them when it imported the app
+    from service import app  # pylint: disable=import-outside-toplevel
+    from service.models import db  # pylint: disable=import-outside-toplevel
+    from service.pool import warm_pool  # pylint: disable=import-outside-toplevel
+    with app.app_context():
+        opened = warm_pool(db.engine)
+    worker.log.info("Worker %s opened %d database connections", worker.pid, opened)
@@ -17,7 +17,7 @@ app.url_map.strict_slashes = False
 app.config.from_object("config")
 
 # Import the routes After the Flask app is created
-from service import routes, models, error_handlers
+from service import routes, models, error_handlers, commands
 
 
 # Set up logging for production
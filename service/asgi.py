@@ -0,0 +1,295 @@
+"""
+ASGI application
+
+Serves the hot inventory routes with native async handlers on an async
+SQLAlchemy engine, so one process keeps many requests in flight while they
+wait on the database:
+
+  GET /inventory/<product_id>
+  PUT /inventory/<product_id>/inc, /dec and /update
+
+Every other request is passed to the Flask app through asgiref's WsgiToAsgi,
+as are the requests for Products with sharded stock and, in ledger mode
+(INVENTORY_LEDGER), every request.
+The handlers answer exactly like their Resources in service/routes.py and
+share the read cache, the ETags and the request metrics with them.
+
+  uvicorn service.asgi:application
+
+Needs asgiref and an async driver: asyncpg for PostgreSQL, aiosqlite for SQLite.
+"""
+import asyncio
+import logging
+import re
+import time
+from contextvars import ContextVar
+from urllib.parse import parse_qs
+
+from asgiref.wsgi import WsgiToAsgi
+from sqlalchemy import literal, select, update
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from werkzeug.http import parse_etags
+
+from service.models import Product, Condition, DataValidationError, db
+from service.pool import engine_options
+from service.routes import (
+    app, product_cache, product_etag, etag_header, invalidate_product, request_metrics, product_args, retrieve_args,
+)
+from service.serializers import product_dict, dumps
+from . import status
+
+logger = logging.getLogger("flask.app")
+
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "postgres": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+# the seconds the current request awaited database statements, like g.db_seconds in Flask
+db_seconds = ContextVar("db_seconds", default=None)
+
+
+def async_database_url(uri):
+    """Returns the URL of a database for its async driver"""
+    url = make_url(uri)
+    return url.set(drivername=ASYNC_DRIVERS[url.get_backend_name()])
+
+
+def async_engine_options(config):
+    """Returns the options of the async engine, the DB_* settings of the sync one"""
+    options = engine_options(config)
+    options.pop("poolclass", None)  # async engines need their own adapted QueuePool
+    if "connect_args" in options:
+        # asyncpg takes server settings instead of libpq options
+        options["connect_args"] = {"server_settings": {"statement_timeout": str(config["DB_STATEMENT_TIMEOUT"])}}
+    return options
+
+
+######################################################################
+#  A S Y N C   P R O D U C T   Q U E R I E S
+######################################################################
+class AsyncProducts:
+    """The Product finders and quantity writes on an async engine"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.returning = engine.dialect.full_returning
+
+    def session(self):
+        """Returns a new AsyncSession whose objects stay loaded after commit"""
+        return AsyncSession(self.engine, expire_on_commit=False)
+
+    async def find_by_id(self, product_id, condition=None):
+        """Returns the Products with a product_id, optionally of one condition"""
+        query = select(Product).where(Product.product_id == product_id)
+        if condition:
+            query = query.where(Product.condition == Condition[condition])
+        async with self.session() as session:
+            return (await self._execute(session, query)).scalars().all()
+
+    async def increase(self, product_id, condition, value):
+        """Like Product.increase"""
+        return await self._adjust(product_id, condition, Product.quantity + value)
+
+    async def decrease(self, product_id, condition, value):
+        """Like Product.decrease"""
+        return await self._adjust(product_id, condition, Product.quantity - value, Product.quantity >= value)
+
+    async def set_quantity(self, product_id, condition, value):
+        """Like Product.set_quantity"""
+        return await self._adjust(product_id, condition, literal(value, db.Integer))
+
+    async def _adjust(self, product_id, condition, quantity, *guards):
+        """The single conditional UPDATE of Product._adjust"""
+        criteria = (Product.product_id == product_id, Product.condition == Condition[condition], Product.shards == 0)
+        criteria += guards
+        stmt = (
+            update(Product).where(*criteria)
+            .values(quantity=Product.restocked(quantity), version=Product.version + 1)
+        )
+        async with self.session() as session:
+            async with session.begin():
+                if self.returning:
+                    result = await self._execute(
+                        session,
+                        select(Product)
+                        .from_statement(stmt.returning(*Product.__table__.columns))
+                        .execution_options(populate_existing=True),
+                    )
+                    return result.scalars().first()
+                result = await self._execute(session, stmt.execution_options(synchronize_session=False))
+                if not result.rowcount:
+                    return None
+                result = await self._execute(session, select(Product).where(*criteria[:2]))
+                return result.scalars().first()
+
+    @staticmethod
+    async def _execute(session, statement):
+        """Executes a statement and adds the time it took to db_seconds"""
+        start = time.perf_counter()
+        try:
+            return await session.execute(statement)
+        finally:
+            spent = db_seconds.get()
+            if spent is not None:
+                spent[0] += time.perf_counter() - start
+
+
+######################################################################
+#  A S G I   A P P L I C A T I O N
+######################################################################
+class InventoryASGI:
+    """Routes the hot inventory requests to async handlers and the rest to Flask"""
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.wsgi = WsgiToAsgi(flask_app)
+        self.products = None
+        self.routes = [
+            ("GET", re.compile(r"^/inventory/(\d+)/?$"), self.get_product, "product_resource"),
+            ("PUT", re.compile(r"^/inventory/(\d+)/inc/?$"), self.increase_product, "increase_resource"),
+            ("PUT", re.compile(r"^/inventory/(\d+)/dec/?$"), self.decrease_product, "decrease_resource"),
+            ("PUT", re.compile(r"^/inventory/(\d+)/update/?$"), self.update_product, "update_resource"),
+        ]
+        if flask_app.config["INVENTORY_LEDGER"]:
+            # the ledger lives in the Flask routes, see service/ledger.py
+            self.routes = []
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+        if scope["type"] == "http":
+            for method, pattern, handler, endpoint in self.routes:
+                match = pattern.match(scope["path"])
+                if match and scope["method"] == method:
+                    if await self.handle(scope, send, handler, endpoint, int(match.group(1))):
+                        return
+                    break
+        await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        """Creates the async engine at startup and disposes of it at shutdown"""
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self.start()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if self.products is not None:
+                    await self.products.engine.dispose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def start(self):
+        """Creates the async engine, unless it exists"""
+        if self.products is None:
+            config = self.flask_app.config
+            engine = create_async_engine(
+                async_database_url(config["SQLALCHEMY_DATABASE_URI"]), **async_engine_options(config)
+            )
+            self.products = AsyncProducts(engine)
+            logger.info("Async engine created for %s", engine.url.get_backend_name())
+
+    async def handle(self, scope, send, handler, endpoint, product_id):
+        """Calls a handler and sends its (status, body, headers) response
+
+        Returns False, without sending anything, when the handler leaves the
+        request to Flask by returning None.
+        """
+        start = time.perf_counter()
+        spent = [0.0]
+        token = db_seconds.set(spent)
+        self.start()
+        # the first of repeated arguments, blank ones included, like request.args.get
+        query = parse_qs(scope["query_string"].decode(), keep_blank_values=True)
+        args = {name: values[0] for name, values in query.items()}
+        headers = {name.decode().lower(): value.decode() for name, value in scope["headers"]}
+        try:
+            response = await handler(product_id, args, headers)
+            if response is None:
+                return False
+            code, body, extra = response
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Unhandled error in %s", endpoint)
+            code, body, extra = error(status.HTTP_500_INTERNAL_SERVER_ERROR, "Internal Server Error")
+        finally:
+            db_seconds.reset(token)
+        response_headers = [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]
+        response_headers.extend((name.lower().encode(), value.encode()) for name, value in extra.items())
+        await send({"type": "http.response.start", "status": code, "headers": response_headers})
+        await send({"type": "http.response.body", "body": body})
+        request_metrics.observe(endpoint, scope["method"], code, time.perf_counter() - start, spent[0])
+        if request_metrics.flush_due():
+            # the snapshot is written to a file, off the event loop
+            await asyncio.get_running_loop().run_in_executor(None, request_metrics.flush)
+        return True
+
+    async def get_product(self, product_id, args, headers):
+        """Like ProductResource.get"""
+        try:
+            condition = retrieve_args.validate(args)["condition"]
+        except DataValidationError as invalid:
+            return error(status.HTTP_400_BAD_REQUEST, str(invalid))
+        condition = condition.name if condition else None
+        if_none_match = parse_etags(headers.get("if-none-match"))
+        cached = product_cache.get((product_id, condition))
+        if cached is not None:
+            body, etag = cached
+            if etag in if_none_match:
+                return status.HTTP_304_NOT_MODIFIED, b"", etag_header(etag)
+            return status.HTTP_200_OK, body.encode(), etag_header(etag)
+
+        products = await self.products.find_by_id(product_id, condition)
+        if not products:
+            return error(status.HTTP_404_NOT_FOUND, "Product with id '{}' was not found.".format(product_id))
+        if any(product.shards for product in products):
+            return None
+        etag = product_etag(Product.versions_of(products))
+        body = dumps(product_dict(products[0]) if condition else [product_dict(product) for product in products])
+        product_cache.set((product_id, condition), (body, etag))
+        if etag in if_none_match:
+            return status.HTTP_304_NOT_MODIFIED, b"", etag_header(etag)
+        return status.HTTP_200_OK, body.encode(), etag_header(etag)
+
+    async def increase_product(self, product_id, args, headers):
+        """Like IncreaseResource.put"""
+        return await self.adjust_product(self.products.increase, product_id, args)
+
+    async def decrease_product(self, product_id, args, headers):
+        """Like DecreaseResource.put"""
+        return await self.adjust_product(self.products.decrease, product_id, args)
+
+    async def update_product(self, product_id, args, headers):
+        """Like UpdateResource.put"""
+        return await self.adjust_product(self.products.set_quantity, product_id, args)
+
+    async def adjust_product(self, adjust, product_id, args):
+        """Validates the condition and value arguments and applies an adjustment"""
+        try:
+            args = product_args.validate(args)
+        except DataValidationError as invalid:
+            return error(status.HTTP_400_BAD_REQUEST, str(invalid))
+        condition = args["condition"].name
+        product = await adjust(product_id, condition, args["value"])
+        if not product:
+            found = await self.products.find_by_id(product_id, condition)
+            if found and found[0].shards:
+                return None
+            if adjust == self.products.decrease and found:
+                return error(status.HTTP_403_FORBIDDEN, "Inventory decreased to negative prohibited.")
+            return error(status.HTTP_404_NOT_FOUND,
+                         "Product {} with condition {} was not found".format(product_id, condition))
+        invalidate_product(product_id)
+        etag = product_etag(Product.versions_of([product]))
+        return status.HTTP_200_OK, dumps(product_dict(product)).encode(), etag_header(etag)
+
+
+def error(code, message):
+    """Returns the (status, body, headers) of an error like the Flask app sends"""
+    return code, dumps({"message": message}).encode(), {}
+
+
+application = InventoryASGI(app)
@@ -0,0 +1,148 @@
+"""
+Caches for Product reads
+
+The cache is chosen with the CACHE_TYPE setting:
+
+  lru  - an in-process LRU cache bounded by CACHE_MAX_SIZE entries whose
+         entries expire after CACHE_TTL seconds (the default)
+  null - no caching
+  any other value is imported as "package.module:Class" and constructed
+  with the max_size and ttl keyword arguments
+
+Every worker process has its own cache, so a write is only invalidated in
+the worker that handled it; CACHE_TTL bounds how long other workers can
+serve the previous value.
+"""
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from importlib import import_module
+
+
+class Cache(ABC):
+    """Interface of the Product caches"""
+
+    name = "cache"
+
+    @abstractmethod
+    def get(self, key):
+        """Returns the value cached for key, or None"""
+
+    @abstractmethod
+    def set(self, key, value):
+        """Caches value for key"""
+
+    @abstractmethod
+    def delete(self, *keys):
+        """Removes keys from the cache"""
+
+    @abstractmethod
+    def clear(self):
+        """Removes every entry from the cache"""
+
+    @abstractmethod
+    def stats(self):
+        """Returns the counters of the cache"""
+
+
+class NullCache(Cache):
+    """A cache that never holds anything"""
+
+    name = "null"
+
+    def __init__(self, **_options):
+        self.misses = 0
+
+    def get(self, key):
+        self.misses += 1
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def delete(self, *keys):
+        pass
+
+    def clear(self):
+        pass
+
+    def stats(self):
+        return {"type": self.name, "size": 0, "hits": 0, "misses": self.misses}
+
+
+class LRUCache(Cache):
+    """A thread-safe least recently used cache whose entries expire after ttl seconds"""
+
+    name = "lru"
+
+    def __init__(self, max_size=10000, ttl=5.0, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._clock = clock
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expires = item
+                if expires > self._clock():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, self._clock() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "type": self.name,
+                "size": len(self._data),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+CACHE_TYPES = {
+    "lru": LRUCache,
+    "null": NullCache,
+}
+
+
+def create_cache(config):
+    """Creates the cache named by CACHE_TYPE in config"""
+    cache_type = config.get("CACHE_TYPE", "lru")
+    if cache_type in CACHE_TYPES:
+        cache_class = CACHE_TYPES[cache_type]
+    else:
+        module_name, _, class_name = cache_type.partition(":")
+        cache_class = getattr(import_module(module_name), class_name)
+    return cache_class(max_size=config.get("CACHE_MAX_SIZE", 10000), ttl=config.get("CACHE_TTL", 5.0))
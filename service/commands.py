@@ -0,0 +1,226 @@
+"""
+Flask CLI commands
+
+  flask import-products products.csv   load Products from a CSV file
+  flask restock [--interval 60]         restock every NEW Product below its restock level
+  flask compact-ledger [--interval 60]  fold the pending stock movements into the quantities
+  flask db-upgrade                      apply the missing schema migrations
+  flask db-version                      show the schema version of the database
+"""
+import csv
+import io
+import sys
+import time
+
+import click
+from sqlalchemy import text
+
+from service.models import Product, Condition, DataValidationError, db
+from service.routes import restock_products
+from service import ledger, migrations
+from . import app
+
+# legacy column names, as used by products.csv
+COLUMN_ALIASES = {"id": "product_id", "name": "product_name", "status": "condition"}
+INTEGER_FIELDS = ("product_id", "quantity", "restock_level", "reorder_amount")
+COPY_COLUMNS = ("product_id", "product_name", "quantity", "condition", "restock_level", "reorder_amount")
+# the range of the integer columns on PostgreSQL, where COPY fails the whole chunk on a value outside it
+INTEGER_MIN, INTEGER_MAX = -2 ** 31, 2 ** 31 - 1
+
+
+######################################################################
+#  I M P O R T   P R O D U C T S
+######################################################################
+@app.cli.command("import-products")
+@click.argument("csv_file", type=click.File("r", encoding="utf-8"))
+@click.option("--chunk-size", default=10000, show_default=True, help="Rows validated and loaded per transaction")
+@click.option("--max-rejects-shown", default=20, show_default=True, help="Rejected lines printed to stderr")
+def import_products(csv_file, chunk_size, max_rejects_shown):
+    """Streams Products from a CSV file into the database
+
+    The header names the columns: product_id, product_name, quantity,
+    condition (name or number), restock_level and reorder_amount. The legacy
+    id and status columns of products.csv are accepted as well. Rows that
+    already exist, or repeat an earlier row, are skipped.
+    """
+    start = time.perf_counter()
+    totals = {"read": 0, "created": 0, "existing": 0, "rejected": 0}
+    for products, rejects in read_products(csv_file, chunk_size):
+        created = load_products(products)
+        totals["read"] += len(products) + len(rejects)
+        totals["created"] += created
+        totals["existing"] += len(products) - created
+        for line, reason in rejects:
+            if totals["rejected"] < max_rejects_shown:
+                click.echo("line {}: {}".format(line, reason), err=True)
+            totals["rejected"] += 1
+        elapsed = time.perf_counter() - start
+        click.echo("{read} rows read, {created} created, {existing} existing, {rejected} rejected".format(**totals)
+                   + " ({:.0f} rows/sec)".format(totals["read"] / elapsed if elapsed else 0), err=True)
+    elapsed = time.perf_counter() - start
+    click.echo("Imported {created} of {read} rows in {elapsed:.2f}s ({rate:.0f} rows/sec): "
+               "{existing} already existed, {rejected} rejected".format(
+                   elapsed=elapsed, rate=totals["read"] / elapsed if elapsed else 0, **totals))
+    if totals["rejected"]:
+        sys.exit(1)
+
+
+def read_products(csv_file, chunk_size):
+    """Yields (products, rejects) for every chunk_size lines of a CSV file
+
+    rejects holds a (line number, reason) pair for every line that failed validation
+    """
+    reader = csv.DictReader(csv_file)
+    products, rejects = [], []
+    for row in reader:
+        try:
+            products.append(parse_row(row))
+        except DataValidationError as error:
+            rejects.append((reader.line_num, str(error)))
+        if len(products) + len(rejects) >= chunk_size:
+            yield products, rejects
+            products, rejects = [], []
+    if products or rejects:
+        yield products, rejects
+
+
+def parse_row(row):
+    """Validates a CSV row with the rules of Product.deserialize and the limits of the products columns"""
+    data = {}
+    for column, value in row.items():
+        if column is None or value is None or value.strip() == "":
+            continue
+        data[COLUMN_ALIASES.get(column.strip(), column.strip())] = value.strip()
+    for field in INTEGER_FIELDS:
+        if field in data:
+            try:
+                data[field] = int(data[field])
+            except ValueError:
+                raise DataValidationError("Invalid Product: {} is not an integer: {}".format(field, data[field]))
+            if not INTEGER_MIN <= data[field] <= INTEGER_MAX:
+                raise DataValidationError("Invalid Product: {} is out of range: {}".format(field, data[field]))
+    max_length = Product.__table__.c.product_name.type.length
+    if len(data.get("product_name", "")) > max_length:
+        raise DataValidationError("Invalid Product: product_name is longer than {} characters".format(max_length))
+    if data.get("condition", "").isdigit():
+        try:
+            data["condition"] = Condition(int(data["condition"])).name
+        except ValueError:
+            raise DataValidationError("Invalid Product: the condition is invalid: " + data["condition"])
+    return Product().deserialize(data)
+
+
+def load_products(products):
+    """Inserts Products in one transaction and returns how many were created"""
+    if not products:
+        return 0
+    dialect = db.engine.dialect.name
+    if dialect == "postgresql":
+        return copy_products(products)
+    if dialect == "sqlite":
+        return insert_products(products)
+    return sum(product is not None for product in Product.bulk_create(products))
+
+
+def insert_products(products):
+    """Loads Products with one executemany INSERT OR IGNORE (SQLite)"""
+    try:
+        result = db.session.execute(
+            Product.__table__.insert().prefix_with("OR IGNORE"),
+            [product.row() for product in products],
+        )
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return result.rowcount
+
+
+def copy_products(products):
+    """Loads Products with COPY into a temporary table and one INSERT ... ON CONFLICT DO NOTHING"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for product in products:
+        row = product.row()
+        row["condition"] = product.condition.name
+        writer.writerow([row[column] for column in COPY_COLUMNS])
+    buffer.seek(0)
+
+    columns = ", ".join(COPY_COLUMNS)
+    enum_type = Product.__table__.c.condition.type.name
+    try:
+        connection = db.session.connection()
+        connection.execute(text(
+            "CREATE TEMP TABLE products_import (product_id integer, product_name varchar(128), "
+            "quantity integer, condition text, restock_level integer, reorder_amount integer) ON COMMIT DROP"
+        ))
+        cursor = connection.connection.cursor()
+        cursor.copy_expert("COPY products_import ({}) FROM STDIN WITH (FORMAT csv)".format(columns), buffer)
+        result = connection.execute(text(
+            "INSERT INTO products ({columns}) "
+            "SELECT product_id, product_name, quantity, CAST(condition AS {enum_type}), restock_level, reorder_amount "
+            "FROM products_import ON CONFLICT ON CONSTRAINT unique_product_condition DO NOTHING".format(
+                columns=columns, enum_type=enum_type)
+        ))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return result.rowcount
+
+
+######################################################################
+#  R E S T O C K
+######################################################################
+@app.cli.command("restock")
+@click.option("--interval", type=float, default=None, help="Repeat the sweep every INTERVAL seconds")
+@click.option("--verbose", is_flag=True, help="List every restocked Product")
+def restock(interval, verbose):
+    """Restocks every NEW Product whose quantity is below its restock level"""
+    while True:
+        report = restock_products()
+        click.echo("Restocked {restocked} Products (+{reordered_quantity} items) in {seconds}s".format(**report))
+        for product in report["products"] if verbose else []:
+            click.echo("  id {id}: product {product_id} reordered {reorder_amount}, now {quantity}".format(**product))
+        if interval is None:
+            break
+        time.sleep(interval)
+
+
+######################################################################
+#  L E D G E R   C O M P A C T I O N
+######################################################################
+@app.cli.command("compact-ledger")
+@click.option("--interval", type=float, default=None, help="Repeat the compaction every INTERVAL seconds")
+def compact_ledger(interval):
+    """Folds the pending stock movements of ledger mode into the quantity of their Products"""
+    while True:
+        start = time.perf_counter()
+        compacted = ledger.compact(app.config["LEDGER_COMPACT_BATCH_SIZE"])
+        click.echo("Compacted {} stock movements in {:.3f}s".format(compacted, time.perf_counter() - start))
+        if interval is None:
+            break
+        time.sleep(interval)
+
+
+######################################################################
+#  S C H E M A   M I G R A T I O N S
+######################################################################
+@app.cli.command("db-upgrade")
+def db_upgrade():
+    """Applies the schema migrations the database is missing"""
+    applied = migrations.upgrade(db.engine)
+    current, latest = migrations.schema_status(db.engine)
+    if applied:
+        click.echo("Applied migrations {}".format(", ".join(str(version) for version in applied)))
+    click.echo("Database schema is at version {} of {}".format(current, latest))
+
+
+@app.cli.command("db-version")
+def db_version():
+    """Shows the schema version of the database and the migrations it is missing"""
+    current, latest = migrations.schema_status(db.engine)
+    click.echo("Database schema is at version {} of {}".format(current, latest))
+    for version, description, _, _ in migrations.MIGRATIONS:
+        if version > current:
+            click.echo("  missing {}: {}".format(version, description))
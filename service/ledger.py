@@ -0,0 +1,343 @@
+"""
+Stock movement ledger
+
+In ledger mode (INVENTORY_LEDGER) the quantity routes do not rewrite
+products.quantity. Each change appends a row to stock_movements, so
+concurrent writers of a hot Product do not queue for the lock of its row,
+and the movements are the history of its stock. products.quantity becomes
+the balance of the movements that were compacted: the quantity of a Product
+is that balance plus its pending (not yet compacted) movements, read in the
+same statement as the row, from the partial index of the pending movements.
+
+  flask compact-ledger [--interval 60]
+
+folds the pending movements into the balances, which keeps the tails short.
+Compaction does not change the quantity of a Product, so it leaves its
+version and ETag alone.
+
+An increase is a plain insert. A decrease, a change to an absolute
+quantity, or an increase that can restock, must not race the writers of the
+balance it is computed from: its insert checks and computes the balance in a
+single statement, which SQLite runs alone, and on PostgreSQL it first takes
+a transaction-level advisory lock on the product_id.
+"""
+import logging
+from collections import defaultdict
+
+from sqlalchemy import bindparam, func, insert, literal, select, update
+
+from service.models import Condition, Product, StockMovement, db
+
+logger = logging.getLogger("flask.app")
+
+LEDGER_LOCK_ID = 720_002  # first key of the pg_advisory_xact_lock of a product_id
+RESTOCK_LOCKS = 500  # advisory locks per restock transaction, within max_locks_per_transaction
+
+
+######################################################################
+#  B A L A N C E S
+######################################################################
+def pending_quantity():
+    """Returns the SQL expression of the sum of the pending movements of a products row"""
+    return (
+        select(func.coalesce(func.sum(StockMovement.delta), 0))
+        .where(StockMovement.product_row_id == Product.id, ~StockMovement.compacted)
+        .scalar_subquery()
+    )
+
+
+def newest_movement():
+    """Returns the SQL expression of the id of the newest movement of a products row"""
+    return (
+        select(func.coalesce(func.max(StockMovement.id), 0))
+        .where(StockMovement.product_row_id == Product.id)
+        .scalar_subquery()
+    )
+
+
+def balance():
+    """Returns the SQL expression of the current quantity of a products row"""
+    return Product.quantity + pending_quantity()
+
+
+def balances(query):
+    """Yields the Products of a query with their current quantity
+
+    The Products are detached, so their quantity is never written back, and
+    carry the id of their newest movement for their ETag.
+    """
+    for product, pending, newest in query.add_columns(pending_quantity(), newest_movement()):
+        db.session.expunge(product)
+        product.quantity += pending
+        product.newest_movement = newest
+        yield product
+
+
+def newest_movement_of(product):
+    """Returns the id of the newest movement of a Product that was loaded without its balance"""
+    return db.session.query(func.coalesce(func.max(StockMovement.id), 0)).filter(
+        StockMovement.product_row_id == product.id).scalar()
+
+
+def reload(products):
+    """Reads Products again with their current quantity, e.g. after another query loaded them"""
+    ids = [product.id for product in products]
+    return list(balances(Product.query.filter(Product.id.in_(ids)).order_by(Product.id)))
+
+
+######################################################################
+#  M O V E M E N T S
+######################################################################
+def increase(product_id, condition, value):
+    """Appends a movement that increases the quantity of a Product by value and restocks it"""
+    logger.info("Appending increase of %s with condition %s by %d", product_id, condition, value)
+    return _append(product_id, condition, "inc", balance() + value, restock_lock=True)
+
+
+def decrease(product_id, condition, value):
+    """
+    Appends a movement that decreases the quantity of a Product by value and restocks it
+
+    Nothing is appended (and None returned) when the quantity would go negative
+    """
+    logger.info("Appending decrease of %s with condition %s by %d", product_id, condition, value)
+    return _append(product_id, condition, "dec", balance() - value, balance() >= value, lock=True)
+
+
+def set_quantity(product_id, condition, value):
+    """Appends a movement that sets the quantity of a Product to value and restocks it"""
+    logger.info("Appending update of %s with condition %s to %d", product_id, condition, value)
+    return _append(product_id, condition, "update", literal(value, db.Integer), lock=True)
+
+
+def move_to(product, quantity):
+    """
+    Appends the movement that takes a Product to quantity, without committing
+
+    Lets PUT /inventory/<product_id> save the other fields of the Product
+    and its quantity in one transaction. The restock rule is not applied:
+    the caller has applied it already.
+    """
+    try:
+        _lock(product.product_id)
+        db.session.execute(_movement((Product.id == product.id,), literal(quantity, db.Integer), "put"))
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def adjust_many(adjustments, atomic=True):
+    """
+    Appends the movements of many quantity deltas in one transaction
+
+    Has the contract of Product.adjust_many: a delta never takes a quantity
+    below zero, the restock rule is applied and the updated Products and the
+    reasons of the failures are returned keyed by (product_id, Condition).
+    """
+    deltas = Product.adjustment_deltas(adjustments)
+    logger.info("Appending adjustments of %d Products (atomic=%s)", len(deltas), atomic)
+    if not deltas:
+        return {}, {}
+    try:
+        # in product_id order, so two requests never wait for each other's locks
+        for product_id in sorted({product_id for (product_id, condition), delta in deltas.items()
+                                  if delta < 0 or condition == Condition.NEW}):
+            _lock(product_id)
+        applied = set()
+        for (product_id, condition), delta in deltas.items():
+            quantity = balance() + delta
+            criteria = (Product.product_id == product_id, Product.condition == condition, quantity >= 0)
+            if db.session.execute(_movement(criteria, Product.restocked(quantity), "adjust")).rowcount:
+                applied.add((product_id, condition))
+        failed = Product.failed_adjustments(key for key in deltas if key not in applied)
+        if failed and atomic:
+            db.session.rollback()
+            return {}, failed
+        updated = {}
+        if applied:
+            query = Product.query.filter(Product.product_id.in_({product_id for product_id, _ in applied}))
+            for product in balances(query):
+                if (product.product_id, product.condition) in applied:
+                    updated[(product.product_id, product.condition)] = product
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return updated, failed
+
+
+def _append(product_id, condition, reason, quantity, *guards, lock=False, restock_lock=False):
+    """
+    Appends the movement that takes a Product to quantity, restocked
+
+    Args:
+        quantity: the SQL expression of the new quantity before restocking
+        guards: extra SQL criteria the row must match
+        lock: take the advisory lock of the product_id first
+        restock_lock: take it only when the Product can be restocked
+
+    Returns:
+        the Product with its new quantity (detached), or None when no row matched
+    """
+    if not isinstance(condition, Condition):
+        condition = Condition[condition]
+    criteria = (Product.product_id == product_id, Product.condition == condition)
+    try:
+        if lock:
+            _lock(product_id)
+        elif restock_lock and condition == Condition.NEW:
+            _lock(product_id, condition)
+        product = None
+        stmt = _movement(criteria + guards, Product.restocked(quantity), reason)
+        if db.session.execute(stmt).rowcount:
+            product = next(balances(Product.query.filter(*criteria)), None)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return product
+
+
+def _movement(criteria, quantity, reason):
+    """Returns the INSERT of the movements that take the products rows matching criteria to quantity
+
+    Sharded Products never match: their stock is in their shards, see service/shards.py
+    """
+    return insert(StockMovement).from_select(
+        ["product_row_id", "delta", "reason"],
+        select(Product.id, quantity - balance(), literal(reason)).where(*criteria, Product.shards == 0),
+    )
+
+
+def _lock(product_id, condition=None):
+    """Waits for the other balance writers of a product_id until the end of the transaction (PostgreSQL)
+
+    With a condition the lock is only taken when the Product of that
+    condition has a restock rule.
+    """
+    if db.engine.dialect.name != "postgresql":
+        return
+    stmt = select(func.pg_advisory_xact_lock(LEDGER_LOCK_ID, product_id))
+    if condition is not None:
+        stmt = stmt.where(Product.product_id == product_id, Product.condition == condition,
+                          Product.restock_level > 0, Product.reorder_amount > 0)
+    db.session.execute(stmt)
+
+
+def discard(row_ids):
+    """Removes the movements of deleted products rows where no foreign key cascades (SQLite)"""
+    if db.engine.dialect.name == "postgresql" or not row_ids:
+        return
+    try:
+        StockMovement.query.filter(StockMovement.product_row_id.in_(row_ids)).delete(synchronize_session=False)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+######################################################################
+#  R E S T O C K I N G
+######################################################################
+def restock_all(batch_size=10000):
+    """
+    Appends a restock movement for every NEW Product whose balance is below its restock level
+
+    Has the contract of Product.restock_all. The balances are checked again
+    while their writers wait on the advisory locks, RESTOCK_LOCKS Products
+    per transaction, so a movement appended during the sweep is never missed.
+
+    Returns:
+        a list with the id, product_id, new quantity and reorder_amount of
+        every restocked Product
+    """
+    criteria = (
+        Product.condition == Condition.NEW, balance() < Product.restock_level, Product.reorder_amount > 0,
+        Product.shards == 0,
+    )
+    low, high = db.session.query(func.min(Product.id), func.max(Product.id)).filter(*criteria).one()
+    db.session.commit()
+    logger.info("Restocking the balances of Products with ids %s to %s in batches of %d", low, high, batch_size)
+    restocked = []
+    if low is None:
+        return restocked
+    for start in range(low, high + 1, batch_size):
+        batch = criteria + (Product.id >= start, Product.id < start + batch_size)
+        candidates = db.session.query(Product.id, Product.product_id).filter(*batch).order_by(Product.product_id).all()
+        db.session.commit()
+        for offset in range(0, len(candidates), RESTOCK_LOCKS):
+            chunk = candidates[offset:offset + RESTOCK_LOCKS]
+            try:
+                for product_id in sorted({row.product_id for row in chunk}):
+                    _lock(product_id)
+                rows = (
+                    db.session.query(Product.id, Product.product_id, balance().label("quantity"), Product.reorder_amount)
+                    .filter(Product.id.in_([row.id for row in chunk]), *criteria)
+                    .all()
+                )
+                if rows:
+                    ids = Product.id.in_([row.id for row in rows])
+                    db.session.execute(_movement((ids,) + criteria, balance() + Product.reorder_amount, "restock"))
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+            restocked.extend(
+                {"id": row.id, "product_id": row.product_id, "quantity": row.quantity + row.reorder_amount,
+                 "reorder_amount": row.reorder_amount}
+                for row in sorted(rows)
+            )
+    logger.info("Restocked %d Products", len(restocked))
+    return restocked
+
+
+######################################################################
+#  C O M P A C T I O N
+######################################################################
+def compact(batch_size=10000):
+    """
+    Folds the pending movements into the quantity of their Products
+
+    Every batch of movements is added to products.quantity and marked
+    compacted in one short transaction. The movements are locked with SKIP
+    LOCKED on PostgreSQL, so two compactions never fold the same movement,
+    and a movement that commits during a compaction is folded by the next.
+
+    Returns:
+        the number of movements that were compacted
+    """
+    products = Product.__table__
+    fold = (
+        products.update()
+        .where(products.c.id == bindparam("row_id"))
+        .values(quantity=products.c.quantity + bindparam("total"))
+    )
+    compacted = 0
+    while True:
+        try:
+            rows = db.session.execute(
+                select(StockMovement.id, StockMovement.product_row_id, StockMovement.delta)
+                .where(~StockMovement.compacted)
+                .limit(batch_size)
+                .with_for_update(skip_locked=True)
+            ).all()
+            if rows:
+                totals = defaultdict(int)
+                for row in rows:
+                    totals[row.product_row_id] += row.delta
+                db.session.execute(fold, [{"row_id": row_id, "total": total} for row_id, total in totals.items()])
+                db.session.execute(
+                    update(StockMovement)
+                    .where(StockMovement.id.in_([row.id for row in rows]))
+                    .values(compacted=True)
+                    .execution_options(synchronize_session=False)
+                )
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        compacted += len(rows)
+        if len(rows) < batch_size:
+            break
+    logger.info("Compacted %d stock movements", compacted)
+    return compacted
@@ -0,0 +1,247 @@
+"""
+Metrics
+
+Thread-safe histograms with cumulative buckets and the per-request metrics of
+the service, rendered in the Prometheus text format by GET /metrics.
+"""
+import json
+import os
+import threading
+import time
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# bucket upper bounds in seconds, suited to request and query latencies
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """Counts observations in buckets and keeps their sum"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        """Records one observation"""
+        index = len(self.buckets)
+        for position, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = position
+                break
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def snapshot(self):
+        """Returns the cumulative bucket counts, sum and count of the observations"""
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        cumulative = 0
+        buckets = []
+        for bound, count in zip(self.buckets + ("+Inf",), counts):
+            cumulative += count
+            buckets.append([bound, cumulative])
+        return {"buckets": buckets, "sum": total, "count": cumulative}
+
+
+def merge_histograms(first, second):
+    """Adds two Histogram snapshots taken with the same buckets"""
+    buckets = [[bound, count + other] for (bound, count), (_, other) in zip(first["buckets"], second["buckets"])]
+    return {"buckets": buckets, "sum": first["sum"] + second["sum"], "count": first["count"] + second["count"]}
+
+
+class RequestMetrics:
+    """Request counts, latencies and database time per endpoint and method
+
+    With a directory every worker process writes its snapshot there (at most
+    once per flush_interval seconds) and collect() adds up the snapshots of
+    all workers, so any worker can serve the totals of the whole server. A
+    daemon thread of every worker writes the observations the requests left
+    unwritten within flush_interval, also when the worker turns idle.
+    """
+
+    def __init__(self, directory=None, flush_interval=1.0, worker_id=None):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.worker_id = worker_id
+        self._requests = {}
+        self._latency = {}
+        self._db_time = {}
+        self._last_flush = 0.0
+        self._dirty = False
+        self._flusher_pid = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def observe(self, endpoint, method, status, seconds, db_seconds):
+        """Records one handled request"""
+        key = (endpoint, method)
+        with self._lock:
+            self._requests[key + (str(status),)] = self._requests.get(key + (str(status),), 0) + 1
+            if key not in self._latency:
+                self._latency[key] = Histogram()
+                self._db_time[key] = Histogram()
+        self._latency[key].observe(seconds)
+        self._db_time[key].observe(db_seconds)
+        self._dirty = True
+        if self.directory and self._flusher_pid != os.getpid():
+            self._start_flusher()
+
+    def _start_flusher(self):
+        # threads do not survive a fork, so every worker process starts its own
+        with self._flush_lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+        threading.Thread(target=self._flush_dirty, name="metrics-flusher", daemon=True).start()
+
+    def _flush_dirty(self):
+        while True:
+            time.sleep(self.flush_interval)
+            if not self._dirty:
+                continue
+            try:
+                self.flush(force=True)
+            except OSError:
+                continue  # the directory is gone or full, try again next interval
+
+    def snapshot(self):
+        """Returns the metrics of this process as JSON-compatible data"""
+        with self._lock:
+            requests = [list(key) + [count] for key, count in self._requests.items()]
+            histograms = [(key, self._latency[key], self._db_time[key]) for key in self._latency]
+        return {
+            "requests": requests,
+            "latency": [list(key) + [latency.snapshot()] for key, latency, _ in histograms],
+            "db_time": [list(key) + [db_time.snapshot()] for key, _, db_time in histograms],
+        }
+
+    def _path(self):
+        worker_id = self.worker_id if self.worker_id is not None else os.getpid()
+        return os.path.join(self.directory, "metrics-{}.json".format(worker_id))
+
+    def flush_due(self):
+        """Returns whether flush() would write the snapshot now"""
+        return bool(self.directory) and time.monotonic() - self._last_flush >= self.flush_interval
+
+    def flush(self, force=False):
+        """Writes the snapshot of this process to the metrics directory"""
+        if not self.directory:
+            return
+        with self._flush_lock:
+            now = time.monotonic()
+            if not force and now - self._last_flush < self.flush_interval:
+                return
+            self._last_flush = now
+            self._dirty = False
+            path = self._path()
+            with open(path + ".tmp", "w") as output:
+                json.dump(self.snapshot(), output)
+            os.replace(path + ".tmp", path)
+
+    def collect(self):
+        """Returns the metrics of every worker added up"""
+        snapshots = [self.snapshot()]
+        if self.directory:
+            own = os.path.basename(self._path())
+            for name in os.listdir(self.directory):
+                if name.startswith("metrics-") and name.endswith(".json") and name != own:
+                    try:
+                        with open(os.path.join(self.directory, name)) as source:
+                            snapshots.append(json.load(source))
+                    except (OSError, ValueError):
+                        continue  # being replaced by its worker right now
+        requests, latency, db_time = {}, {}, {}
+        for snapshot in snapshots:
+            for *key, count in snapshot["requests"]:
+                requests[tuple(key)] = requests.get(tuple(key), 0) + count
+            for merged, name in ((latency, "latency"), (db_time, "db_time")):
+                for endpoint, method, histogram in snapshot[name]:
+                    key = (endpoint, method)
+                    merged[key] = merge_histograms(merged[key], histogram) if key in merged else histogram
+        return requests, latency, db_time
+
+    def render(self):
+        """Returns the metrics of every worker in the Prometheus text format"""
+        requests, latency, db_time = self.collect()
+        lines = [
+            "# HELP inventory_http_requests_total Requests handled, by endpoint, method and status.",
+            "# TYPE inventory_http_requests_total counter",
+        ]
+        for (endpoint, method, status), count in sorted(requests.items()):
+            labels = _labels(endpoint=endpoint, method=method, status=status)
+            lines.append("inventory_http_requests_total{} {}".format(labels, count))
+        for name, help_text, histograms in (
+            ("inventory_http_request_duration_seconds", "Time to build the response.", latency),
+            ("inventory_db_duration_seconds", "Time spent in database statements per request.", db_time),
+        ):
+            lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} histogram".format(name))
+            for (endpoint, method), histogram in sorted(histograms.items()):
+                for bound, count in histogram["buckets"]:
+                    labels = _labels(endpoint=endpoint, method=method, le=_format_bound(bound))
+                    lines.append("{}_bucket{} {}".format(name, labels, count))
+                labels = _labels(endpoint=endpoint, method=method)
+                lines.append("{}_sum{} {}".format(name, labels, repr(float(histogram["sum"]))))
+                lines.append("{}_count{} {}".format(name, labels, histogram["count"]))
+        return "\n".join(lines) + "\n"
+
+    def init_app(self, app):
+        """Records every request of a Flask app and the database time it used"""
+        app.before_request(_start_request)
+
+        @app.after_request
+        def record_request(response):  # pylint: disable=unused-variable
+            start = g.pop("metrics_start", None)
+            if start is not None:
+                endpoint = request.endpoint or "unmatched"
+                self.observe(endpoint, request.method, response.status_code,
+                             time.perf_counter() - start, g.pop("db_seconds", 0.0))
+                self.flush()
+            return response
+
+
+def _start_request():
+    g.metrics_start = time.perf_counter()
+    g.db_seconds = 0.0
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _start_statement(conn, cursor, statement, parameters, context, executemany):  # pylint: disable=unused-argument
+    conn.info.setdefault("metrics_statement_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _end_statement(conn, cursor, statement, parameters, context, executemany):  # pylint: disable=unused-argument
+    _add_db_time(conn)
+
+
+@event.listens_for(Engine, "handle_error")
+def _failed_statement(context):
+    if context.connection is not None:
+        _add_db_time(context.connection)
+
+
+def _add_db_time(conn):
+    starts = conn.info.get("metrics_statement_start")
+    if not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    if has_request_context() and "db_seconds" in g:
+        g.db_seconds += elapsed
+
+
+def _format_bound(bound):
+    return bound if isinstance(bound, str) else repr(float(bound))
+
+
+def _labels(**labels):
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join('{}="{}"'.format(name, escape(value)) for name, value in labels.items()) + "}"
@@ -0,0 +1,216 @@
+"""
+Schema migrations
+
+Every migration brings the schema from the previous version to its own and
+is written so it also succeeds when its changes are already in place, as in
+databases that were created by db.create_all() before migrations existed.
+Migrations declare the tables, columns and indexes they create themselves,
+as they were at their version, so later changes to the models never change
+what an old migration does.
+The schema_version table records the migrations that were applied; the app
+only compares it with the latest version at boot, and
+
+  flask db-upgrade
+
+applies the missing migrations once. On PostgreSQL an advisory lock keeps
+two upgrades from running at the same time, and indexes are built with
+CREATE INDEX CONCURRENTLY so writes to products continue meanwhile.
+"""
+import logging
+
+from sqlalchemy import (
+    Boolean, Column, DateTime, Enum, ForeignKey, Index, Integer, MetaData, String, Table, UniqueConstraint, bindparam,
+    false, func, inspect, text,
+)
+
+from service.models import Condition
+
+logger = logging.getLogger("flask.app")
+
+metadata = MetaData()
+
+schema_version = Table(
+    "schema_version",
+    metadata,
+    Column("version", Integer, primary_key=True, autoincrement=False),
+    Column("description", String(200), nullable=False),
+    Column("applied_at", DateTime, nullable=False, server_default=func.now()),
+)
+
+MIGRATION_LOCK_ID = 720_001  # pg_advisory_lock key of flask db-upgrade
+
+# (version, description, function, transactional), in version order
+MIGRATIONS = []
+
+
+def migration(version, description, transactional=True):
+    """Registers a function(connection) as the migration to version
+
+    A migration that is not transactional runs in autocommit mode, as
+    PostgreSQL requires for CREATE INDEX CONCURRENTLY.
+    """
+    def register(function):
+        MIGRATIONS.append((version, description, function, transactional))
+        MIGRATIONS.sort(key=lambda item: item[0])
+        return function
+    return register
+
+
+######################################################################
+#  M I G R A T I O N S
+######################################################################
+@migration(1, "create the products table")
+def create_products(connection):
+    """The products table as the first release created it"""
+    baseline = MetaData()
+    products = Table(
+        "products",
+        baseline,
+        Column("id", Integer, primary_key=True),
+        Column("product_id", Integer),
+        Column("product_name", String(128), nullable=False),
+        Column("quantity", Integer),
+        Column("condition", Enum(Condition), nullable=False, server_default=Condition.UNKNOWN.name),
+        Column("restock_level", Integer),
+        Column("reorder_amount", Integer),
+        UniqueConstraint("product_id", "condition", name="unique_product_condition"),
+    )
+    products.create(connection, checkfirst=True)
+
+
+# the indexes of migration 2 and their columns
+PRODUCT_INDEXES = (
+    ("ix_products_name_condition", ("product_name", "condition")),
+    ("ix_products_condition_id", ("condition", "id")),
+)
+
+
+@migration(2, "index products by name and by condition", transactional=False)
+def create_product_indexes(connection):
+    """The indexes of the Product finders"""
+    existing = {index["name"] for index in inspect(connection).get_indexes("products")}
+    postgresql = connection.dialect.name == "postgresql"
+    if postgresql:
+        # a failed CREATE INDEX CONCURRENTLY leaves an index that is never used, build it again
+        invalid = {name for name, in connection.execute(text(
+            "SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+            "WHERE NOT i.indisvalid AND c.relname IN :names"
+        ).bindparams(bindparam("names", expanding=True)), {"names": [name for name, _ in PRODUCT_INDEXES]})}
+        for name in invalid:
+            logger.warning("Dropping the invalid index %s", name)
+            connection.execute(text("DROP INDEX CONCURRENTLY IF EXISTS {}".format(name)))
+        existing -= invalid
+    for name, columns in PRODUCT_INDEXES:
+        if name in existing:
+            continue
+        if postgresql:
+            connection.execute(text("CREATE INDEX CONCURRENTLY {} ON products ({})".format(name, ", ".join(columns))))
+        else:
+            connection.execute(text("CREATE INDEX {} ON products ({})".format(name, ", ".join(columns))))
+
+
+@migration(3, "add the version column of products")
+def add_product_version(connection):
+    """The version column behind the ETags"""
+    columns = {column["name"] for column in inspect(connection).get_columns("products")}
+    if "version" not in columns:
+        connection.execute(text("ALTER TABLE products ADD COLUMN version INTEGER NOT NULL DEFAULT 1"))
+
+
+@migration(4, "create the stock_movements table")
+def create_stock_movements(connection):
+    """The append-only ledger of ledger mode, with its indexes"""
+    frozen = MetaData()
+    Table("products", frozen, Column("id", Integer, primary_key=True))
+    movements = Table(
+        "stock_movements",
+        frozen,
+        Column("id", Integer, primary_key=True),
+        Column("product_row_id", Integer, ForeignKey("products.id", ondelete="CASCADE"), nullable=False),
+        Column("delta", Integer, nullable=False),
+        Column("reason", String(16), nullable=False),
+        Column("compacted", Boolean, nullable=False, default=False, server_default=false()),
+        Column("created_at", DateTime, nullable=False, server_default=func.now()),
+        Index("ix_stock_movements_product", "product_row_id", "id"),
+        Index(
+            "ix_stock_movements_pending", "product_row_id",
+            postgresql_where=text("NOT compacted"), sqlite_where=text("compacted = 0"),
+        ),
+    )
+    movements.create(connection, checkfirst=True)
+
+
+@migration(5, "add the sharded stock of products")
+def create_product_shards(connection):
+    """The shards column of products and the product_shards table"""
+    columns = {column["name"] for column in inspect(connection).get_columns("products")}
+    if "shards" not in columns:
+        connection.execute(text("ALTER TABLE products ADD COLUMN shards INTEGER NOT NULL DEFAULT 0"))
+    frozen = MetaData()
+    Table("products", frozen, Column("id", Integer, primary_key=True))
+    product_shards = Table(
+        "product_shards",
+        frozen,
+        Column("product_row_id", Integer, ForeignKey("products.id", ondelete="CASCADE"), primary_key=True,
+               autoincrement=False),
+        Column("shard", Integer, primary_key=True, autoincrement=False),
+        Column("quantity", Integer, nullable=False, default=0),
+        Column("version", Integer, nullable=False, default=1, server_default="1"),
+    )
+    product_shards.create(connection, checkfirst=True)
+
+
+######################################################################
+#  U P G R A D E
+######################################################################
+def latest_version():
+    """Returns the version of the newest migration"""
+    return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+
+def current_version(connection):
+    """Returns the version of the schema of a database, 0 when it has none"""
+    if not inspect(connection).has_table("schema_version"):
+        return 0
+    return connection.execute(func.coalesce(func.max(schema_version.c.version), 0).select()).scalar()
+
+
+def schema_status(engine):
+    """Returns the (current, latest) schema versions of a database"""
+    with engine.connect() as connection:
+        return current_version(connection), latest_version()
+
+
+def upgrade(engine):
+    """Applies every migration newer than the schema of a database
+
+    Returns:
+        the versions that were applied
+    """
+    applied = []
+    # the lock is held outside any transaction, CREATE INDEX CONCURRENTLY would wait for it
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as lock:
+        if engine.dialect.name == "postgresql":
+            lock.execute(text("SELECT pg_advisory_lock(:key)"), {"key": MIGRATION_LOCK_ID})
+        try:
+            with engine.begin() as connection:
+                metadata.create_all(connection)
+                current = current_version(connection)
+            for version, description, function, transactional in MIGRATIONS:
+                if version <= current:
+                    continue
+                logger.info("Migrating to schema version %d: %s", version, description)
+                if transactional:
+                    with engine.begin() as connection:
+                        function(connection)
+                        connection.execute(schema_version.insert().values(version=version, description=description))
+                else:
+                    with engine.connect() as connection:
+                        function(connection.execution_options(isolation_level="AUTOCOMMIT"))
+                    with engine.begin() as connection:
+                        connection.execute(schema_version.insert().values(version=version, description=description))
+                applied.append(version)
+        finally:
+            if engine.dialect.name == "postgresql":
+                lock.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": MIGRATION_LOCK_ID})
+    return applied
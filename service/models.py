@@ -4,11 +4,14 @@ Models for Product
 All of the models are stored in this module
 """
 import os
-import json
 import logging
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
-import pandas as pd
+from sqlalchemy import and_, case, cast, column, func, literal, select, update, values
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm.exc import StaleDataError
+from retry.api import retry_call
+from service.pool import engine_options, warm_pool
 from enum import Enum
 
 logger = logging.getLogger("flask.app")
@@ -22,6 +25,10 @@ POSTGRES_PASSWORD = os.environ.get("POSTGRES_PASSWORD", "pass")
 RETRY_COUNT = int(os.environ.get("RETRY_COUNT", 10))
 RETRY_DELAY = int(os.environ.get("RETRY_DELAY", 1))
 RETRY_BACKOFF = int(os.environ.get("RETRY_BACKOFF", 2))
+RETRY_MAX_DELAY = int(os.environ.get("RETRY_MAX_DELAY", 8))
+# the longest a booting worker waits between its tries, below the GUNICORN_TIMEOUT
+# after which gunicorn kills a worker that has not booted
+RETRY_TIMEOUT = float(os.environ.get("RETRY_TIMEOUT", int(os.environ.get("GUNICORN_TIMEOUT", 30)) * 0.8))
 
 # Create the SQLAlchemy object to be initialized later in init_db()
 db = SQLAlchemy()
@@ -29,6 +36,17 @@ db = SQLAlchemy()
 def init_db(app):
     Product.init_db(app)
 
+def retry_tries(tries, delay, backoff, max_delay, timeout):
+    """Returns how many of tries fit when the waits between them may add up to timeout seconds"""
+    allowed, waited = 1, 0
+    while allowed < tries:
+        wait = min(delay * backoff ** (allowed - 1), max_delay)
+        if waited + wait > timeout:
+            break
+        waited += wait
+        allowed += 1
+    return allowed
+
 class DataValidationError(Exception):
     """ Used for an data validation errors when deserializing """
 
@@ -51,6 +69,9 @@ class Product(db.Model):
     __tablename__ = "products"
     __table_args__ = (
         db.UniqueConstraint('product_id', 'condition', name='unique_product_condition'),
+        # find_by_name is served by the leading column of the name + condition index
+        db.Index('ix_products_name_condition', 'product_name', 'condition'),
+        db.Index('ix_products_condition_id', 'condition', 'id'),
     )
     
     # Table Schema
@@ -62,20 +83,18 @@ class Product(db.Model):
     condition = db.Column(db.Enum(Condition), nullable=False, server_default=(Condition.UNKNOWN.name)) 
     restock_level = db.Column(db.Integer, default=0)
     reorder_amount = db.Column(db.Integer, default=0)
+    # incremented by every write, see versions(); an ORM flush only updates the row
+    # when its version is still the one that was read, see save()
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+    # the number of sub-counters the stock is split across, 0 when it is not sharded, see service/shards.py
+    shards = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    __mapper_args__ = {"version_id_col": version}
+    # in ledger mode, the id of the newest stock movement of a loaded Product, see service/ledger.py
+    newest_movement = 0
+    # the sum of the versions of the shards of a loaded sharded Product, see service/shards.py
+    shard_version = 0
     # condition = db.Column(db.Integer, default=Condition(0)) 
 
-    # def read_csv(self, file_path):
-    #     """
-    #     read data from csv to db table
-    #     """
-    #     df = pd.read_csv(file_path)
-    #     self.id = None
-    #     for _, row in df.iterrows():
-    #         db.session.add(Product(product_name = str(row[1]), quantity =int(row[2]), condition=int(row[3])))
-    #         db.session.commit()
-    #     logger.info("loading data from csv file successfully")
-
-
     def __repr__(self):
         return "<Product %r id=[%s]>" % (self.product_name, self.id)
 
@@ -91,20 +110,338 @@ class Product(db.Model):
         db.session.add(self)
         db.session.commit()
 
+    @classmethod
+    def bulk_create(cls, products, batch_size=1000):
+        """
+        Creates many Products in batched multi-row inserts inside one transaction
+
+        A Product whose (product_id, condition) already exists, or repeats an
+        earlier entry of the same call, is skipped and reported as a conflict
+
+        Args:
+            products (list): deserialized Products that have not been saved yet
+            batch_size (int): the number of rows sent in each INSERT statement
+
+        Returns:
+            a list holding the created Product, or None for a conflict, per entry
+        """
+        logger.info("Bulk creating %d Products", len(products))
+        results = [None] * len(products)
+        seen = set()
+        try:
+            for start in range(0, len(products), batch_size):
+                batch = products[start:start + batch_size]
+                product_ids = {product.product_id for product in batch}
+                seen.update(
+                    tuple(key) for key in db.session.query(cls.product_id, cls.condition)
+                    .filter(cls.product_id.in_(product_ids))
+                )
+                rows = {}
+                for index, product in enumerate(batch, start):
+                    key = (product.product_id, product.condition)
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                    rows[key] = (index, product.row())
+                if not rows:
+                    continue
+                try:
+                    with db.session.begin_nested():
+                        db.session.execute(
+                            cls.__table__.insert().values([row for _, row in rows.values()])
+                        )
+                except IntegrityError:
+                    # lost a race with a concurrent writer: isolate the conflicting rows
+                    logger.warning("Bulk insert conflict, retrying batch row by row")
+                    for key, (index, row) in list(rows.items()):
+                        try:
+                            with db.session.begin_nested():
+                                db.session.execute(cls.__table__.insert().values(row))
+                        except IntegrityError:
+                            del rows[key]
+                for product in cls.query.filter(cls.product_id.in_(product_ids)):
+                    key = (product.product_id, product.condition)
+                    if key in rows:
+                        results[rows[key][0]] = product
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return results
+
+    @classmethod
+    def restocked(cls, quantity):
+        """
+        Applies the restock rule of check_and_reorder_product to a SQL expression
+
+        Args:
+            quantity: the SQL expression (or value) of the new quantity
+        """
+        return case(
+            (and_(cls.condition == Condition.NEW, quantity < cls.restock_level), quantity + cls.reorder_amount),
+            else_=quantity,
+        )
+
+    @classmethod
+    def restock_all(cls, batch_size=10000):
+        """
+        Applies the restock rule to every NEW Product below its restock level
+
+        Sweeps the table in id ranges of batch_size with one UPDATE and one
+        short transaction per range, so writers are never blocked for long.
+        Sharded Products are restocked by the writes of their shards instead.
+
+        Returns:
+            a list with the id, product_id, new quantity and reorder_amount of
+            every restocked Product
+        """
+        criteria = (
+            cls.condition == Condition.NEW, cls.quantity < cls.restock_level, cls.reorder_amount > 0, cls.shards == 0,
+        )
+        low, high = db.session.query(func.min(cls.id), func.max(cls.id)).filter(*criteria).one()
+        db.session.commit()
+        logger.info("Restocking Products with ids %s to %s in batches of %d", low, high, batch_size)
+        columns = (cls.id, cls.product_id, cls.quantity, cls.reorder_amount)
+        restocked = []
+        if low is None:
+            return restocked
+        for start in range(low, high + 1, batch_size):
+            batch = criteria + (cls.id >= start, cls.id < start + batch_size)
+            stmt = (
+                update(cls).where(*batch)
+                .values(quantity=cls.quantity + cls.reorder_amount, version=cls.version + 1)
+                .execution_options(synchronize_session=False)
+            )
+            try:
+                if db.engine.dialect.full_returning:
+                    rows = db.session.execute(stmt.returning(*columns)).all()
+                else:
+                    ids = [row.id for row in db.session.query(cls.id).filter(*batch)]
+                    db.session.execute(stmt)
+                    rows = db.session.query(*columns).filter(cls.id.in_(ids)).all() if ids else []
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+            restocked.extend(
+                {"id": row.id, "product_id": row.product_id, "quantity": row.quantity,
+                 "reorder_amount": row.reorder_amount}
+                for row in sorted(rows)
+            )
+        logger.info("Restocked %d Products", len(restocked))
+        return restocked
+
+    @classmethod
+    def increase(cls, product_id, condition, value):
+        """ Atomically increases the quantity of a Product by value and restocks it """
+        logger.info("Increasing %s with condition %s by %d", product_id, condition, value)
+        return cls._adjust(product_id, condition, cls.quantity + value)
+
+    @classmethod
+    def decrease(cls, product_id, condition, value):
+        """
+        Atomically decreases the quantity of a Product by value and restocks it
+
+        Nothing is changed (and None returned) when the quantity would go negative
+        """
+        logger.info("Decreasing %s with condition %s by %d", product_id, condition, value)
+        return cls._adjust(product_id, condition, cls.quantity - value, cls.quantity >= value)
+
+    @classmethod
+    def set_quantity(cls, product_id, condition, value):
+        """ Atomically sets the quantity of a Product to value and restocks it """
+        logger.info("Setting %s with condition %s to %d", product_id, condition, value)
+        return cls._adjust(product_id, condition, literal(value, db.Integer))
+
+    @classmethod
+    def _adjust(cls, product_id, condition, quantity, *guards):
+        """
+        Sets the quantity of a Product with a single conditional UPDATE
+
+        The restock rule and any guards are evaluated by the database against the
+        locked row, so concurrent workers cannot lose each other's updates.
+
+        Args:
+            quantity: the SQL expression of the new quantity before restocking
+            guards: extra SQL criteria the row must match to be updated
+
+        Returns:
+            the updated (detached) Product, or None when no row matched or the
+            Product is sharded
+        """
+        if not isinstance(condition, Condition):
+            condition = Condition[condition]
+        # the stock of a sharded Product is in its shards, see service/shards.py
+        criteria = (cls.product_id == product_id, cls.condition == condition, cls.shards == 0) + guards
+        stmt = update(cls).where(*criteria).values(quantity=cls.restocked(quantity), version=cls.version + 1)
+        try:
+            if db.engine.dialect.full_returning:
+                product = db.session.execute(
+                    select(cls)
+                    .from_statement(stmt.returning(*cls.__table__.columns))
+                    .execution_options(populate_existing=True)
+                ).scalars().first()
+            else:
+                result = db.session.execute(stmt.execution_options(synchronize_session=False))
+                product = None
+                if result.rowcount:
+                    product = cls.query.populate_existing().filter(*criteria[:2]).first()
+            if product:
+                # keep the loaded values so serializing does not reload the row
+                db.session.expunge(product)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return product
+
+    @classmethod
+    def adjust_many(cls, adjustments, atomic=True):
+        """
+        Applies many quantity deltas in one transaction
+
+        On PostgreSQL all deltas are applied by one UPDATE ... FROM (VALUES ...)
+        statement, elsewhere by one conditional UPDATE per Product. Like
+        increase() and decrease(), a delta never takes a quantity below zero
+        and the restock rule is applied to the new quantity. Each
+        (product_id, condition) may be adjusted only once per call, so both
+        rules hold for every delta.
+
+        Args:
+            adjustments (list): (product_id, condition, delta) tuples
+            atomic (bool): apply nothing unless every delta can be applied
+
+        Returns:
+            a dict of the updated (detached) Products and a dict of the reasons
+            ("not found", "insufficient quantity" or "sharded") the other deltas
+            failed, both keyed by (product_id, Condition)
+
+        Raises:
+            DataValidationError: when a (product_id, condition) is adjusted twice
+        """
+        deltas = cls.adjustment_deltas(adjustments)
+        logger.info("Adjusting %d Products (atomic=%s)", len(deltas), atomic)
+        if not deltas:
+            return {}, {}
+        try:
+            if db.engine.dialect.full_returning:
+                adjustment = values(
+                    column("product_id", db.Integer), column("condition", db.String), column("delta", db.Integer),
+                    name="adjustments",
+                ).data([(product_id, condition.name, delta) for (product_id, condition), delta in deltas.items()])
+                quantity = cls.quantity + adjustment.c.delta
+                stmt = (
+                    update(cls)
+                    .where(
+                        cls.product_id == adjustment.c.product_id,
+                        cls.condition == cast(adjustment.c.condition, cls.condition.type),
+                        cls.shards == 0,
+                        quantity >= 0,
+                    )
+                    .values(quantity=cls.restocked(quantity), version=cls.version + 1)
+                )
+                products = db.session.execute(
+                    select(cls)
+                    .from_statement(stmt.returning(*cls.__table__.columns))
+                    .execution_options(populate_existing=True)
+                ).scalars().all()
+            else:
+                applied = set()
+                for (product_id, condition), delta in deltas.items():
+                    quantity = cls.quantity + delta
+                    result = db.session.execute(
+                        update(cls)
+                        .where(cls.product_id == product_id, cls.condition == condition, cls.shards == 0, quantity >= 0)
+                        .values(quantity=cls.restocked(quantity), version=cls.version + 1)
+                        .execution_options(synchronize_session=False)
+                    )
+                    if result.rowcount:
+                        applied.add((product_id, condition))
+                products = [
+                    product for product in cls.query.populate_existing()
+                    .filter(cls.product_id.in_({product_id for product_id, _ in applied}))
+                    if (product.product_id, product.condition) in applied
+                ]
+            updated = {(product.product_id, product.condition): product for product in products}
+            failed = cls.failed_adjustments(key for key in deltas if key not in updated)
+            if failed and atomic:
+                db.session.rollback()
+                return {}, failed
+            for product in products:
+                # keep the loaded values so serializing does not reload the row
+                db.session.expunge(product)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return updated, failed
+
+    @staticmethod
+    def adjustment_deltas(adjustments):
+        """Returns the deltas of (product_id, condition, delta) tuples keyed by (product_id, Condition)"""
+        deltas = {}
+        for product_id, condition, delta in adjustments:
+            if not isinstance(condition, Condition):
+                condition = Condition[condition]
+            if (product_id, condition) in deltas:
+                raise DataValidationError(
+                    "Product {} with condition {} is adjusted more than once".format(product_id, condition.name))
+            deltas[(product_id, condition)] = delta
+        return deltas
+
+    @classmethod
+    def failed_adjustments(cls, keys):
+        """Returns why the deltas of (product_id, Condition) keys could not be applied, keyed by them"""
+        failed = dict.fromkeys(keys, "not found")
+        if failed:
+            for product_id, condition, shards in db.session.query(cls.product_id, cls.condition, cls.shards).filter(
+                    cls.product_id.in_({product_id for product_id, _ in failed})):
+                if (product_id, condition) in failed:
+                    failed[(product_id, condition)] = "sharded" if shards else "insufficient quantity"
+        return failed
+
     def save(self):
         """
         Updates a Product to the database
+
+        The UPDATE is a compare-and-swap on the version that was read, so no
+        row lock is held between reading the Product and saving it.
+
+        Raises:
+            StaleDataError: the Product was changed or deleted since it was read
         """
         logger.info("Saving %s", self.product_name)
         if not self.id:
             raise DataValidationError("Empty ID")
-        db.session.commit()
+        try:
+            db.session.commit()
+        except StaleDataError:
+            db.session.rollback()
+            raise
 
     def delete(self):
         """ Removes a Product from the data store """
         logger.info("Deleting %s", self.product_name)
-        db.session.delete(self)
-        db.session.commit()
+        try:
+            db.session.delete(self)
+            db.session.commit()
+        except StaleDataError:
+            # changed or deleted since it was read, which does not matter to a delete
+            db.session.rollback()
+            Product.query.filter(Product.id == self.id).delete(synchronize_session=False)
+            db.session.expunge(self)
+            db.session.commit()
+
+    def row(self):
+        """ Returns the column values of a Product for a Core INSERT """
+        return {
+            "product_id": self.product_id,
+            "product_name": self.product_name,
+            "quantity": self.quantity or 0,
+            "condition": self.condition,
+            "restock_level": self.restock_level or 0,
+            "reorder_amount": self.reorder_amount or 0,
+        }
 
     def serialize(self):
         """ Serializes a Product into a dictionary """
@@ -153,12 +490,25 @@ class Product(db.Model):
         """ Initializes the database session """
         logger.info("Initializing database")
         cls.app = app
+        # pool options follow the database URI, which tests may change
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app.config)
         # This is where we initialize SQLAlchemy from the Flask app
         db.init_app(app)
         app.app_context().push()
-        db.create_all()  # make our sqlalchemy tables
-        # first time init need this
-        # Product.read_csv(app,"./products.csv")
+        # the schema is created and upgraded by flask db-upgrade, see service/migrations.py
+        from service import migrations  # pylint: disable=import-outside-toplevel
+        # the database may still be starting, so connect with exponential backoff
+        current, latest = retry_call(
+            migrations.schema_status, fargs=[db.engine], exceptions=OperationalError,
+            tries=retry_tries(RETRY_COUNT, RETRY_DELAY, RETRY_BACKOFF, RETRY_MAX_DELAY, RETRY_TIMEOUT),
+            delay=RETRY_DELAY, backoff=RETRY_BACKOFF, max_delay=RETRY_MAX_DELAY, logger=logger,
+        )
+        if current < latest:
+            if app.config.get("DB_AUTO_MIGRATE"):
+                migrations.upgrade(db.engine)
+            else:
+                logger.warning("Database schema is at version %d of %d, run flask db-upgrade", current, latest)
+        logger.info("Opened %d database connections", warm_pool(db.engine))
         #q1 = db.session.query(Product).filter(Product.product_name=="apple").first()
         #q2 = db.session.query(Product).filter(Product.id==1).first()
         #print(q1)
@@ -234,6 +584,71 @@ class Product(db.Model):
         logger.info("Processing all Products")
         return cls.query.all()
 
+    @classmethod
+    def page(cls, query, limit, after=None):
+        """Returns one page of a Product query in id order using keyset pagination
+
+        Args:
+            query: the Product query to page through
+            limit (int): the most Products to return
+            after (int): the cursor, only Products with a greater id are returned
+
+        Returns:
+            (products, next_cursor) where next_cursor is None on the last page
+        """
+        logger.info("Processing page of %d after %s ...", limit, after)
+        products = cls.page_query(query, limit + 1, after).all()
+        if len(products) > limit:
+            return products[:limit], products[limit - 1].id
+        return products, None
+
+    @classmethod
+    def page_query(cls, query, limit, after=None):
+        """Returns the query of the first limit Products after the cursor in id order"""
+        if after is not None:
+            query = query.filter(cls.id > after)
+        return query.order_by(cls.id).limit(limit)
+
+    @classmethod
+    def versions(cls, query):
+        """Returns a summary of a Product query that changes with every write to it
+
+        The summary is (count, sum of versions, greatest id, sum of ids) and is
+        computed by the database from the id and version columns alone.
+        """
+        logger.info("Processing versions query ...")
+        rows = query.with_entities(cls.id.label("id"), cls.version.label("version")).subquery()
+        count, version_sum, max_id, id_sum = db.session.query(
+            func.count(rows.c.id),
+            func.coalesce(func.sum(rows.c.version), 0),
+            func.coalesce(func.max(rows.c.id), 0),
+            func.coalesce(func.sum(rows.c.id), 0),
+        ).one()
+        return int(count), int(version_sum), int(max_id), int(id_sum)
+
+    @staticmethod
+    def versions_of(products):
+        """Returns the versions() summary of Products that are already loaded"""
+        ids = [product.id for product in products]
+        return len(ids), sum(product.version for product in products), max(ids, default=0), sum(ids)
+
+    @classmethod
+    def stream(cls, query, batch_size=1000, after=None):
+        """Iterates a Product query in id order without loading it all at once
+
+        Rows are fetched batch_size at a time, from a server-side cursor on
+        databases that support one.
+
+        Args:
+            query: the Product query to iterate
+            batch_size (int): the number of rows fetched per round trip
+            after (int): the cursor, only Products with a greater id are returned
+        """
+        logger.info("Processing stream in batches of %d after %s ...", batch_size, after)
+        if after is not None:
+            query = query.filter(cls.id > after)
+        return query.order_by(cls.id).yield_per(batch_size)
+
     @classmethod
     def find(cls, by_id):
         """ Finds a Product by it's ID """
@@ -297,4 +712,55 @@ class Product(db.Model):
         logger.info("Processing name and condition query for %s and %s...", product_name, condition)
         if type(condition) != str:      
             condition = condition.name
-        return cls.query.filter(cls.product_name == product_name, cls.condition == condition)
\ No newline at end of file
+        return cls.query.filter(cls.product_name == product_name, cls.condition == condition)
+
+class StockMovement(db.Model):
+    """
+    Class that represents a change to the quantity of a Product in ledger mode
+
+    Movements are only ever inserted; compaction folds them into the quantity
+    of their Product and marks them compacted, see service/ledger.py
+    """
+    __tablename__ = "stock_movements"
+    __table_args__ = (
+        # the newest movement and the history of a Product
+        db.Index("ix_stock_movements_product", "product_row_id", "id"),
+        # the pending tail read with every balance, and scanned by compaction; the
+        # predicates are written the way each dialect renders ~StockMovement.compacted
+        db.Index(
+            "ix_stock_movements_pending", "product_row_id",
+            postgresql_where=db.text("NOT compacted"), sqlite_where=db.text("compacted = 0"),
+        ),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    # the id of the products row, not its product_id
+    product_row_id = db.Column(db.Integer, db.ForeignKey("products.id", ondelete="CASCADE"), nullable=False)
+    delta = db.Column(db.Integer, nullable=False)
+    reason = db.Column(db.String(16), nullable=False)
+    compacted = db.Column(db.Boolean, nullable=False, default=False, server_default=db.false())
+    created_at = db.Column(db.DateTime, nullable=False, server_default=db.func.now())
+
+    def __repr__(self):
+        return "<StockMovement %r delta=%d id=[%s]>" % (self.reason, self.delta, self.id)
+
+
+class ProductShard(db.Model):
+    """
+    Class that represents one sub-counter of the stock of a sharded Product
+
+    The quantity of a sharded Product is its products.quantity (normally 0)
+    plus the quantities of its shards, see service/shards.py
+    """
+    __tablename__ = "product_shards"
+
+    product_row_id = db.Column(
+        db.Integer, db.ForeignKey("products.id", ondelete="CASCADE"), primary_key=True, autoincrement=False
+    )
+    shard = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+    # incremented by every write of the shard, for the ETag of its Product
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+
+    def __repr__(self):
+        return "<ProductShard %d of %d quantity=%d>" % (self.shard, self.product_row_id, self.quantity)
@@ -0,0 +1,138 @@
+"""
+Database connection pool
+
+Builds the SQLAlchemy engine options from the DB_* settings and provides a
+QueuePool that records how long checkouts wait, how often the pool has to
+open overflow connections and how often a checkout times out.
+"""
+import threading
+import time
+
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+from service.metrics import Histogram
+
+
+class PoolStats:
+    """Counters of an InstrumentedQueuePool, kept when the pool is recreated"""
+
+    def __init__(self):
+        self.wait_time = Histogram()
+        self.checkouts = 0
+        self.overflow_events = 0
+        self.timeouts = 0
+        self._lock = threading.Lock()
+
+    def increment(self, name):
+        """Adds one to a counter"""
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+
+class InstrumentedQueuePool(QueuePool):
+    """A QueuePool that records PoolStats"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            connection = super().connect()
+        except PoolTimeoutError:
+            self.stats.increment("timeouts")
+            raise
+        finally:
+            self.stats.wait_time.observe(time.perf_counter() - start)
+        self.stats.increment("checkouts")
+        return connection
+
+    def _inc_overflow(self):
+        opened = super()._inc_overflow()
+        if opened and self._overflow > 0:
+            self.stats.increment("overflow_events")
+        return opened
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.stats = self.stats
+        return pool
+
+
+def engine_options(config):
+    """Returns SQLALCHEMY_ENGINE_OPTIONS for the database in config
+
+    SQLite does not use a connection pool here, so it only gets the options
+    shared by every database.
+    """
+    url = make_url(config["SQLALCHEMY_DATABASE_URI"])
+    options = {"pool_pre_ping": config["DB_POOL_PRE_PING"]}
+    if url.get_backend_name() == "sqlite":
+        return options
+    options.update(
+        poolclass=InstrumentedQueuePool,
+        pool_size=config["DB_POOL_SIZE"],
+        max_overflow=config["DB_MAX_OVERFLOW"],
+        pool_timeout=config["DB_POOL_TIMEOUT"],
+        pool_recycle=config["DB_POOL_RECYCLE"],
+    )
+    if config["DB_STATEMENT_TIMEOUT"] and url.get_backend_name() == "postgresql":
+        options["connect_args"] = {"options": "-c statement_timeout={:d}".format(config["DB_STATEMENT_TIMEOUT"])}
+    return options
+
+
+def warm_pool(engine, connections=None):
+    """Opens pooled connections ahead of the first requests
+
+    Args:
+        connections (int): how many to open, the size of the pool by default
+
+    Returns:
+        the number of connections opened, 0 for engines without a QueuePool
+    """
+    pool = engine.pool
+    if not isinstance(pool, QueuePool):
+        return 0
+    count = min(connections or pool.size(), pool.size())
+    opened = []
+    try:
+        for _ in range(count):
+            opened.append(engine.connect())
+    finally:
+        for connection in opened:
+            connection.close()
+    # a pool replaced by dispose() or recreate() starts cold again
+    pool.warm = True
+    return len(opened)
+
+
+def pool_is_warm(engine):
+    """Tells whether warm_pool has run on the current pool of an engine"""
+    return not isinstance(engine.pool, QueuePool) or getattr(engine.pool, "warm", False)
+
+
+def pool_status(engine):
+    """Returns the state and counters of the connection pool of an engine"""
+    pool = engine.pool
+    status = {"class": type(pool).__name__, "status": pool.status(), "warm": pool_is_warm(engine)}
+    if isinstance(pool, QueuePool):
+        status.update(
+            size=pool.size(),
+            checked_out=pool.checkedout(),
+            checked_in=pool.checkedin(),
+            overflow=max(pool.overflow(), 0),
+            max_overflow=pool._max_overflow,  # pylint: disable=protected-access
+            timeout=pool.timeout(),
+        )
+    stats = getattr(pool, "stats", None)
+    if stats is not None:
+        status.update(
+            checkouts=stats.checkouts,
+            overflow_events=stats.overflow_events,
+            timeouts=stats.timeouts,
+            wait_time_seconds=stats.wait_time.snapshot(),
+        )
+    return status
@@ -4,24 +4,30 @@ My Service
 Describe what your service does here
 """
 
-from math import prod
-import os
-from queue import Empty
-import sys
-import logging
-from venv import create
-from attr import validate
-from flask import Flask, jsonify, request, url_for, make_response, abort
-from flask_restx import Api, Resource, fields, reqparse, inputs
-from numpy import integer
-from service.models import Product, Condition, DataValidationError
+import csv
+import io
+import time
+import zlib
+from collections import Counter
+from flask import Response, request, url_for, abort, stream_with_context
+from flask_restx import Api, Resource, fields
+from service.models import Product, Condition, DataValidationError, db
+from service.serializers import (
+    PRODUCT_FIELDS, product_dict, product_values, product_json, dumps, json_response, json_text_response
+)
+from service.cache import create_cache
+from service.validation import (
+    Argument, QueryArgs, compile_model, boolean, choice, condition, int_range, integer, quantity,
+)
+from service.pool import pool_status, pool_is_warm
+from service import ledger, migrations, shards
+from service.metrics import RequestMetrics
 from . import status  # HTTP Status Codes
 from werkzeug.exceptions import NotFound
-
-# For this example we'll use SQLAlchemy, a popular ORM that supports a
-# variety of backends including SQLite, MySQL, and PostgreSQL
-from flask_sqlalchemy import SQLAlchemy
-from service.models import Product, DataValidationError
+from werkzeug.http import quote_etag
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm.exc import StaleDataError
 
 # Import Flask application
 from . import app
@@ -37,6 +43,54 @@ def index():
     return app.send_static_file("index.html")
 
 
+######################################################################
+# Prometheus metrics of every worker
+######################################################################
+request_metrics = RequestMetrics(app.config["METRICS_DIR"], app.config["METRICS_FLUSH_INTERVAL"])
+request_metrics.init_app(app)
+
+
+@app.route("/metrics")
+def metrics():
+    """ Metrics in the Prometheus text format """
+    return Response(request_metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+######################################################################
+# Health checks for load balancers and orchestrators
+######################################################################
+@app.route("/health/live")
+def health_live():
+    """ The worker is running """
+    return json_response({"status": "OK"})
+
+
+@app.route("/health/ready")
+def health_ready():
+    """ The worker can serve requests: its pool is warm and the database is reachable and current """
+    global schema_current
+    checks = {"pool_warm": pool_is_warm(db.engine)}
+    try:
+        if not schema_current:
+            current, latest = migrations.schema_status(db.engine)
+            schema_current = current >= latest
+        else:
+            with db.engine.connect() as connection:
+                connection.execute(text("SELECT 1"))
+        checks["database"] = True
+    except SQLAlchemyError as error:
+        app.logger.warning("Readiness check failed: %s", error)
+        checks["database"] = False
+    checks["schema_current"] = schema_current
+    ready = all(checks.values())
+    return json_response(dict(checks, status="ready" if ready else "not ready"),
+                         status.HTTP_200_OK if ready else status.HTTP_503_SERVICE_UNAVAILABLE)
+
+
+# set once the schema is seen at the latest migration, it never goes back
+schema_current = False
+
+
 ######################################################################
 # Configure Swagger before initializing it
 ######################################################################
@@ -58,12 +112,12 @@ create_model = api.model('Product', {
                               description='The name of Product'),
     'quantity': fields.Integer(required=True,
                               description='The quantity of Product'),                          
-    'condition': fields.String(required=False,
+    'condition': fields.String(required=True,
                               enum=Condition._member_names_, 
                               description='The condition of the Product'),
-    'restock_level': fields.Integer(required=True,
+    'restock_level': fields.Integer(required=False,
                               description='The restock level of Product'), 
-    'reorder_amount': fields.Integer(required=True,
+    'reorder_amount': fields.Integer(required=False,
                               description='The reorder amount of Product')
 
 })
@@ -72,11 +126,32 @@ product_model = api.inherit(
     'ProductModel', 
     create_model,
     {
-        'id': fields.String(readOnly=True,
+        'id': fields.Integer(readOnly=True,
                             description='The unique id assigned internally by service'),
     }
 )
 
+bulk_result_model = api.model('BulkResult', {
+    'status': fields.Integer(description='The HTTP status of this entry'),
+    'message': fields.String(description='Why this entry was not created'),
+    'product': fields.Nested(product_model, allow_null=True,
+                             description='The created Product'),
+})
+
+adjustment_model = api.model('Adjustment', {
+    'product_id': fields.Integer(required=True, description='The id of the Product'),
+    'condition': fields.String(required=True, enum=Condition._member_names_,
+                               description='The condition of the Product'),
+    'delta': fields.Integer(required=True, description='The amount added to (or, if negative, removed from) the quantity'),
+})
+
+adjustment_result_model = api.model('AdjustmentResult', {
+    'status': fields.Integer(description='The HTTP status of this entry'),
+    'message': fields.String(description='Why this entry was not applied'),
+    'product': fields.Nested(product_model, allow_null=True,
+                             description='The adjusted Product'),
+})
+
 # product_model = api.model('Product', {
 #     'product_id': fields.Integer(required=True,
 #                           description='The id of the Product'),
@@ -90,22 +165,59 @@ product_model = api.inherit(
 
 # })
 
-# query string arguments
-product_args = reqparse.RequestParser()
-# product_args.add_argument('product_id', type=str, required=False, help='List Products by id')
-# product_args.add_argument('product_name', type=str, required=False, help='List Product by name')
-product_args.add_argument('condition', type=str, required=False, help='List Products by condition')
-product_args.add_argument('value', type=int, required=False, help='Doing action on quantity')
-product_args.add_argument('product_name', type=str, required=False, help='List Product by name')
-
-
-get_args = reqparse.RequestParser()
-get_args.add_argument('product_name', type=str, required=False, help='List Product by name')
-get_args.add_argument('condition', type=str, required=False, help='List Products by condition')
-
-retrieve_args = reqparse.RequestParser()
-retrieve_args.add_argument('condition', type=str, required=False, help='List Products by condition')
-# quantity_args.add_argument('value', type=int, required=True, help='Doing action on quantity')
+# query string arguments, validated and converted by service/validation.py
+product_args = QueryArgs('product_args', [
+    Argument('value', quantity, required="Value 'condition' and 'value' should be provided",
+             invalid="'value' not an integer", help='Doing action on quantity'),
+    Argument('condition', condition, required="Value 'condition' and 'value' should be provided",
+             help='The condition of the Product'),
+])
+
+get_args = QueryArgs('get_args', [
+    Argument('product_name', help='List Product by name'),
+    Argument('condition', condition, help='List Products by condition'),
+    Argument('limit', int_range(1, app.config['PAGE_SIZE_MAX']), default=app.config['PAGE_SIZE_DEFAULT'],
+             invalid="'limit' must be an integer from 1 to {}".format(app.config['PAGE_SIZE_MAX']),
+             help='The most Products to return'),
+    Argument('cursor', integer, invalid="'cursor' not an integer", help='Return Products after this cursor'),
+    Argument('stream', boolean, default=False, help='Stream every eligible Product instead of one page'),
+])
+
+export_args = QueryArgs('export_args', [
+    Argument('product_name', help='Export Products by name'),
+    Argument('condition', condition, help='Export Products by condition'),
+    Argument('format', choice('csv', 'ndjson'), default='csv', help='csv or ndjson'),
+])
+
+adjustment_args = QueryArgs('adjustment_args', [
+    Argument('mode', choice('atomic', 'best_effort'), default='atomic',
+             help='atomic applies all adjustments or none, best_effort applies every one it can'),
+])
+
+retrieve_args = QueryArgs('retrieve_args', [
+    Argument('condition', condition, help='List Products by condition'),
+])
+
+update_args = QueryArgs('update_args', [
+    Argument('condition', condition, required="'condition' not valid", help='The condition of the Product'),
+])
+
+shard_args = QueryArgs('shard_args', [
+    Argument('condition', condition, required="Value 'condition' and 'count' should be provided",
+             help='The condition of the Product'),
+    Argument('count', int_range(0, app.config['SHARDS_MAX']),
+             required="Value 'condition' and 'count' should be provided",
+             invalid="'count' must be an integer from 0 to {}".format(app.config['SHARDS_MAX']),
+             help='The number of shards, 0 to merge them back'),
+])
+
+# JSON bodies, validated and converted by service/validation.py
+validate_product = compile_model(create_model)
+# adjustments come from programs rather than the HTML form, so their ints must be JSON numbers
+validate_adjustment = compile_model(adjustment_model, strict=True)
+
+# read-through cache of GET /inventory/<product_id>, see service/cache.py
+product_cache = create_cache(app.config)
 
 ######################################################################
 # Special Error Handlers
@@ -143,8 +255,8 @@ class ProductResource(Resource):
     #------------------------------------------------------------------
     @api.doc('get_products')
     @api.response(404, 'Product not found')
-    @api.marshal_with(product_model)
-    @api.expect(retrieve_args, validate=True)
+    @api.response(200, 'Success', product_model)
+    @api.doc(params=retrieve_args.params)
     def get(self, product_id):
         """
         Retrieve Product
@@ -155,33 +267,47 @@ class ProductResource(Resource):
         This endpoint will return Product(s) based on the id, condition and/or name  
         """
         # Check whether we have a condition in args(as query)
-        args = product_args.parse_args()
-        condition = args.get("condition")
-        results = []
+        args = retrieve_args.parse_args()
+        condition = args["condition"].name if args["condition"] else None
+        cached = product_cache.get((product_id, condition))
+        if cached is not None:
+            body, etag = cached
+            if etag in request.if_none_match:
+                return not_modified(etag)
+            app.logger.info("Returning cached product: %s", product_id)
+            return json_text_response(body, headers=etag_header(etag))
+
+        query = Product.find_by_id(product_id)
+        if condition:
+            query = query.filter(Product.condition == condition)
+        if request.if_none_match and not app.config["INVENTORY_LEDGER"]:
+            # answer polling clients from the id and version columns alone
+            versions = Product.versions(query)
+            if versions[0] and product_etag(versions) in request.if_none_match:
+                return not_modified(product_etag(versions))
 
         # For route with only product_id
-        if not args['condition']:
+        if not condition:
             app.logger.info("Request for product with id: %s", product_id)
-            products = Product.find_by_id(product_id)
-            if not products.first():
+            products = fetch_products(query)
+            if not products:
                 abort(status.HTTP_404_NOT_FOUND, "Product with id '{}' was not found.".format(product_id))
-                # raise NotFound("Product with id '{}' was not found.".format(product_id))
-            else:
-                results = [product.serialize() for product in products]
+            results = [product_dict(product) for product in products]
             app.logger.info("Returning product with id: %s", product_id)
         else:
             app.logger.info("Request for product with id: %s and condition: %s", product_id, condition)
-            if condition not in ['NEW', 'OPEN_BOX', 'USED', 'UNKNOWN']:
-                abort(status.HTTP_400_BAD_REQUEST, "'condition' not valid")
-            product = Product.find_by_id_and_condition(product_id, condition)
-            if not product:
+            products = fetch_products(query)
+            if not products:
                 abort(status.HTTP_404_NOT_FOUND, "Product with id '{}' was not found.".format(product_id))
-                # raise NotFound('Product {} with condition {} was not found'.format(product_id, condition))
-            else:
-                results = product.serialize()
+            results = product_dict(products[0])
             app.logger.info("Returning product: %s", product_id)
 
-        return results, status.HTTP_200_OK
+        body = dumps(results)
+        etag = products_etag(products)
+        product_cache.set((product_id, condition), (body, etag))
+        if etag in request.if_none_match:
+            return not_modified(etag)
+        return json_text_response(body, headers=etag_header(etag))
 
     #------------------------------------------------------------------
     # UPDATE AN EXISTING PRODUCT
@@ -190,29 +316,69 @@ class ProductResource(Resource):
     @api.response(404, 'Product not found')
     @api.response(400, 'The posted Product data was not valid')
     @api.expect(product_model)
-    @api.marshal_with(product_model)
+    @api.doc(params=update_args.params)
+    @api.response(409, 'The Product kept changing while being updated')
+    @api.response(412, 'The Product no longer has an ETag of If-Match')
+    @api.response(200, 'Success', product_model)
     def put(self, product_id):
-        """ Update the product """
-        condition = request.args.get("condition")
+        """
+        Update the product
+
+        With an If-Match header the update is only applied while the Product
+        still has one of the ETags it lists, otherwise it fails with 412.
+        Without one, an update that races another write is retried on the
+        new version of the Product.
+        """
+        condition = update_args.parse_args()["condition"]
 
-        app.logger.info('Request to update Product with id: %s and condition: %s', product_id, condition)
+        app.logger.info('Request to update Product with id: %s and condition: %s', product_id, condition.name)
         check_content_type("application/json")
-        if condition not in ['NEW', 'OPEN_BOX', 'USED', 'UNKNOWN']:
-            abort(status.HTTP_400_BAD_REQUEST, "'condition' not valid")
-        product = Product.find_by_id_and_condition(product_id, condition)
-        if not product:
-            abort(status.HTTP_404_NOT_FOUND, "Product {} with condition {} was not found".format(product_id, condition))
-        if product.product_name != request.json["product_name"]:
-            abort(status.HTTP_400_BAD_REQUEST, "Product Name Conflict") 
-        if str(product.product_id) != str(request.json["product_id"]):
-            abort(status.HTTP_400_BAD_REQUEST, "Product ID Conflict") 
-        data = api.payload
-        product.deserialize(data)
-        check_and_reorder_product(product)
-        product.save()
+        data = validate_product(api.payload)
+        for attempt in range(app.config["UPDATE_RETRIES"] + 1):
+            product = Product.find_by_id_and_condition(product_id, condition)
+            if not product:
+                abort(status.HTTP_404_NOT_FOUND, "Product {} with condition {} was not found".format(product_id, condition.name))
+            if product.product_name != data["product_name"]:
+                abort(status.HTTP_400_BAD_REQUEST, "Product Name Conflict") 
+            if product.product_id != data["product_id"]:
+                abort(status.HTTP_400_BAD_REQUEST, "Product ID Conflict") 
+            row_quantity = product.quantity
+            if app.config["INVENTORY_LEDGER"]:
+                product.newest_movement = ledger.newest_movement_of(product)
+            if product.shards:
+                product.shard_version = shards.version_of(product)
+            if request.if_match and products_etag([product]) not in request.if_match:
+                abort(status.HTTP_412_PRECONDITION_FAILED, "Product {} with condition {} was changed".format(
+                    product_id, condition.name))
+            for field, value in data.items():
+                setattr(product, field, value)
+            check_and_reorder_product(product)
+            try:
+                if product.shards:
+                    # the new quantity is spread across the shards
+                    quantity, product.quantity = product.quantity, 0
+                    shards.spread(product, quantity)
+                elif app.config["INVENTORY_LEDGER"]:
+                    # the new quantity is a movement, the row keeps its compacted balance
+                    quantity, product.quantity = product.quantity, row_quantity
+                    ledger.move_to(product, quantity)
+                # compare-and-swap on the version read above
+                product.save()
+                break
+            except StaleDataError:
+                app.logger.info("Product %s was changed by another request (attempt %d)", product_id, attempt + 1)
+                if request.if_match:
+                    abort(status.HTTP_412_PRECONDITION_FAILED, "Product {} with condition {} was changed".format(
+                        product_id, condition.name))
+        else:
+            abort(status.HTTP_409_CONFLICT, "Product {} with condition {} is changing too often, retry".format(
+                product_id, condition.name))
+        invalidate_product(product_id)
+        if app.config["INVENTORY_LEDGER"] or product.shards:
+            product = fetch_products(Product.query.filter(Product.id == product.id))[0]
 
         app.logger.info('Product with id {} updated.'.format(product_id))
-        return product.serialize(), status.HTTP_200_OK
+        return product_response(product)
 
     #------------------------------------------------------------------
     # DELETE A PET
@@ -227,8 +393,13 @@ class ProductResource(Resource):
         if not products.first():
             raise NotFound("Product with id '{}' was not found.".format(product_id))
         else:
+            row_ids = []
             for product in products:
+                row_ids.append(product.id)
                 product.delete()
+            if app.config["INVENTORY_LEDGER"]:
+                ledger.discard(row_ids)
+        invalidate_product(product_id)
         return '', status.HTTP_204_NO_CONTENT
 
 
@@ -244,30 +415,52 @@ class ProductCollection(Resource):
     # LIST ALL PRODUCTS (ALL or with query parameters)
     #------------------------------------------------------------------
     @api.doc('list_products')
-    @api.expect(get_args, validate=True)
-    @api.marshal_list_with(product_model)
+    @api.doc(params=get_args.params)
+    @api.response(200, 'Success', [product_model])
+    @api.produces(['application/json', 'application/x-ndjson'])
     def get(self):
-        """Returns all of the eligible Products"""
+        """Returns one page of the eligible Products, or streams all of them"""
         app.logger.info("Request for product list ...")
-        products = []
-        args = product_args.parse_args()
-        if not args["product_name"] and not args["condition"]:
-            products = Product.all()
-        elif args["product_name"] and args["condition"]:
-            if args["condition"] not in ['NEW', 'OPEN_BOX', 'USED', 'UNKNOWN']:
-                abort(status.HTTP_400_BAD_REQUEST, "'condition' not valid")
-            products = Product.find_by_name_and_condition(args["product_name"], args["condition"])
-        elif args["product_name"]:
-            products = Product.find_by_name(args["product_name"])
-        elif args["condition"]:
-            if args["condition"] not in ['NEW', 'OPEN_BOX', 'USED', 'UNKNOWN']:
-                abort(status.HTTP_400_BAD_REQUEST, "'condition' not valid")
-            products = Product.find_by_condition(args["condition"])
-
-        
-        results = [product.serialize() for product in products]
+        args = get_args.parse_args()
+        query = product_query(args)
+        ndjson = request.accept_mimetypes.best_match(
+            ['application/json', 'application/x-ndjson']) == 'application/x-ndjson'
+        if args["stream"] or ndjson:
+            products = Product.stream(query, app.config["STREAM_BATCH_SIZE"], args["cursor"])
+            return stream_products(stream_query(products), ndjson)
+
+        if request.if_none_match and not app.config["INVENTORY_LEDGER"]:
+            versions = Product.versions(Product.page_query(query, args["limit"], args["cursor"]))
+            # the greatest id of a full page is the cursor of the next one
+            next_page = versions[0] == args["limit"] and Product.page_query(
+                query, 1, versions[2]).with_entities(Product.id).first() is not None
+            etag = product_etag(versions + (int(next_page),))
+            if etag in request.if_none_match:
+                return not_modified(etag)
+
+        products, next_cursor = Product.page(query, args["limit"], args["cursor"])
+        if app.config["INVENTORY_LEDGER"]:
+            products = ledger.reload(products)
+        shards.totals(products)
+
+        results = [product_dict(product) for product in products]
+        etag = products_etag(products, next_cursor is not None)
+        if etag in request.if_none_match:
+            return not_modified(etag)
+        headers = etag_header(etag)
+        if next_cursor is not None:
+            next_url = url_for(
+                "product_collection",
+                product_name=args["product_name"],
+                condition=args["condition"].name if args["condition"] else None,
+                limit=args["limit"],
+                cursor=next_cursor,
+                _external=True,
+            )
+            headers["Link"] = '<{}>; rel="next"'.format(next_url)
+            headers["X-Next-Cursor"] = str(next_cursor)
         app.logger.info("Returning %d products", len(results))
-        return results, status.HTTP_200_OK
+        return json_response(results, headers=headers)
 
     #------------------------------------------------------------------
     # ADD A NEW PRODUCT
@@ -276,23 +469,257 @@ class ProductCollection(Resource):
     @api.response(400, 'The posted Product data was not valid')
     @api.response(409, 'The posted Product already exists')
     @api.expect(create_model)
-    @api.marshal_with(product_model, code=201)
+    @api.response(201, 'Product created', product_model)
     def post(self):
         """create a new product"""
         app.logger.info('Create Product Request')
         check_content_type("application/json")
-        product = Product()
-        product.deserialize(api.payload)
+        product = Product(**validate_product(api.payload))
         
         find_product = Product.find_by_id_and_condition(product.product_id, product.condition)
         if find_product:
             abort(status.HTTP_409_CONFLICT, 'product {} with condition {} already exists'.format(product.product_id, product.condition))
         product.create()
+        invalidate_product(product.product_id)
 
         location_url = url_for("product_resource", product_id=product.product_id, condition = product.condition.name, _external=True)
 
         app.logger.info('Created Product with id: {}'.format(product.product_id))
-        return product.serialize(), status.HTTP_201_CREATED, {"Location": location_url}
+        return product_response(product, status.HTTP_201_CREATED, {"Location": location_url})
+
+######################################################################
+#  PATH: /inventory/bulk
+######################################################################
+@api.route('/inventory/bulk', strict_slashes=False)
+class ProductBulkCollection(Resource):
+    """ Handles creating many Products in one request """
+
+    @api.doc('bulk_create_products')
+    @api.response(400, 'The posted data was not a list of Products')
+    @api.response(413, 'Too many Products in one request')
+    @api.expect([create_model])
+    @api.response(207, 'Per-item results', [bulk_result_model])
+    def post(self):
+        """create many products in one transaction"""
+        app.logger.info('Bulk Create Products Request')
+        check_content_type("application/json")
+        data = api.payload
+        if not isinstance(data, list):
+            abort(status.HTTP_400_BAD_REQUEST, "Body must be a list of Products")
+        if len(data) > app.config["BULK_MAX_ITEMS"]:
+            abort(
+                status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                "At most {} Products per request".format(app.config["BULK_MAX_ITEMS"]),
+            )
+
+        results = []
+        products = []
+        for item in data:
+            try:
+                products.append(Product(**validate_product(item)))
+                results.append(None)
+            except DataValidationError as error:
+                results.append({'status': status.HTTP_400_BAD_REQUEST, 'message': str(error)})
+
+        created = iter(Product.bulk_create(products, app.config["BULK_BATCH_SIZE"]))
+        valid = iter(products)
+        for index, result in enumerate(results):
+            if result is not None:
+                continue
+            product, requested = next(created), next(valid)
+            if product is None:
+                results[index] = {
+                    'status': status.HTTP_409_CONFLICT,
+                    'message': 'product {} with condition {} already exists'.format(
+                        requested.product_id, requested.condition.name),
+                }
+            else:
+                invalidate_product(product.product_id)
+                results[index] = {'status': status.HTTP_201_CREATED, 'product': product_dict(product)}
+
+        app.logger.info('Bulk created %d of %d Products',
+                        sum(result['status'] == status.HTTP_201_CREATED for result in results), len(results))
+        return json_response(results, status.HTTP_207_MULTI_STATUS)
+
+######################################################################
+#  PATH: /inventory/adjustments
+######################################################################
+@api.route('/inventory/adjustments', strict_slashes=False)
+class AdjustmentCollection(Resource):
+    """ Applies many stock adjustments in one transaction """
+
+    @api.doc('adjust_products')
+    @api.doc(params=adjustment_args.params)
+    @api.expect([adjustment_model])
+    @api.response(200, 'Every adjustment was applied', [adjustment_result_model])
+    @api.response(207, 'Per-item results of a best_effort request', [adjustment_result_model])
+    @api.response(400, 'The posted data was not a list of valid adjustments')
+    @api.response(409, 'An atomic request was not applied', [adjustment_result_model])
+    @api.response(413, 'Too many adjustments in one request')
+    def post(self):
+        """add a delta to the quantity of many products, restocking them like /inc and /dec"""
+        args = adjustment_args.parse_args()
+        atomic = args["mode"] == "atomic"
+        app.logger.info('Adjust Products Request (%s)', args["mode"])
+        check_content_type("application/json")
+        data = api.payload
+        if not isinstance(data, list):
+            abort(status.HTTP_400_BAD_REQUEST, "Body must be a list of adjustments")
+        if len(data) > app.config["BULK_MAX_ITEMS"]:
+            abort(
+                status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                "At most {} adjustments per request".format(app.config["BULK_MAX_ITEMS"]),
+            )
+
+        keys = [parse_adjustment(item) for item in data]
+        # a product may be adjusted once per request, so every delta is checked on its own
+        counts = Counter(key[:2] for key in keys if isinstance(key, tuple))
+        keys = [
+            'Product {} with condition {} is adjusted more than once'.format(key[0], key[1].name)
+            if isinstance(key, tuple) and counts[key[:2]] > 1 else key
+            for key in keys
+        ]
+        results = [{'status': status.HTTP_400_BAD_REQUEST, 'message': key} if isinstance(key, str) else None
+                   for key in keys]
+        invalid = any(results)
+        adjustments = [key for key in keys if isinstance(key, tuple)]
+        updated, failed = {}, {}
+        if not (invalid and atomic):
+            adjust_many = ledger.adjust_many if app.config["INVENTORY_LEDGER"] else Product.adjust_many
+            updated, failed = adjust_many(adjustments, atomic)
+        for product_id in {product_id for product_id, _ in updated}:
+            invalidate_product(product_id)
+
+        for index, key in enumerate(keys):
+            if results[index] is not None:
+                continue
+            key = key[:2]
+            if key in updated:
+                results[index] = {'status': status.HTTP_200_OK, 'product': product_dict(updated[key])}
+            elif failed.get(key) == "not found":
+                results[index] = {
+                    'status': status.HTTP_404_NOT_FOUND,
+                    'message': 'Product {} with condition {} was not found'.format(key[0], key[1].name),
+                }
+            elif failed.get(key) == "insufficient quantity":
+                results[index] = {'status': status.HTTP_403_FORBIDDEN,
+                                  'message': 'Inventory decreased to negative prohibited.'}
+            elif failed.get(key) == "sharded":
+                results[index] = {
+                    'status': status.HTTP_409_CONFLICT,
+                    'message': 'Product {} with condition {} has sharded stock, use /inc and /dec'.format(
+                        key[0], key[1].name),
+                }
+            else:
+                results[index] = {'status': status.HTTP_424_FAILED_DEPENDENCY,
+                                  'message': 'Not applied because another adjustment failed'}
+
+        app.logger.info('Adjusted %d of %d Products', len(updated), len(results))
+        if not atomic:
+            return json_response(results, status.HTTP_207_MULTI_STATUS)
+        if invalid:
+            return json_response(results, status.HTTP_400_BAD_REQUEST)
+        if failed:
+            return json_response(results, status.HTTP_409_CONFLICT)
+        return json_response(results)
+
+######################################################################
+#  PATH: /inventory/export
+######################################################################
+@api.route('/inventory/export')
+class ProductExport(Resource):
+    """ Exports the whole inventory """
+
+    @api.doc('export_products')
+    @api.doc(params=export_args.params)
+    @api.response(200, 'Every eligible Product, streamed')
+    @api.response(400, 'The format or condition was not valid')
+    @api.produces(['text/csv', 'application/x-ndjson'])
+    def get(self):
+        """Streams every eligible Product as CSV or NDJSON, gzipped if the client accepts it"""
+        args = export_args.parse_args()
+        app.logger.info("Request to export products as %s", args["format"])
+        products = Product.stream(product_query(args), app.config["STREAM_BATCH_SIZE"])
+        chunks = export_products(stream_query(products), args["format"])
+        mimetype = "text/csv" if args["format"] == "csv" else "application/x-ndjson"
+        headers = {
+            "Content-Disposition": 'attachment; filename="inventory.{}"'.format(args["format"]),
+            "Vary": "Accept-Encoding",
+        }
+        if request.accept_encodings["gzip"]:
+            chunks = gzip_chunks(chunks)
+            headers["Content-Encoding"] = "gzip"
+        return Response(stream_with_context(chunks), status=status.HTTP_200_OK, headers=headers, mimetype=mimetype)
+
+######################################################################
+#  PATH: /admin/cache
+######################################################################
+@api.route('/admin/cache')
+class CacheResource(Resource):
+    """ Inspects and clears the Product read cache of this worker """
+
+    @api.doc('get_cache_stats')
+    def get(self):
+        """Returns the hit and miss counters of the cache"""
+        return product_cache.stats(), status.HTTP_200_OK
+
+    @api.doc('clear_cache')
+    @api.response(204, 'Cache cleared')
+    def delete(self):
+        """Removes every entry from the cache"""
+        app.logger.info('Request to clear the Product cache')
+        product_cache.clear()
+        return '', status.HTTP_204_NO_CONTENT
+
+######################################################################
+#  PATH: /admin/restock
+######################################################################
+@api.route('/admin/restock')
+class RestockResource(Resource):
+    """ Applies the restock rule to the whole inventory """
+
+    @api.doc('restock_products')
+    @api.response(200, 'The reorder report')
+    def post(self):
+        """Restocks every NEW Product below its restock level and reports the reorders"""
+        app.logger.info('Request to restock all Products')
+        return json_response(restock_products())
+
+######################################################################
+#  PATH: /inventory/<int:product_id>/shards
+######################################################################
+@api.route('/inventory/<int:product_id>/shards')
+@api.param('product_id', 'The Product identifier')
+class ShardResource(Resource):
+    """ Splits the stock of a hot Product across sub-counters """
+
+    @api.doc('shard_products')
+    @api.response(400, 'The condition or count was not valid')
+    @api.response(404, 'Product not found')
+    @api.response(200, 'Success', product_model)
+    @api.doc(params=shard_args.params)
+    def put(self, product_id):
+        """split the stock of a product across count shards, or merge them back with count=0"""
+        args = shard_args.parse_args()
+        app.logger.info('Request to split the stock of Product %s across %d shards', product_id, args['count'])
+        product = shards.reshard(product_id, args['condition'], args['count'])
+        if not product:
+            abort(status.HTTP_404_NOT_FOUND, "Product {} with condition {} was not found".format(
+                product_id, args['condition'].name))
+        invalidate_product(product_id)
+        return product_response(product)
+
+######################################################################
+#  PATH: /admin/pool
+######################################################################
+@api.route('/admin/pool')
+class PoolResource(Resource):
+    """ Inspects the database connection pool of this worker """
+
+    @api.doc('get_pool_stats')
+    def get(self):
+        """Returns the state of the pool and its checkout wait times"""
+        return pool_status(db.engine), status.HTTP_200_OK
 
 ######################################################################
 #  PATH: /inventory/<int:product_id>/inc
@@ -306,32 +733,17 @@ class IncreaseResource(Resource):
     @api.doc('increase_products')
     @api.response(400, 'The posted Product data was not valid')
     @api.response(404, 'Product not found')
-    @api.expect(product_args, validate=True)
+    @api.doc(params=product_args.params)
     def put(self, product_id):
         """increase a product's inventory by a certain value"""
         app.logger.info('Request to increase a product\'s inventory by a certain value with id: %s', product_id)
         args = product_args.parse_args()
-        # condition = args.get("condition")
-        # value = args.get("value")
-        if not args['condition'] or not args['value']:
-            abort(status.HTTP_400_BAD_REQUEST, "Value 'condition' and 'value' should be provided")
-        value_int = int(args['value'])
-        # try:
-        #     value_int = int(args['value'])
-        # except ValueError:
-        #     abort(status.HTTP_400_BAD_REQUEST, "'value' not an integer")
-        if value_int < 0:
-            abort(status.HTTP_400_BAD_REQUEST, "'value' should be non-negative")
-        if args['condition'] not in ['NEW', 'OPEN_BOX', 'USED', 'UNKNOWN']:
-            abort(status.HTTP_400_BAD_REQUEST, "'condition' not valid")
-        product = Product.find_by_id_and_condition(product_id, args['condition'])
+        increase = ledger.increase if app.config["INVENTORY_LEDGER"] else Product.increase
+        product, _ = adjust_stock(increase, shards.increase, product_id, args['condition'], args['value'])
         if not product:
-            abort(status.HTTP_404_NOT_FOUND, "Product {} with condition {} was not found".format(product_id, args['condition']))
-        
-        product.quantity += value_int
-        check_and_reorder_product(product)
-        product.save()
-        return product.serialize(), status.HTTP_200_OK
+            abort(status.HTTP_404_NOT_FOUND, "Product {} with condition {} was not found".format(product_id, args['condition'].name))
+        invalidate_product(product_id)
+        return product_response(product)
 
 ######################################################################
 #  PATH: /inventory/<int:product_id>/dec
@@ -346,33 +758,20 @@ class DecreaseResource(Resource):
     @api.response(400, 'The posted Product data was not valid')
     @api.response(403, 'Inventory decreased to negative prohibited.') 
     @api.response(404, 'Product not found')   
-    @api.expect(product_args, validate=True)
+    @api.doc(params=product_args.params)
     def put(self, product_id):
         """decrease a product's inventory by a certain value"""
         app.logger.info('Request to decrease a product\'s inventory by a certain value with id: %s', product_id)
         args = product_args.parse_args()
-        condition = args.get("condition")
-        value = args.get("value")
-        if not condition or not value:
-            abort(status.HTTP_400_BAD_REQUEST, "Value 'condition' and 'value' should be provided")
-        value_int = int(value)
-        # try:
-        #     value_int = int(value)
-        # except ValueError:
-        #     abort(status.HTTP_400_BAD_REQUEST, "'value' not an integer")
-        if value_int < 0:
-            abort(status.HTTP_400_BAD_REQUEST, "'value' should be non-negative")
-        if condition not in ['NEW', 'OPEN_BOX', 'USED', 'UNKNOWN']:
-            abort(status.HTTP_400_BAD_REQUEST, "'condition' not valid")
-        product = Product.find_by_id_and_condition(product_id, condition)
+        condition = args["condition"]
+        decrease = ledger.decrease if app.config["INVENTORY_LEDGER"] else Product.decrease
+        product, found = adjust_stock(decrease, shards.decrease, product_id, condition, args["value"])
+        if not found:
+            abort(status.HTTP_404_NOT_FOUND, "Product {} with condition {} was not found".format(product_id, condition.name))
         if not product:
-            abort(status.HTTP_404_NOT_FOUND, "Product {} with condition {} was not found".format(product_id, condition))
-        if value_int > product.quantity:
             abort(status.HTTP_403_FORBIDDEN, "Inventory decreased to negative prohibited.")
-        product.quantity -= value_int
-        check_and_reorder_product(product)
-        product.save()
-        return product.serialize(), status.HTTP_200_OK
+        invalidate_product(product_id)
+        return product_response(product)
 
 ######################################################################
 #  PATH: /inventory/<int:product_id>/update
@@ -384,32 +783,17 @@ class UpdateResource(Resource):
     @api.doc('update_products')
     @api.response(400, 'The posted Product data was not valid')
     @api.response(404, 'Product not found')
-    @api.expect(product_args, validate=True)
+    @api.doc(params=product_args.params)
     def put(self,product_id):
         """update a product's inventory by a certain value"""
         app.logger.info('Request to update a product\'s inventory with a certain value with id: %s', product_id)
         args = product_args.parse_args()
-        # condition = args.get("condition")
-        # value = args.get("value")
-        if not args['condition'] or not args['value']:
-            abort(status.HTTP_400_BAD_REQUEST, "Value 'condition' and 'value' should be provided")
-        value_int = int(args['value'])
-        # try:
-        #     value_int = int(args['value'])
-        # except ValueError:
-        #     abort(status.HTTP_400_BAD_REQUEST, "'value' not an integer")
-        if value_int < 0:
-            abort(status.HTTP_400_BAD_REQUEST, "'value' should be non-negative")
-        if args['condition'] not in ['NEW', 'OPEN_BOX', 'USED', 'UNKNOWN']:
-                abort(status.HTTP_400_BAD_REQUEST, "'condition' not valid")
-        product = Product.find_by_id_and_condition(product_id, args['condition'])
+        set_quantity = ledger.set_quantity if app.config["INVENTORY_LEDGER"] else Product.set_quantity
+        product, _ = adjust_stock(set_quantity, shards.set_quantity, product_id, args['condition'], args['value'])
         if not product:
-            abort(status.HTTP_404_NOT_FOUND, "Product {} with condition {} was not found".format(product_id, args['condition']))
-
-        product.quantity = value_int
-        check_and_reorder_product(product)
-        product.save()
-        return product.serialize(), status.HTTP_200_OK
+            abort(status.HTTP_404_NOT_FOUND, "Product {} with condition {} was not found".format(product_id, args['condition'].name))
+        invalidate_product(product_id)
+        return product_response(product)
 
 
 
@@ -632,6 +1016,160 @@ def init_db():
     print("init database sucessfully")
 
 
+def product_etag(versions):
+    """Returns the ETag of Products from their Product.versions() summary"""
+    return "-".join("{:x}".format(value) for value in versions)
+
+
+def etag_header(etag):
+    """Returns the headers that carry an ETag"""
+    return {"ETag": quote_etag(etag)}
+
+
+def products_etag(products, next_page=None):
+    """Returns the ETag of loaded Products, which in ledger mode includes their newest movements
+
+    The ETag of a page also changes when next_page, whether another page follows it, does.
+    """
+    versions = Product.versions_of(products)
+    if next_page is not None:
+        versions += (int(next_page),)
+    if app.config["INVENTORY_LEDGER"]:
+        versions += (sum(product.newest_movement for product in products),)
+    if any(product.shards for product in products):
+        versions += (sum(product.shard_version for product in products),)
+    return product_etag(versions)
+
+
+def product_response(product, code=status.HTTP_200_OK, headers=None):
+    """Returns a single Product as JSON together with its ETag"""
+    headers = dict(headers or {}, **etag_header(products_etag([product])))
+    return json_response(product_dict(product), code, headers)
+
+
+def not_modified(etag):
+    """Returns a 304 response telling the client its copy is still current"""
+    app.logger.info("Returning not modified: %s", etag)
+    return Response(status=status.HTTP_304_NOT_MODIFIED, headers=etag_header(etag))
+
+
+def invalidate_product(product_id):
+    """Removes every cached read of a product_id"""
+    product_cache.delete((product_id, None), *((product_id, condition.name) for condition in Condition))
+
+
+def fetch_products(query):
+    """Returns the Products of a query with their current quantity, in ledger mode or with sharded stock"""
+    if app.config["INVENTORY_LEDGER"]:
+        return shards.totals(list(ledger.balances(query)))
+    return shards.totals(query.all())
+
+
+def stream_query(query):
+    """Returns the Products of a streamed query with their current quantity, like fetch_products"""
+    products = ledger.balances(query) if app.config["INVENTORY_LEDGER"] else query
+    return shards.stream_totals(products, app.config["STREAM_BATCH_SIZE"])
+
+
+def product_query(args):
+    """Returns the Product query for the product_name and condition filters in args"""
+    if args["product_name"] and args["condition"]:
+        return Product.find_by_name_and_condition(args["product_name"], args["condition"])
+    if args["product_name"]:
+        return Product.find_by_name(args["product_name"])
+    if args["condition"]:
+        return Product.find_by_condition(args["condition"])
+    return Product.query
+
+
+def restock_products():
+    """Runs the restock sweep and returns its reorder report"""
+    start = time.perf_counter()
+    # in ledger mode products.quantity is not the quantity, the balances are
+    restock_all = ledger.restock_all if app.config["INVENTORY_LEDGER"] else Product.restock_all
+    restocked = restock_all(app.config["RESTOCK_BATCH_SIZE"])
+    for product_id in {product["product_id"] for product in restocked}:
+        invalidate_product(product_id)
+    return {
+        "restocked": len(restocked),
+        "reordered_quantity": sum(product["reorder_amount"] for product in restocked),
+        "seconds": round(time.perf_counter() - start, 3),
+        "products": restocked,
+    }
+
+
+def stream_products(products, ndjson=False):
+    """Streams Products as NDJSON lines or as one JSON array, a batch of rows per chunk"""
+    batch_size = app.config["STREAM_BATCH_SIZE"]
+
+    def generate():
+        count = 0
+        chunk = []
+        if not ndjson:
+            yield "["
+        for product in products:
+            line = product_json(product)
+            chunk.append(line + "\n" if ndjson else ("," if count else "") + line)
+            count += 1
+            if len(chunk) >= batch_size:
+                yield "".join(chunk)
+                chunk = []
+        if not ndjson:
+            chunk.append("]")
+        yield "".join(chunk)
+        app.logger.info("Streamed %d products", count)
+
+    mimetype = "application/x-ndjson" if ndjson else "application/json"
+    return Response(stream_with_context(generate()), status=status.HTTP_200_OK, mimetype=mimetype)
+
+
+def parse_adjustment(item):
+    """Returns the (product_id, Condition, delta) of an adjustment, or why it is not valid"""
+    try:
+        adjustment = validate_adjustment(item)
+    except DataValidationError as error:
+        return str(error)
+    return adjustment["product_id"], adjustment["condition"], adjustment["delta"]
+
+
+def export_products(products, export_format):
+    """Yields Products as CSV (with a header line) or NDJSON text, a batch of rows per chunk"""
+    batch_size = app.config["STREAM_BATCH_SIZE"]
+    count = 0
+    if export_format == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator="\n")
+        writer.writerow(PRODUCT_FIELDS)
+        for product in products:
+            writer.writerow(product_values(product))
+            count += 1
+            if count % batch_size == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+    else:
+        chunk = []
+        for product in products:
+            chunk.append(product_json(product) + "\n")
+            count += 1
+            if len(chunk) >= batch_size:
+                yield "".join(chunk)
+                chunk = []
+        yield "".join(chunk)
+    app.logger.info("Exported %d products", count)
+
+
+def gzip_chunks(chunks):
+    """Compresses text chunks into one gzip stream"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
+
+
 def check_content_type(media_type):
     """Checks that the media type is correct"""
     content_type = request.headers.get("Content-Type")
@@ -644,8 +1182,34 @@ def check_content_type(media_type):
     )
 
 
+def adjust_stock(single_row, sharded, product_id, condition, value):
+    """Writes the quantity of a Product with single_row, or with sharded when it has shards
+
+    Products this worker has seen sharded go straight to sharded and skip
+    the single-row UPDATE, which matches nothing for them.
+
+    Returns:
+        the written Product or None, and whether the Product exists
+    """
+    known = shards.known(product_id, condition)
+    if known:
+        try:
+            return sharded(known, value, check_and_reorder_product), True
+        except shards.NotSharded:
+            app.logger.info("Product %s is not sharded anymore", product_id)
+    product = single_row(product_id, condition, value)
+    if product:
+        return product, True
+    found = Product.find_by_id_and_condition(product_id, condition)
+    if found and found.shards:
+        return sharded(found, value, check_and_reorder_product), True
+    return None, found is not None
+
+
 def check_and_reorder_product(product):
     """check if condition of product is new and the quantity of product is lower than the restock level, than reorder product
+
+    The quantity of a sharded product is the sum of its shards, see service/shards.py
     """
     if product.condition.name == "NEW" and product.quantity < product.restock_level:
         app.logger.info("restock product")
@@ -0,0 +1,78 @@
+"""
+Serializers for Product
+
+Builds the JSON documents described by the Swagger product_model straight
+from Product attributes, without flask-restx marshalling walking every field
+of every row on each request.
+"""
+import json
+from flask import Response
+from service.models import Condition
+from . import status
+
+# The fields of a serialized Product, in the order of the Swagger product_model
+PRODUCT_FIELDS = (
+    "id",
+    "product_id",
+    "product_name",
+    "quantity",
+    "condition",
+    "restock_level",
+    "reorder_amount",
+)
+
+CONDITION_NAMES = {condition: condition.name for condition in Condition}
+CONDITION_NAMES[None] = None
+
+
+def product_dict(product):
+    """Serializes a Product into a dictionary of PRODUCT_FIELDS
+
+    Each attribute is read once with plain attribute access and the enum name
+    of the condition is looked up in CONDITION_NAMES instead of being computed.
+    """
+    return {
+        "id": product.id,
+        "product_id": product.product_id,
+        "product_name": product.product_name,
+        "quantity": product.quantity,
+        "condition": CONDITION_NAMES[product.condition],
+        "restock_level": product.restock_level,
+        "reorder_amount": product.reorder_amount,
+    }
+
+
+def product_values(product):
+    """Returns the PRODUCT_FIELDS of a Product as a tuple, e.g. for a CSV row"""
+    return (
+        product.id,
+        product.product_id,
+        product.product_name,
+        product.quantity,
+        CONDITION_NAMES[product.condition],
+        product.restock_level,
+        product.reorder_amount,
+    )
+
+
+_encoder = json.JSONEncoder(separators=(",", ":"))
+
+
+def dumps(data):
+    """Encodes data as JSON"""
+    return _encoder.encode(data)
+
+
+def product_json(product):
+    """Encodes a Product as a JSON document"""
+    return dumps(product_dict(product))
+
+
+def json_response(data, code=status.HTTP_200_OK, headers=None):
+    """Returns a JSON Response for data that is already serialized"""
+    return json_text_response(dumps(data), code, headers)
+
+
+def json_text_response(body, code=status.HTTP_200_OK, headers=None):
+    """Returns a JSON Response for a document that is already encoded"""
+    return Response(body, status=code, headers=headers, mimetype="application/json")
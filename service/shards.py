@@ -0,0 +1,343 @@
+"""
+Sharded stock
+
+During a sale a few Products take most of the writes, and every /dec of one
+of them waits for the lock of its products row. The stock of such a Product
+can be split across count rows of product_shards:
+
+  PUT /inventory/<product_id>/shards?condition=NEW&count=8
+
+An increase adds to a random shard and a decrease takes from a random shard
+that holds enough, so concurrent writers mostly lock different rows. The
+quantity of a sharded Product is products.quantity, which resharding sets
+to 0, plus the sum of its shards: reads add them up, and the restock rule
+(check_and_reorder_product) is applied to the sum after every write.
+count=0 folds the shards back into products.quantity.
+
+The single-row UPDATEs of Product and the ledger skip sharded Products, so
+the routes fall back to this module when they match nothing, and from then
+on call it first: every worker remembers the sharded Products it has seen.
+
+A write that locks the products row and shards locks the row first and the
+shards in shard order, so two writers never wait for each other's locks.
+"""
+import logging
+import random
+from collections import namedtuple
+
+from sqlalchemy import bindparam, func, insert, update
+
+from service.models import Product, ProductShard, StockMovement, db
+
+logger = logging.getLogger("flask.app")
+
+# what the writes need of a sharded Product, remembered by (product_id, Condition)
+ShardedProduct = namedtuple("ShardedProduct", "id product_id condition shards")
+_known = {}
+
+
+class NotSharded(Exception):
+    """The Product has no shards (anymore), write it with the single-row UPDATEs"""
+
+
+def known(product_id, condition):
+    """Returns the ShardedProduct this worker last saw for product_id and condition, or None"""
+    return _known.get((product_id, condition))
+
+
+def _remember(product):
+    """Records whether a Product is sharded for known()"""
+    key = (product.product_id, product.condition)
+    if product.shards:
+        _known[key] = ShardedProduct(product.id, product.product_id, product.condition, product.shards)
+    else:
+        _known.pop(key, None)
+
+
+######################################################################
+#  Q U A N T I T I E S
+######################################################################
+def totals(products):
+    """Adds the shards of the sharded Products among products to their quantity
+
+    The sharded Products are detached, so their quantity is never written
+    back, and carry the sum of the versions of their shards for their ETag.
+
+    Returns:
+        products
+    """
+    sharded = {product.id: product for product in products if product.shards}
+    if sharded:
+        rows = (
+            db.session.query(
+                ProductShard.product_row_id, func.sum(ProductShard.quantity), func.sum(ProductShard.version))
+            .filter(ProductShard.product_row_id.in_(sharded))
+            .group_by(ProductShard.product_row_id)
+        )
+        for row_id, quantity, version in rows:
+            product = sharded[row_id]
+            if product in db.session:
+                db.session.expunge(product)
+            product.quantity += quantity
+            product.shard_version = version
+    return products
+
+
+def stream_totals(products, batch_size):
+    """Yields streamed Products with totals() applied to every batch_size of them"""
+    batch = []
+    for product in products:
+        batch.append(product)
+        if len(batch) >= batch_size:
+            yield from totals(batch)
+            batch = []
+    yield from totals(batch)
+
+
+def version_of(product):
+    """Returns the sum of the versions of the shards of a Product that was loaded without its totals"""
+    return db.session.query(func.coalesce(func.sum(ProductShard.version), 0)).filter(
+        ProductShard.product_row_id == product.id).scalar()
+
+
+def split(quantity, count):
+    """Returns quantity split into count nearly equal parts"""
+    return [quantity // count + (shard < quantity % count) for shard in range(count)]
+
+
+######################################################################
+#  R E S H A R D I N G
+######################################################################
+def reshard(product_id, condition, count):
+    """
+    Splits the quantity of a Product evenly across count shards
+
+    With count 0 the quantity is folded back into products.quantity. The
+    pending ledger movements of the Product are folded in as well, since
+    the ledger skips sharded Products.
+
+    Returns:
+        the Product with its quantity, or None when it does not exist
+    """
+    logger.info("Splitting %s with condition %s across %d shards", product_id, condition, count)
+    try:
+        product = Product.query.filter(
+            Product.product_id == product_id, Product.condition == condition).with_for_update().first()
+        if not product:
+            db.session.rollback()
+            return None
+        row_id = product.id
+        shards = ProductShard.query.filter(ProductShard.product_row_id == row_id)
+        movements = StockMovement.query.filter(StockMovement.product_row_id == row_id, ~StockMovement.compacted)
+        locked = shards.with_entities(ProductShard.quantity).order_by(ProductShard.shard).with_for_update()
+        quantity = (
+            product.quantity
+            + sum(part for part, in locked)
+            + movements.with_entities(func.coalesce(func.sum(StockMovement.delta), 0)).scalar()
+        )
+        movements.update({"compacted": True}, synchronize_session=False)
+        shards.delete(synchronize_session=False)
+        if count:
+            db.session.execute(insert(ProductShard), [
+                {"product_row_id": row_id, "shard": shard, "quantity": part}
+                for shard, part in enumerate(split(quantity, count))
+            ])
+        product.quantity = 0 if count else quantity
+        product.shards = count
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return _load(row_id)
+
+
+######################################################################
+#  W R I T E S
+######################################################################
+def increase(product, value, reorder=None):
+    """
+    Adds value to a random shard of a sharded Product and restocks it with reorder
+
+    Raises:
+        NotSharded: when the Product has no shards
+    """
+    logger.info("Increasing a shard of %s by %d", product.product_id, value)
+    row_id = product.id
+    quantity = ProductShard.quantity + value
+    try:
+        applied = _update(row_id, random.randrange(product.shards), quantity)
+        if not applied:
+            # the Product was resharded since it was read
+            applied = any(_update(row_id, shard, quantity) for shard in _shards(row_id)[:1])
+        if not applied:
+            _not_sharded(product)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return restock(row_id, reorder)
+
+
+def decrease(product, value, reorder=None):
+    """
+    Takes value from a shard of a sharded Product that holds enough and restocks it with reorder
+
+    Tries a random shard first, then the shards that hold enough, and only
+    when none does takes value from several shards, locking all of them.
+
+    Returns:
+        the Product with its new quantity, or None when it holds less than value
+
+    Raises:
+        NotSharded: when the Product has no shards
+    """
+    logger.info("Decreasing a shard of %s by %d", product.product_id, value)
+    row_id = product.id
+    quantity = ProductShard.quantity - value
+    try:
+        applied = _update(row_id, random.randrange(product.shards), quantity, quantity >= 0)
+        if not applied:
+            candidates = [
+                shard for shard, in db.session.query(ProductShard.shard)
+                .filter(ProductShard.product_row_id == row_id, ProductShard.quantity >= value)
+                .order_by(ProductShard.quantity.desc())
+            ]
+            applied = any(_update(row_id, shard, quantity, quantity >= 0) for shard in candidates)
+        if not applied and not _shards(row_id):
+            _not_sharded(product)
+        if not applied:
+            applied = _take_across(row_id, value)
+        if not applied:
+            db.session.rollback()
+            return None
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return restock(row_id, reorder)
+
+
+def set_quantity(product, value, reorder=None):
+    """
+    Spreads value evenly across the shards of a sharded Product and restocks it with reorder
+
+    Raises:
+        NotSharded: when the Product has no shards
+    """
+    logger.info("Setting the shards of %s to %d", product.product_id, value)
+    row_id = product.id
+    try:
+        if not spread(product, value):
+            _not_sharded(product)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return restock(row_id, reorder)
+
+
+def spread(product, quantity):
+    """
+    Spreads quantity evenly across the shards of a Product, without committing
+
+    Lets PUT /inventory/<product_id> save the other fields of the Product
+    and its quantity in one transaction. The products row is locked before
+    the shards, which are locked in shard order.
+
+    Returns:
+        whether the Product has shards
+    """
+    try:
+        db.session.query(Product.id).filter(Product.id == product.id).with_for_update().scalar()
+        shards = _shards(product.id, lock=True)
+        if shards:
+            db.session.execute(
+                update(ProductShard.__table__)
+                .where(ProductShard.product_row_id == product.id, ProductShard.shard == bindparam("index"))
+                .values(quantity=bindparam("part"), version=ProductShard.version + 1),
+                [{"index": shard, "part": part} for shard, part in zip(shards, split(quantity, len(shards)))],
+            )
+    except Exception:
+        db.session.rollback()
+        raise
+    return bool(shards)
+
+
+def restock(row_id, reorder=None):
+    """
+    Applies reorder, the check_and_reorder_product rule, to the sum of the shards of a Product
+
+    Only a Product below its restock level locks its products row, to
+    check the sum again, so two writers never both restock it.
+
+    Returns:
+        the Product with its quantity
+    """
+    product = _load(row_id)
+    if reorder is None or not product.shards:
+        return product
+    quantity = product.quantity
+    reorder(product)
+    if product.quantity == quantity:
+        return product
+    try:
+        locked = db.session.query(Product.quantity).filter(Product.id == row_id).with_for_update().scalar()
+        product.quantity = locked + db.session.query(func.coalesce(func.sum(ProductShard.quantity), 0)).filter(
+            ProductShard.product_row_id == row_id).scalar()
+        quantity = product.quantity
+        reorder(product)
+        if product.quantity != quantity:
+            _update(row_id, random.randrange(product.shards), ProductShard.quantity + product.quantity - quantity)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return _load(row_id)
+
+
+def _shards(row_id, lock=False):
+    """Returns the shards of a products row in shard order, locked with lock"""
+    query = db.session.query(ProductShard.shard).filter(ProductShard.product_row_id == row_id).order_by(
+        ProductShard.shard)
+    return [shard for shard, in (query.with_for_update() if lock else query)]
+
+
+def _not_sharded(product):
+    """Forgets a Product that has no shards anymore and raises NotSharded"""
+    _known.pop((product.product_id, product.condition), None)
+    raise NotSharded(product.product_id)
+
+
+def _take_across(row_id, value):
+    """Takes value from several shards, in shard order, when they hold enough between them"""
+    shards = db.session.query(ProductShard.shard, ProductShard.quantity).filter(
+        ProductShard.product_row_id == row_id).order_by(ProductShard.shard).with_for_update().all()
+    if sum(quantity for _, quantity in shards) < value:
+        return False
+    for shard, quantity in shards:
+        take = min(quantity, value)
+        # the guard catches the writers a database without row locks (SQLite) lets in
+        if take and not _update(row_id, shard, ProductShard.quantity - take, ProductShard.quantity >= take):
+            return False
+        value -= take
+        if not value:
+            break
+    return True
+
+
+def _update(row_id, shard, quantity, *guards):
+    """Sets the quantity of one shard with a conditional UPDATE and returns whether it matched"""
+    result = db.session.execute(
+        update(ProductShard)
+        .where(ProductShard.product_row_id == row_id, ProductShard.shard == shard, *guards)
+        .values(quantity=quantity, version=ProductShard.version + 1)
+        .execution_options(synchronize_session=False)
+    )
+    return bool(result.rowcount)
+
+
+def _load(row_id):
+    """Reads a Product with the sum of its shards"""
+    product = totals([Product.query.populate_existing().filter(Product.id == row_id).one()])[0]
+    _remember(product)
+    return product
@@ -0,0 +1,226 @@
+"""
+Request validation
+
+Compiles the Swagger models and the query string arguments of the routes
+into plain functions once, at import, like service/serializers.py does for
+the responses. Each request is then checked and converted in a single pass:
+a resource receives ints, booleans and Condition members rather than the
+strings of the request, and nothing parses the request a second time.
+
+An invalid value raises DataValidationError with the message the client
+gets in the 400 Bad Request answer.
+"""
+from flask import request, abort
+from flask_restx import fields
+from service.models import Condition, DataValidationError
+from . import status
+
+CONDITIONS = {condition.name: condition for condition in Condition}
+BOOLEANS = {"true": True, "1": True, "false": False, "0": False}
+
+
+######################################################################
+#  C O N V E R T E R S
+######################################################################
+# Each converter turns one value of a request into its Python value and
+# raises TypeError, ValueError or KeyError when it cannot; its schema
+# attribute documents the value in Swagger.
+
+
+def integer(value):
+    """Converts an int, or a string of digits as HTML forms send it, into an int"""
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise TypeError(value)
+    return int(value)
+
+
+integer.schema = {"type": "integer"}
+
+
+def strict_integer(value):
+    """Accepts an int, as a JSON number, but no string"""
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise TypeError(value)
+    return value
+
+
+strict_integer.schema = {"type": "integer"}
+
+
+def string(value):
+    """Accepts a string"""
+    if not isinstance(value, str):
+        raise TypeError(value)
+    return value
+
+
+string.schema = {"type": "string"}
+
+
+def boolean(value):
+    """Converts a boolean, or true/false/1/0, into a bool"""
+    if isinstance(value, bool):
+        return value
+    return BOOLEANS[value.lower()]
+
+
+boolean.schema = {"type": "boolean"}
+
+
+def condition(value):
+    """Converts the name of a Condition into the Condition"""
+    return CONDITIONS[value]
+
+
+condition.schema = {"type": "string", "enum": list(CONDITIONS)}
+
+
+def int_range(low, high):
+    """Returns a converter of ints from low to high"""
+    def convert(value):
+        number = integer(value)
+        if not low <= number <= high:
+            raise ValueError(number)
+        return number
+    convert.schema = {"type": "integer", "minimum": low, "maximum": high}
+    return convert
+
+
+def choice(*choices):
+    """Returns a converter that accepts one of choices"""
+    def convert(value):
+        if value not in choices:
+            raise ValueError(value)
+        return value
+    convert.schema = {"type": "string", "enum": list(choices)}
+    return convert
+
+
+def quantity(value):
+    """Converts the value of /inc, /dec and /update"""
+    number = integer(value)
+    if number < 0:
+        raise DataValidationError("'value' should be non-negative")
+    if number == 0:  # the quantity routes have always treated 0 as a missing value
+        raise DataValidationError("Value 'condition' and 'value' should be provided")
+    return number
+
+
+quantity.schema = {"type": "integer", "minimum": 1}
+
+
+######################################################################
+#  C O M P I L E R
+######################################################################
+def _compile_validator(name, rules, query=False, not_a_dict=None):
+    """Returns a function that checks and converts the values of a mapping
+
+    rules are (key, convert, required, invalid, default) tuples: required is
+    the message of a missing value or None when the value is optional,
+    invalid the message of a value convert rejects. The function returns the
+    dictionary of the converted values, without the optional values that are
+    missing and have no default. In query mode a blank value counts as
+    missing and every argument is returned, None when it is missing.
+    """
+    rules = tuple(rules)
+
+    def validate(data):
+        if not_a_dict and not isinstance(data, dict):
+            raise DataValidationError(not_a_dict)
+        get = data.get
+        values = {}
+        for key, convert, required, invalid, default in rules:
+            value = get(key)
+            if value is None or (query and value == ""):
+                if required:
+                    raise DataValidationError(required)
+                if default is not None or query:
+                    values[key] = default
+                continue
+            try:
+                values[key] = convert(value)
+            except (TypeError, ValueError, KeyError, AttributeError):
+                raise DataValidationError(invalid) from None
+        return values
+
+    validate.__name__ = validate.__qualname__ = name
+    return validate
+
+
+def compile_model(model, strict=False):
+    """Compiles a Swagger model into a function that validates a JSON object of it
+
+    The fields of the model choose the converters: Integer, Boolean and
+    String, the latter as a Condition when its enum holds the Condition
+    names. Read-only fields are ignored. Integer fields accept the digit
+    strings the HTML form sends unless strict is set.
+    """
+    rules = []
+    for key, field in model.items():
+        if field.readonly:
+            continue
+        if isinstance(field, fields.Integer):
+            convert, kind = strict_integer if strict else integer, "an integer"
+        elif isinstance(field, fields.Boolean):
+            convert, kind = boolean, "a boolean"
+        elif getattr(field, "enum", None) == list(CONDITIONS):
+            convert, kind = condition, "a valid condition"
+        else:
+            convert, kind = string, "a string"
+        rules.append((
+            key, convert,
+            "Invalid {}: missing {}".format(model.name, key) if field.required else None,
+            "Invalid {}: {} must be {}".format(model.name, key, kind),
+            None,
+        ))
+    validate = _compile_validator(
+        "validate_" + model.name.lower(), rules,
+        not_a_dict="Invalid {}: body of request contained bad or no data".format(model.name),
+    )
+    validate.__doc__ = "Validates a {} and returns its converted fields".format(model.name)
+    return validate
+
+
+class Argument:
+    """A query string argument: how it is converted, its default and its Swagger description"""
+
+    def __init__(self, name, convert=string, required=None, invalid=None, default=None, help=""):
+        # pylint: disable=redefined-builtin
+        self.name = name
+        self.convert = convert
+        self.required = required
+        self.invalid = invalid or "'{}' not valid".format(name)
+        self.default = default
+        self.help = help
+
+    def param(self):
+        """Returns the Swagger description of the argument"""
+        param = dict(self.convert.schema, description=self.help, required=bool(self.required))
+        param["in"] = "query"
+        if self.default is not None:
+            param["default"] = self.default
+        return param
+
+
+class QueryArgs:
+    """The query string arguments of a route, compiled into one validator
+
+    Replaces reqparse.RequestParser: parse_args() checks and converts the
+    arguments of the current request, and params documents them with
+    @api.doc(params=...).
+    """
+
+    def __init__(self, name, arguments):
+        self.arguments = arguments
+        self.validate = _compile_validator(
+            name, [(arg.name, arg.convert, arg.required, arg.invalid, arg.default) for arg in arguments],
+            query=True,
+        )
+        self.params = {arg.name: arg.param() for arg in arguments}
+
+    def parse_args(self, query=None):
+        """Returns the converted arguments of query, by default those of the request, or aborts with 400"""
+        try:
+            return self.validate(request.args if query is None else query)
+        except DataValidationError as error:
+            abort(status.HTTP_400_BAD_REQUEST, str(error))
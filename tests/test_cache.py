@@ -0,0 +1,86 @@
+"""
+Test cases for the Product caches
+
+"""
+import unittest
+from service.cache import LRUCache, NullCache, create_cache
+
+
+class FakeClock:
+    """A clock that only moves when told to"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+######################################################################
+#  C A C H E   T E S T   C A S E S
+######################################################################
+class TestCache(unittest.TestCase):
+    """ Test Cases for the Product caches """
+
+    def test_lru_get_and_set(self):
+        """Cache and read back values"""
+        cache = LRUCache(max_size=10, ttl=5)
+        self.assertIsNone(cache.get("a"))
+        cache.set("a", 1)
+        self.assertEqual(cache.get("a"), 1)
+        stats = cache.stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["hit_ratio"], 0.5)
+
+    def test_lru_expires_entries(self):
+        """Entries expire after the ttl"""
+        clock = FakeClock()
+        cache = LRUCache(max_size=10, ttl=5, clock=clock)
+        cache.set("a", 1)
+        clock.now = 4.9
+        self.assertEqual(cache.get("a"), 1)
+        clock.now = 5.0
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.stats()["size"], 0)
+
+    def test_lru_evicts_least_recently_used(self):
+        """The least recently used entry is evicted when the cache is full"""
+        cache = LRUCache(max_size=2, ttl=5)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_lru_delete_and_clear(self):
+        """Delete some entries or all of them"""
+        cache = LRUCache()
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.delete("a", "missing")
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("b"), 2)
+        cache.clear()
+        self.assertIsNone(cache.get("b"))
+
+    def test_null_cache(self):
+        """The null cache holds nothing"""
+        cache = NullCache()
+        cache.set("a", 1)
+        self.assertIsNone(cache.get("a"))
+        cache.delete("a")
+        cache.clear()
+        self.assertEqual(cache.stats()["misses"], 1)
+
+    def test_create_cache(self):
+        """Create the cache named in the configuration"""
+        cache = create_cache({"CACHE_TYPE": "lru", "CACHE_MAX_SIZE": 7, "CACHE_TTL": 2})
+        self.assertIsInstance(cache, LRUCache)
+        self.assertEqual(cache.max_size, 7)
+        self.assertEqual(cache.ttl, 2)
+        self.assertIsInstance(create_cache({"CACHE_TYPE": "null"}), NullCache)
+        self.assertIsInstance(create_cache({"CACHE_TYPE": "service.cache:NullCache"}), NullCache)
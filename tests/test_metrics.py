@@ -0,0 +1,96 @@
+"""
+Test cases for the metrics primitives
+
+"""
+import os
+import tempfile
+import time
+import unittest
+from service.metrics import Histogram, RequestMetrics
+
+
+######################################################################
+#  M E T R I C S   T E S T   C A S E S
+######################################################################
+class TestHistogram(unittest.TestCase):
+    """ Test Cases for Histogram """
+
+    def test_observe(self):
+        """Count observations in cumulative buckets"""
+        histogram = Histogram(buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 3.0):
+            histogram.observe(value)
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot["buckets"], [[0.1, 2], [1.0, 3], ["+Inf", 4]])
+        self.assertEqual(snapshot["count"], 4)
+        self.assertAlmostEqual(snapshot["sum"], 3.65)
+
+    def test_empty(self):
+        """An empty histogram has zero counts"""
+        snapshot = Histogram(buckets=(1.0,)).snapshot()
+        self.assertEqual(snapshot, {"buckets": [[1.0, 0], ["+Inf", 0]], "sum": 0.0, "count": 0})
+
+
+class TestRequestMetrics(unittest.TestCase):
+    """ Test Cases for RequestMetrics """
+
+    def test_render(self):
+        """Render requests, latencies and database time"""
+        metrics = RequestMetrics()
+        metrics.observe("product_resource", "GET", 200, 0.002, 0.001)
+        metrics.observe("product_resource", "GET", 404, 0.02, 0.0)
+        text = metrics.render()
+        self.assertIn('inventory_http_requests_total{endpoint="product_resource",method="GET",status="200"} 1', text)
+        self.assertIn('inventory_http_requests_total{endpoint="product_resource",method="GET",status="404"} 1', text)
+        self.assertIn('inventory_http_request_duration_seconds_bucket'
+                      '{endpoint="product_resource",method="GET",le="0.0025"} 1', text)
+        self.assertIn('inventory_http_request_duration_seconds_bucket'
+                      '{endpoint="product_resource",method="GET",le="+Inf"} 2', text)
+        self.assertIn('inventory_http_request_duration_seconds_count{endpoint="product_resource",method="GET"} 2', text)
+        self.assertIn('inventory_db_duration_seconds_count{endpoint="product_resource",method="GET"} 2', text)
+        self.assertIn("# TYPE inventory_db_duration_seconds histogram", text)
+
+    def test_collect_from_workers(self):
+        """Add up the metrics every worker wrote to the metrics directory"""
+        with tempfile.TemporaryDirectory() as directory:
+            first = RequestMetrics(directory, worker_id=1)
+            second = RequestMetrics(directory, worker_id=2)
+            first.observe("product_collection", "GET", 200, 0.1, 0.05)
+            second.observe("product_collection", "GET", 200, 0.2, 0.05)
+            second.observe("product_collection", "POST", 201, 0.2, 0.1)
+            first.flush(force=True)
+            second.flush(force=True)
+            requests, latency, db_time = first.collect()
+            self.assertEqual(requests[("product_collection", "GET", "200")], 2)
+            self.assertEqual(requests[("product_collection", "POST", "201")], 1)
+            self.assertEqual(latency[("product_collection", "GET")]["count"], 2)
+            self.assertAlmostEqual(latency[("product_collection", "GET")]["sum"], 0.3)
+            self.assertAlmostEqual(db_time[("product_collection", "GET")]["sum"], 0.1)
+            self.assertEqual(sorted(os.listdir(directory)), ["metrics-1.json", "metrics-2.json"])
+
+    def test_flush_interval(self):
+        """Only write the snapshot once per flush interval"""
+        with tempfile.TemporaryDirectory() as directory:
+            metrics = RequestMetrics(directory, flush_interval=3600, worker_id=1)
+            metrics.flush()
+            metrics.observe("index", "GET", 200, 0.1, 0.0)
+            metrics.flush()
+            requests, _, _ = RequestMetrics(directory, worker_id=2).collect()
+            self.assertEqual(requests, {})
+            metrics.flush(force=True)
+            requests, _, _ = RequestMetrics(directory, worker_id=2).collect()
+            self.assertEqual(requests, {("index", "GET", "200"): 1})
+
+    def test_flush_idle(self):
+        """Write the observations made within the flush interval once the worker is idle"""
+        with tempfile.TemporaryDirectory() as directory:
+            metrics = RequestMetrics(directory, flush_interval=0.05, worker_id=1)
+            metrics.observe("index", "GET", 200, 0.1, 0.0)
+            metrics.flush()
+            metrics.observe("index", "GET", 200, 0.1, 0.0)
+            metrics.flush()
+            other = RequestMetrics(directory, worker_id=2)
+            deadline = time.monotonic() + 5
+            while other.collect()[0] != {("index", "GET", "200"): 2} and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(other.collect()[0], {("index", "GET", "200"): 2})
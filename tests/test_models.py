@@ -7,9 +7,12 @@ import logging
 from multiprocessing import Condition
 import unittest
 import os
+from unittest.mock import patch
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm.exc import StaleDataError
 
-from numpy import product
-from service.models import Product, DataValidationError, db, Condition
+from service.models import Product, DataValidationError, db, Condition, retry_tries
 from service import app
 from werkzeug.exceptions import NotFound
 from .factories import ProductFactory
@@ -246,3 +249,156 @@ class TestProductModel(unittest.TestCase):
         # self.assertEqual(product.quantity, products[1].quantity)
         
 
+
+    def test_bulk_create(self):
+        """Bulk create Products in small batches"""
+        products = [
+            Product(product_id=10001, product_name="apple", quantity=1, condition=Condition.NEW),
+            Product(product_id=10001, product_name="apple", quantity=2, condition=Condition.USED),
+            Product(product_id=10002, product_name="pear", quantity=3, condition=Condition.NEW),
+            Product(product_id=10001, product_name="apple", quantity=4, condition=Condition.NEW),
+        ]
+        results = Product.bulk_create(products, batch_size=2)
+        self.assertEqual(len(results), 4)
+        self.assertIsNone(results[3])
+        for result, product in zip(results[:3], products):
+            self.assertIsNotNone(result.id)
+            self.assertEqual(result.quantity, product.quantity)
+        self.assertEqual(len(Product.all()), 3)
+        # a second call conflicts on every row
+        again = [Product(product_id=10002, product_name="pear", quantity=3, condition=Condition.NEW)]
+        self.assertEqual(Product.bulk_create(again), [None])
+        self.assertEqual(len(Product.all()), 3)
+
+    def test_increase_decrease_and_set_quantity(self):
+        """Adjust the quantity of a Product in the database"""
+        Product(product_id=10001, product_name="apple", quantity=5, condition=Condition.USED).create()
+        product = Product.increase(10001, "USED", 3)
+        self.assertEqual(product.quantity, 8)
+        product = Product.decrease(10001, Condition.USED, 8)
+        self.assertEqual(product.quantity, 0)
+        self.assertIsNone(Product.decrease(10001, "USED", 1))
+        product = Product.set_quantity(10001, "USED", 42)
+        self.assertEqual(product.quantity, 42)
+        self.assertEqual(Product.find_by_id_and_condition(10001, "USED").quantity, 42)
+        self.assertIsNone(Product.increase(10001, "NEW", 1))
+        self.assertIsNone(Product.set_quantity(10002, "USED", 1))
+
+    def test_adjust_quantity_restocks_new_products(self):
+        """Adjusting the quantity applies the restock rule to NEW Products only"""
+        Product(product_id=10001, product_name="apple", quantity=20, condition=Condition.NEW,
+                restock_level=10, reorder_amount=15).create()
+        Product(product_id=10001, product_name="apple", quantity=20, condition=Condition.USED,
+                restock_level=10, reorder_amount=15).create()
+        self.assertEqual(Product.decrease(10001, "NEW", 12).quantity, 23)
+        self.assertEqual(Product.decrease(10001, "USED", 12).quantity, 8)
+        self.assertEqual(Product.set_quantity(10001, "NEW", 9).quantity, 24)
+        self.assertEqual(Product.set_quantity(10001, "NEW", 10).quantity, 10)
+        self.assertEqual(Product.increase(10001, "NEW", 0).quantity, 10)
+
+    def test_adjust_many(self):
+        """Apply many deltas in one transaction, best effort"""
+        Product(product_id=10001, product_name="apple", quantity=20, condition=Condition.NEW,
+                restock_level=10, reorder_amount=15).create()
+        Product(product_id=10002, product_name="pear", quantity=2, condition=Condition.USED).create()
+        updated, failed = Product.adjust_many(
+            [(10001, "NEW", -12), (10002, "USED", -3), (10003, "USED", 1)],
+            atomic=False,
+        )
+        self.assertEqual(list(updated), [(10001, Condition.NEW)])
+        self.assertEqual(updated[(10001, Condition.NEW)].quantity, 23)
+        self.assertEqual(updated[(10001, Condition.NEW)].version, 2)
+        self.assertEqual(failed, {(10002, Condition.USED): "insufficient quantity",
+                                  (10003, Condition.USED): "not found"})
+        self.assertEqual(Product.find_by_id_and_condition(10001, "NEW").quantity, 23)
+        self.assertEqual(Product.find_by_id_and_condition(10002, "USED").quantity, 2)
+        self.assertEqual(Product.adjust_many([]), ({}, {}))
+        self.assertRaises(DataValidationError, Product.adjust_many, [(10002, "USED", -2), (10002, "USED", 2)])
+        self.assertEqual(Product.find_by_id_and_condition(10002, "USED").quantity, 2)
+
+    def test_adjust_many_atomic(self):
+        """Apply no delta unless all of them can be applied"""
+        Product(product_id=10001, product_name="apple", quantity=5, condition=Condition.USED).create()
+        Product(product_id=10002, product_name="pear", quantity=2, condition=Condition.USED).create()
+        updated, failed = Product.adjust_many([(10001, "USED", 3), (10002, "USED", -3)])
+        self.assertEqual(updated, {})
+        self.assertEqual(failed, {(10002, Condition.USED): "insufficient quantity"})
+        self.assertEqual(Product.find_by_id_and_condition(10001, "USED").quantity, 5)
+        updated, failed = Product.adjust_many([(10001, "USED", 3), (10002, "USED", -2)])
+        self.assertEqual(failed, {})
+        self.assertEqual({key: product.quantity for key, product in updated.items()},
+                         {(10001, Condition.USED): 8, (10002, Condition.USED): 0})
+
+    def test_restock_all(self):
+        """Restock every NEW Product below its restock level, in id batches"""
+        for number, (quantity, condition) in enumerate(
+                [(1, Condition.NEW), (20, Condition.NEW), (1, Condition.USED), (3, Condition.NEW)]):
+            Product(product_id=10001 + number, product_name="apple", quantity=quantity, condition=condition,
+                    restock_level=10, reorder_amount=15).create()
+        restocked = Product.restock_all(batch_size=2)
+        self.assertEqual([(row["product_id"], row["quantity"]) for row in restocked], [(10001, 16), (10004, 18)])
+        self.assertEqual(Product.find_by_id_and_condition(10004, "NEW").quantity, 18)
+        self.assertEqual(Product.find_by_id_and_condition(10004, "NEW").version, 2)
+        self.assertEqual(Product.find_by_id_and_condition(10003, "USED").quantity, 1)
+        self.assertEqual(Product.restock_all(), [])
+
+    def test_page(self):
+        """Page through Products in id order"""
+        for product in ProductFactory.create_batch(5):
+            product.create()
+        products, cursor = Product.page(Product.query, 3)
+        self.assertEqual(len(products), 3)
+        self.assertEqual(cursor, products[-1].id)
+        rest, cursor = Product.page(Product.query, 3, cursor)
+        self.assertEqual(len(rest), 2)
+        self.assertIsNone(cursor)
+        self.assertEqual([product.id for product in products + rest], [1, 2, 3, 4, 5])
+
+    def test_version_increments_on_writes(self):
+        """Every write to a Product increments its version"""
+        product = Product(product_id=10001, product_name="apple", quantity=5, condition=Condition.USED)
+        product.create()
+        self.assertEqual(product.version, 1)
+        product.quantity = 6
+        product.save()
+        self.assertEqual(product.version, 2)
+        self.assertEqual(Product.increase(10001, "USED", 1).version, 3)
+        query = Product.find_by_id(10001)
+        self.assertEqual(Product.versions(query), (1, 3, product.id, product.id))
+        self.assertEqual(Product.versions(query), Product.versions_of(query.all()))
+        self.assertEqual(Product.versions(Product.find_by_id(10002)), (0, 0, 0, 0))
+
+    def test_init_db_retries_connect(self):
+        """Retry the database connection at boot with backoff"""
+        error = OperationalError("SELECT 1", {}, None)
+        with patch("service.migrations.schema_status", side_effect=[error, error, (3, 3)]) as status, \
+                patch("service.models.RETRY_DELAY", 0):
+            Product.init_db(app)
+        self.assertEqual(status.call_count, 3)
+        with patch("service.migrations.schema_status", side_effect=error), \
+                patch("service.models.RETRY_DELAY", 0), patch("service.models.RETRY_COUNT", 2):
+            self.assertRaises(OperationalError, Product.init_db, app)
+
+    def test_retry_tries(self):
+        """Keep the waits between the connection tries within the timeout"""
+        self.assertEqual(retry_tries(10, 1, 2, 8, 24), 6)  # waits 1, 2, 4, 8 and 8 seconds
+        self.assertEqual(retry_tries(10, 1, 2, 8, 1000), 10)
+        self.assertEqual(retry_tries(10, 0, 2, 8, 0), 10)
+        self.assertEqual(retry_tries(10, 30, 2, 60, 24), 1)
+
+    def test_save_compare_and_swap(self):
+        """Refuse to save a Product that was changed since it was read"""
+        product = Product(product_id=10001, product_name="apple", quantity=5, condition=Condition.USED)
+        product.create()
+        self.assertEqual(product.version, 1)
+        with db.engine.begin() as connection:
+            connection.execute(text("UPDATE products SET quantity = 9, version = version + 1"))
+        product.quantity = 6
+        self.assertRaises(StaleDataError, product.save)
+        self.assertEqual(Product.find(product.id).quantity, 9)
+        product = Product.find(product.id)
+        product_id = product.id
+        with db.engine.begin() as connection:
+            connection.execute(text("UPDATE products SET version = version + 1"))
+        product.delete()
+        self.assertIsNone(Product.find(product_id))
@@ -6,14 +6,21 @@ Test cases can be run with the following:
   coverage report -m
 """
 import os
+import csv
+import gzip
+import io
+import json
 import logging
 from unittest import TestCase
 from unittest.mock import MagicMock, patch
 from urllib.parse import quote_plus
 from werkzeug.exceptions import NotFound
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
 from service import status  # HTTP Status Codes
 from service.models import db, Product, init_db, Condition
-from service.routes import app
+from service.routes import app, product_cache
+from service.migrations import upgrade
 from .factories import ProductFactory, FuzzyInteger
 from factory import Faker
 
@@ -53,6 +60,7 @@ class TestProductServer(TestCase):
         """ This runs before each test """
         db.drop_all()  # clean up the last tests
         db.create_all()  # create new tables
+        product_cache.clear()
         self.app = app.test_client()
 
     def tearDown(self):
@@ -228,6 +236,20 @@ class TestProductServer(TestCase):
         resp = self.app.post(BASE_URL, json={}, content_type=CONTENT_TYPE_JSON)
         self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
 
+    def test_create_product_form_strings(self):
+        """Create a Product from the string fields an HTML form posts"""
+        data = {"product_id": "42", "product_name": "apple", "quantity": "3", "condition": "NEW",
+                "restock_level": "1", "reorder_amount": "2"}
+        resp = self.app.post(BASE_URL, json=data, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(resp.get_json()["quantity"], 3)
+        resp = self.app.post(BASE_URL, json=dict(data, quantity="three"), content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(resp.get_json()["message"], "Invalid Product: quantity must be an integer")
+        resp = self.app.put(BASE_URL + "/42", query_string="condition=NEW", json=dict(data, product_id=None),
+                            content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_create_product_no_content_type(self):
         """Create a Product with no content type"""
         resp = self.app.post(BASE_URL)
@@ -284,6 +306,49 @@ class TestProductServer(TestCase):
         self.assertEqual(updated_product["quantity"], 15)
         self.assertEqual(new_product["condition"], updated_product["condition"])
 
+    def test_update_product_if_match(self):
+        """Update a Product only while it has the ETag of If-Match"""
+        product = self._create_products(1)[0]
+        url = "{}/{}".format(BASE_URL, product.product_id)
+        query = "condition=" + product.condition.name
+        etag = self.app.get(url, query_string=query).headers["ETag"]
+        data = dict(product.serialize(), quantity=product.quantity + 1)
+        resp = self.app.put(url, query_string=query, json=data, headers={"If-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+        resp = self.app.put(url, query_string=query, json=data, headers={"If-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        resp = self.app.put(url, query_string=query, json=data, headers={"If-Match": "*"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_update_product_race(self):
+        """Retry an update that lost a race, unless the client sent If-Match"""
+        product = self._create_products(1)[0]
+        url = "{}/{}".format(BASE_URL, product.product_id)
+        query = "condition=" + product.condition.name
+        data = dict(product.serialize(), quantity=500)
+
+        def concurrent_write(changed):
+            """Another worker changes the Product between the read and the write"""
+            with db.engine.begin() as connection:
+                connection.execute(text("UPDATE products SET version = version + 1"))
+
+        races = iter([True])
+        with patch("service.routes.check_and_reorder_product",
+                   side_effect=lambda changed: next(races, False) and concurrent_write(changed)):
+            resp = self.app.put(url, query_string=query, json=data)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["quantity"], 500)
+
+        etag = self.app.get(url, query_string=query).headers["ETag"]
+        data["quantity"] = 600
+        with patch("service.routes.check_and_reorder_product", side_effect=concurrent_write):
+            resp = self.app.put(url, query_string=query, json=data, headers={"If-Match": etag})
+            self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+            resp = self.app.put(url, query_string=query, json=data)
+            self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(self.app.get(url, query_string=query).get_json()["quantity"], 500)
+
     def test_update_product_not_found(self):
         """Update a non-existing Product"""
         # create an product without id to update
@@ -596,3 +661,412 @@ class TestProductServer(TestCase):
         )
         self.assertEqual(resp.status_code, status.HTTP_403_FORBIDDEN)
     
+
+    def test_bulk_create_products(self):
+        """Create many Products in one request"""
+        test_products = ProductFactory.create_batch(5)
+        resp = self.app.post(
+            BASE_URL + "/bulk",
+            json=[product.serialize() for product in test_products],
+            content_type=CONTENT_TYPE_JSON,
+        )
+        self.assertEqual(resp.status_code, status.HTTP_207_MULTI_STATUS)
+        data = resp.get_json()
+        self.assertEqual(len(data), 5)
+        for result, test_product in zip(data, test_products):
+            self.assertEqual(result["status"], status.HTTP_201_CREATED)
+            self.assertEqual(result["product"]["product_id"], test_product.product_id)
+            self.assertEqual(result["product"]["condition"], test_product.condition.name)
+        resp = self.app.get(BASE_URL)
+        self.assertEqual(len(resp.get_json()), 5)
+
+    def test_bulk_create_products_partial(self):
+        """Bulk create reports conflicts and bad rows per entry"""
+        existing = self._create_products(1)[0]
+        new_product = ProductFactory(product_id=existing.product_id + 1)
+        body = [
+            existing.serialize(),
+            new_product.serialize(),
+            new_product.serialize(),
+            {"product_name": "no id"},
+        ]
+        resp = self.app.post(BASE_URL + "/bulk", json=body, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_207_MULTI_STATUS)
+        data = resp.get_json()
+        self.assertEqual(
+            [result["status"] for result in data],
+            [status.HTTP_409_CONFLICT, status.HTTP_201_CREATED, status.HTTP_409_CONFLICT, status.HTTP_400_BAD_REQUEST],
+        )
+        self.assertIn("message", data[0])
+        self.assertNotIn("product", data[0])
+        resp = self.app.get(BASE_URL)
+        self.assertEqual(len(resp.get_json()), 2)
+
+    def test_bulk_create_products_bad_body(self):
+        """Bulk create requires a list of Products"""
+        resp = self.app.post(BASE_URL + "/bulk", json={}, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post(BASE_URL + "/bulk")
+        self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
+    def test_bulk_create_products_too_many(self):
+        """Bulk create rejects requests over the size limit"""
+        body = [product.serialize() for product in ProductFactory.create_batch(3)]
+        with patch.dict(app.config, {"BULK_MAX_ITEMS": 2}):
+            resp = self.app.post(BASE_URL + "/bulk", json=body, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+    def test_get_product_list_pages(self):
+        """Page through the list of Products with a cursor"""
+        products = self._create_products(5)
+        resp = self.app.get(BASE_URL, query_string="limit=2")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        seen = [product["id"] for product in resp.get_json()]
+        self.assertEqual(len(seen), 2)
+        while "Link" in resp.headers:
+            self.assertIn('rel="next"', resp.headers["Link"])
+            next_url = resp.headers["Link"].split(">")[0][1:]
+            self.assertIn("cursor=" + resp.headers["X-Next-Cursor"], next_url)
+            resp = self.app.get(next_url)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            seen.extend(product["id"] for product in resp.get_json())
+        self.assertEqual(seen, sorted(product.id for product in products))
+
+    def test_query_product_list_by_condition_pages(self):
+        """Page through Products filtered by condition"""
+        for product_id in range(10001, 10004):
+            product = ProductFactory(product_id=product_id, condition=Condition.USED)
+            resp = self.app.post(BASE_URL, json=product.serialize(), content_type=CONTENT_TYPE_JSON)
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.app.post(BASE_URL, json=ProductFactory(condition=Condition.NEW).serialize(),
+                      content_type=CONTENT_TYPE_JSON)
+        resp = self.app.get(BASE_URL, query_string="condition=USED&limit=2")
+        self.assertEqual(len(resp.get_json()), 2)
+        self.assertIn("condition=USED", resp.headers["Link"])
+        resp = self.app.get(BASE_URL, query_string="condition=USED&limit=2&cursor={}".format(
+            resp.headers["X-Next-Cursor"]))
+        data = resp.get_json()
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]["condition"], "USED")
+        self.assertNotIn("Link", resp.headers)
+
+    def test_get_product_list_bad_limit(self):
+        """Reject page sizes out of range"""
+        resp = self.app.get(BASE_URL, query_string="limit=0")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get(BASE_URL, query_string="limit=100000")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get(BASE_URL, query_string="cursor=abc")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_stream_product_list(self):
+        """Stream every Product as a JSON array"""
+        products = self._create_products(5)
+        with patch.dict(app.config, {"STREAM_BATCH_SIZE": 2}):
+            resp = self.app.get(BASE_URL, query_string="stream=true&limit=1")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, "application/json")
+        data = resp.get_json()
+        self.assertEqual([product["id"] for product in data], sorted(product.id for product in products))
+
+    def test_stream_product_list_ndjson(self):
+        """Stream Products as NDJSON when the client accepts it"""
+        products = self._create_products(3)
+        test_condition = products[0].condition.name
+        resp = self.app.get(
+            BASE_URL, query_string="condition={}".format(test_condition),
+            headers={"Accept": "application/x-ndjson"},
+        )
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, "application/x-ndjson")
+        lines = resp.get_data(as_text=True).splitlines()
+        expected = [product for product in products if product.condition.name == test_condition]
+        self.assertEqual(len(lines), len(expected))
+        for line in lines:
+            self.assertEqual(json.loads(line)["condition"], test_condition)
+
+    def test_stream_empty_product_list(self):
+        """Stream an empty list of Products"""
+        resp = self.app.get(BASE_URL, query_string="stream=1")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), [])
+
+    def test_adjust_products(self):
+        """Apply many adjustments atomically"""
+        products = self._create_products(2)
+        body = [
+            {"product_id": product.product_id, "condition": product.condition.name, "delta": 5}
+            for product in products
+        ]
+        resp = self.app.post(BASE_URL + "/adjustments", json=body, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        for result, product in zip(data, products):
+            self.assertEqual(result["status"], status.HTTP_200_OK)
+            self.assertEqual(result["product"]["id"], product.id)
+            self.assertGreaterEqual(result["product"]["quantity"], product.quantity + 5)
+
+    def test_adjust_products_atomic_failure(self):
+        """Apply no adjustment of an atomic request when one fails"""
+        product = self._create_products(1)[0]
+        body = [
+            {"product_id": product.product_id, "condition": product.condition.name, "delta": 1},
+            {"product_id": product.product_id + 1, "condition": product.condition.name, "delta": 1},
+        ]
+        resp = self.app.post(BASE_URL + "/adjustments", json=body, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual([result["status"] for result in resp.get_json()],
+                         [status.HTTP_424_FAILED_DEPENDENCY, status.HTTP_404_NOT_FOUND])
+        found = Product.find_by_id_and_condition(product.product_id, product.condition.name)
+        self.assertEqual(found.quantity, product.quantity)
+
+        body[1] = {"product_id": "x", "condition": "NEW", "delta": 1}
+        resp = self.app.post(BASE_URL + "/adjustments", json=body, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_adjust_products_best_effort(self):
+        """Apply every adjustment of a best_effort request that can be applied"""
+        product = self._create_products(1)[0]
+        condition = product.condition.name
+        body = [
+            {"product_id": product.product_id, "condition": condition, "delta": -(product.quantity + 1)},
+            {"product_id": product.product_id + 1, "condition": condition, "delta": 1},
+            {"product_id": product.product_id, "condition": "BROKEN", "delta": 1},
+            {"product_id": product.product_id, "condition": condition, "delta": True},
+            "not an object",
+        ]
+        resp = self.app.post(BASE_URL + "/adjustments", query_string="mode=best_effort",
+                             json=body, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_207_MULTI_STATUS)
+        self.assertEqual(
+            [result["status"] for result in resp.get_json()],
+            [status.HTTP_403_FORBIDDEN, status.HTTP_404_NOT_FOUND, status.HTTP_400_BAD_REQUEST,
+             status.HTTP_400_BAD_REQUEST, status.HTTP_400_BAD_REQUEST],
+        )
+        body = [{"product_id": product.product_id, "condition": condition, "delta": -product.quantity}]
+        resp = self.app.post(BASE_URL + "/adjustments", query_string="mode=best_effort",
+                             json=body, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.get_json()[0]["status"], status.HTTP_200_OK)
+
+    def test_adjust_products_duplicates(self):
+        """Reject every adjustment of a product that is adjusted more than once"""
+        product = self._create_products(1)[0]
+        condition = product.condition.name
+        body = [
+            {"product_id": product.product_id, "condition": condition, "delta": -(product.quantity + 1)},
+            {"product_id": product.product_id, "condition": condition, "delta": product.quantity + 1},
+            {"product_id": product.product_id + 1, "condition": condition, "delta": 1},
+        ]
+        resp = self.app.post(BASE_URL + "/adjustments", query_string="mode=best_effort",
+                             json=body, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual([result["status"] for result in resp.get_json()],
+                         [status.HTTP_400_BAD_REQUEST, status.HTTP_400_BAD_REQUEST, status.HTTP_404_NOT_FOUND])
+        found = Product.find_by_id_and_condition(product.product_id, condition)
+        self.assertEqual(found.quantity, product.quantity)
+
+    def test_adjust_products_bad_request(self):
+        """Reject adjustment requests that are not lists or too long"""
+        resp = self.app.post(BASE_URL + "/adjustments", json={}, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post(BASE_URL + "/adjustments", query_string="mode=maybe",
+                             json=[], content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        with patch.dict(app.config, {"BULK_MAX_ITEMS": 1}):
+            resp = self.app.post(BASE_URL + "/adjustments", json=[{}, {}], content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+    def test_restock_products(self):
+        """Restock the whole inventory and report the reorders"""
+        test_product = ProductFactory(condition=Condition.NEW, quantity=1, restock_level=5, reorder_amount=10)
+        test_product.create()
+        self.app.get("{}/{}".format(BASE_URL, test_product.product_id))
+        resp = self.app.post("/admin/restock")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(data["restocked"], 1)
+        self.assertEqual(data["reordered_quantity"], 10)
+        self.assertEqual(data["products"][0]["quantity"], 11)
+        resp = self.app.get("{}/{}".format(BASE_URL, test_product.product_id))
+        self.assertEqual(resp.get_json()[0]["quantity"], 11)
+
+    def test_export_products_csv(self):
+        """Export every Product as CSV"""
+        products = self._create_products(5)
+        with patch.dict(app.config, {"STREAM_BATCH_SIZE": 2}):
+            resp = self.app.get(BASE_URL + "/export")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, "text/csv")
+        self.assertIn("inventory.csv", resp.headers["Content-Disposition"])
+        rows = list(csv.DictReader(io.StringIO(resp.get_data(as_text=True))))
+        self.assertEqual([int(row["id"]) for row in rows], sorted(product.id for product in products))
+        first = next(product for product in products if product.id == int(rows[0]["id"]))
+        self.assertEqual(rows[0]["condition"], first.condition.name)
+        self.assertEqual(int(rows[0]["quantity"]), first.quantity)
+
+    def test_export_products_ndjson_filtered(self):
+        """Export the Products of one condition as NDJSON"""
+        products = self._create_products(4)
+        test_condition = products[0].condition.name
+        resp = self.app.get(BASE_URL + "/export", query_string="format=ndjson&condition=" + test_condition)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, "application/x-ndjson")
+        lines = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+        expected = [product.id for product in products if product.condition.name == test_condition]
+        self.assertEqual([line["id"] for line in lines], sorted(expected))
+
+    def test_export_products_gzip(self):
+        """Export Products gzipped when the client accepts it"""
+        self._create_products(3)
+        resp = self.app.get(BASE_URL + "/export", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        text = gzip.decompress(resp.get_data()).decode()
+        self.assertEqual(len(text.splitlines()), 4)
+
+    def test_export_products_bad_request(self):
+        """Reject unknown export formats and conditions"""
+        resp = self.app.get(BASE_URL + "/export", query_string="format=xml")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get(BASE_URL + "/export", query_string="condition=BROKEN")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_product_is_cached(self):
+        """Read a Product through the cache"""
+        test_product = self._create_products(1)[0]
+        url = "{}/{}?condition={}".format(BASE_URL, test_product.product_id, test_product.condition.name)
+        hits = product_cache.stats()["hits"]
+        first = self.app.get(url)
+        second = self.app.get(url)
+        self.assertEqual(second.status_code, status.HTTP_200_OK)
+        self.assertEqual(first.get_json(), second.get_json())
+        self.assertEqual(product_cache.stats()["hits"], hits + 1)
+        resp = self.app.get("/admin/cache")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["type"], "lru")
+        resp = self.app.delete("/admin/cache")
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(product_cache.stats()["size"], 0)
+
+    def test_cached_product_invalidated_by_writes(self):
+        """Writes to a Product invalidate its cached reads"""
+        test_product = self._create_products(1)[0]
+        test_id = test_product.product_id
+        condition = test_product.condition.name
+        url = "{}/{}?condition={}".format(BASE_URL, test_id, condition)
+        self.assertEqual(self.app.get(url).get_json()["quantity"], test_product.quantity)
+        self.assertEqual(len(self.app.get("{}/{}".format(BASE_URL, test_id)).get_json()), 1)
+        self.app.put("{}/{}/inc".format(BASE_URL, test_id), query_string="condition={}&value=5".format(condition))
+        self.assertEqual(self.app.get(url).get_json()["quantity"], test_product.quantity + 5)
+        other = ProductFactory(product_id=test_id, condition=Condition.NEW if condition != "NEW" else Condition.USED)
+        self.app.post(BASE_URL, json=other.serialize(), content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(len(self.app.get("{}/{}".format(BASE_URL, test_id)).get_json()), 2)
+        self.app.delete("{}/{}".format(BASE_URL, test_id))
+        self.assertEqual(self.app.get(url).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_get_product_conditional(self):
+        """Answer a conditional GET of an unchanged Product with 304"""
+        test_product = self._create_products(1)[0]
+        url = "{}/{}?condition={}".format(BASE_URL, test_product.product_id, test_product.condition.name)
+        for _ in range(2):
+            # first from the database, then from the cache
+            resp = self.app.get(url)
+            etag = resp.headers["ETag"]
+            resp = self.app.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+            self.assertEqual(resp.headers["ETag"], etag)
+            self.assertEqual(len(resp.data), 0)
+            product_cache.clear()
+        resp = self.app.put(
+            "{}/{}/inc".format(BASE_URL, test_product.product_id),
+            query_string="condition={}&value=1".format(test_product.condition.name),
+        )
+        self.assertNotEqual(resp.headers["ETag"], etag)
+        resp = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["quantity"], test_product.quantity + 1)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+
+    def test_get_product_list_conditional(self):
+        """Answer a conditional GET of an unchanged list with 304"""
+        products = self._create_products(3)
+        resp = self.app.get(BASE_URL)
+        etag = resp.headers["ETag"]
+        resp = self.app.get(BASE_URL, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.app.put(
+            "{}/{}/update".format(BASE_URL, products[1].product_id),
+            query_string="condition={}&value=7".format(products[1].condition.name),
+        )
+        resp = self.app.get(BASE_URL, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        etag = resp.headers["ETag"]
+        self.app.delete("{}/{}".format(BASE_URL, products[2].product_id))
+        resp = self.app.get(BASE_URL, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()), 2)
+
+    def test_get_product_page_conditional(self):
+        """Change the ETag of a page when a next page appears"""
+        self._create_products(2)
+        url = BASE_URL + "?limit=2"
+        resp = self.app.get(url)
+        etag = resp.headers["ETag"]
+        self.assertNotIn("Link", resp.headers)
+        resp = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self._create_products(1)
+        resp = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertIn("Link", resp.headers)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+        etag = resp.headers["ETag"]
+        resp = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_get_pool_stats(self):
+        """Report the connection pool of the worker"""
+        resp = self.app.get("/admin/pool")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertIn("class", data)
+        self.assertIn("status", data)
+
+    def test_health(self):
+        """Report liveness always and readiness once the pool is warm and the schema current"""
+        upgrade(db.engine)
+        resp = self.app.get("/health/live")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.app.get("/health/ready")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {
+            "status": "ready", "pool_warm": True, "database": True, "schema_current": True
+        })
+        with patch("service.routes.pool_is_warm", return_value=False):
+            resp = self.app.get("/health/ready")
+        self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertFalse(resp.get_json()["pool_warm"])
+
+    def test_health_ready_schema_behind(self):
+        """Not be ready before the schema is migrated or while the database is down"""
+        with patch("service.routes.schema_current", False), \
+                patch("service.migrations.schema_status", return_value=(2, 3)):
+            resp = self.app.get("/health/ready")
+            self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            self.assertFalse(resp.get_json()["schema_current"])
+        with patch("service.routes.schema_current", False), \
+                patch("service.migrations.schema_status", side_effect=OperationalError("SELECT 1", {}, None)):
+            resp = self.app.get("/health/ready")
+            self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            self.assertFalse(resp.get_json()["database"])
+
+    def test_metrics(self):
+        """Serve request metrics in the Prometheus text format"""
+        self._create_products(1)
+        self.app.get(BASE_URL)
+        resp = self.app.get("/metrics")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, "text/plain")
+        text = resp.get_data(as_text=True)
+        self.assertIn('inventory_http_requests_total{endpoint="product_collection",method="GET",status="200"}', text)
+        self.assertIn('inventory_http_requests_total{endpoint="product_collection",method="POST",status="201"}', text)
+        self.assertIn('inventory_db_duration_seconds_count{endpoint="product_collection",method="GET"}', text)
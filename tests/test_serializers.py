@@ -0,0 +1,51 @@
+"""
+Test cases for the Product serializers
+
+"""
+import json
+import unittest
+from flask_restx import marshal
+from service.models import Condition
+from service.routes import app, product_model
+from service.serializers import PRODUCT_FIELDS, product_dict, product_values, product_json, json_response
+from service import status
+from .factories import ProductFactory
+
+
+######################################################################
+#  S E R I A L I Z E R   T E S T   C A S E S
+######################################################################
+class TestSerializers(unittest.TestCase):
+    """ Test Cases for the Product serializers """
+
+    def test_fields_match_swagger_model(self):
+        """The serializer emits exactly the fields of the Swagger model"""
+        self.assertEqual(set(PRODUCT_FIELDS), set(product_model.resolved.keys()))
+
+    def test_product_dict(self):
+        """Serialize a Product like Product.serialize and marshal do"""
+        for condition in Condition:
+            product = ProductFactory(condition=condition, restock_level=3, reorder_amount=4)
+            data = product_dict(product)
+            self.assertEqual(data, product.serialize())
+            self.assertEqual(data, dict(marshal(product.serialize(), product_model)))
+
+    def test_product_values(self):
+        """Read the fields of a Product in PRODUCT_FIELDS order"""
+        product = ProductFactory()
+        self.assertEqual(product_values(product), tuple(product_dict(product).values()))
+
+    def test_product_json(self):
+        """Encode a Product as JSON"""
+        product = ProductFactory()
+        self.assertEqual(json.loads(product_json(product)), product.serialize())
+
+    def test_json_response(self):
+        """Build a JSON response from serialized data"""
+        product = ProductFactory()
+        with app.test_request_context():
+            resp = json_response([product_dict(product)], status.HTTP_201_CREATED, {"Location": "here"})
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(resp.mimetype, "application/json")
+        self.assertEqual(resp.headers["Location"], "here")
+        self.assertEqual(resp.get_json(), [product.serialize()])
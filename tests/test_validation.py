@@ -0,0 +1,98 @@
+"""
+Test cases for the request validators
+
+"""
+import unittest
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import BadRequest
+from service.models import Condition, DataValidationError
+from service.routes import app, validate_product, validate_adjustment, product_args, get_args, update_args
+from service.validation import Argument, QueryArgs, boolean, choice
+
+
+######################################################################
+#  V A L I D A T I O N   T E S T   C A S E S
+######################################################################
+class TestValidation(unittest.TestCase):
+    """ Test Cases for the request validators """
+
+    def test_validate_product(self):
+        """Convert the fields of a Product body"""
+        data = {"product_id": "7", "product_name": "apple", "quantity": 3, "condition": "USED", "id": 99}
+        self.assertEqual(validate_product(data), {
+            "product_id": 7, "product_name": "apple", "quantity": 3, "condition": Condition.USED,
+        })
+        data.update(restock_level=2, reorder_amount="4")
+        values = validate_product(data)
+        self.assertEqual((values["restock_level"], values["reorder_amount"]), (2, 4))
+
+    def test_validate_product_errors(self):
+        """Reject Product bodies that are not valid"""
+        valid = {"product_id": 7, "product_name": "apple", "quantity": 3, "condition": "USED"}
+        cases = {
+            "Invalid Product: body of request contained bad or no data": "not a dictionary",
+            "Invalid Product: missing quantity": dict(valid, quantity=None),
+            "Invalid Product: product_id must be an integer": dict(valid, product_id="x"),
+            "Invalid Product: quantity must be an integer": dict(valid, quantity=True),
+            "Invalid Product: product_name must be a string": dict(valid, product_name=5),
+            "Invalid Product: condition must be a valid condition": dict(valid, condition="BROKEN"),
+        }
+        for message, data in cases.items():
+            with self.assertRaises(DataValidationError) as context:
+                validate_product(data)
+            self.assertEqual(str(context.exception), message)
+
+    def test_validate_adjustment(self):
+        """Convert an adjustment and reject one without a delta"""
+        self.assertEqual(validate_adjustment({"product_id": 1, "condition": "NEW", "delta": -2}),
+                         {"product_id": 1, "condition": Condition.NEW, "delta": -2})
+        self.assertRaises(DataValidationError, validate_adjustment, {"product_id": 1, "condition": "NEW"})
+        for data in ({"product_id": "1", "condition": "NEW", "delta": 5},
+                     {"product_id": 1, "condition": "NEW", "delta": "5"}):
+            self.assertRaises(DataValidationError, validate_adjustment, data)
+
+    def test_query_args(self):
+        """Convert query string arguments and fill in their defaults"""
+        args = get_args.validate(MultiDict({"condition": "NEW", "limit": "5", "stream": "true", "product_name": ""}))
+        self.assertEqual(args, {
+            "product_name": None, "condition": Condition.NEW, "limit": 5, "cursor": None, "stream": True,
+        })
+        args = get_args.validate(MultiDict())
+        self.assertEqual(args["limit"], app.config["PAGE_SIZE_DEFAULT"])
+        self.assertFalse(args["stream"])
+        for query in ({"limit": "0"}, {"limit": "x"}, {"cursor": "1.5"}, {"stream": "maybe"}, {"condition": "x"}):
+            self.assertRaises(DataValidationError, get_args.validate, MultiDict(query))
+
+    def test_quantity_args(self):
+        """Keep the messages of the quantity routes"""
+        self.assertEqual(product_args.validate({"condition": "USED", "value": "3"}),
+                         {"condition": Condition.USED, "value": 3})
+        cases = {
+            "Value 'condition' and 'value' should be provided": [{"condition": "USED"}, {"value": "1"},
+                                                                 {"condition": "USED", "value": "0"}],
+            "'value' should be non-negative": [{"condition": "USED", "value": "-1"}],
+            "'value' not an integer": [{"condition": "USED", "value": "x"}],
+            "'condition' not valid": [{"condition": "BROKEN", "value": "1"}],
+        }
+        for message, queries in cases.items():
+            for query in queries:
+                with self.assertRaises(DataValidationError) as context:
+                    product_args.validate(query)
+                self.assertEqual(str(context.exception), message)
+        self.assertRaises(DataValidationError, update_args.validate, {})
+
+    def test_parse_args(self):
+        """Read the arguments of the request and abort with 400 when they are not valid"""
+        with app.test_request_context("/inventory?format=ndjson"):
+            parser = QueryArgs("format_args", [Argument("format", choice("csv", "ndjson"), default="csv")])
+            self.assertEqual(parser.parse_args(), {"format": "ndjson"})
+        with app.test_request_context("/inventory?format=xml"):
+            self.assertRaises(BadRequest, parser.parse_args)
+
+    def test_params(self):
+        """Document the arguments in Swagger"""
+        parser = QueryArgs("stream_args", [Argument("stream", boolean, default=False, help="Stream")])
+        self.assertEqual(parser.params, {"stream": {
+            "type": "boolean", "description": "Stream", "required": False, "in": "query", "default": False,
+        }})
+        self.assertEqual(product_args.params["condition"]["enum"], Condition._member_names_)